@@ -2,8 +2,14 @@ import contextlib
 import logging as logger
 import time
 import uuid
+from bisect import bisect_right
+from itertools import accumulate
+from itertools import chain
+from itertools import islice
 
+from django.db import connection
 from django.db import transaction
+from django.db.models import F
 from django.db.models import Manager
 from django.db.models import Q
 from django.db.utils import OperationalError
@@ -31,9 +37,45 @@ logging = logger.getLogger(__name__)
 # for more details.
 # The exact optimum batch size is probably highly dependent on tree
 # topology also, so these rudimentary tests are likely insufficient
+# Subtrees larger than the batch size are copied in batches of this many
+# nodes, without holding the lock on the target tree while copying
 BATCH_SIZE = 100
 TREE_LOCK = 1001
 
+# Number of nodes deleted at once, along with their related objects, by `delete_subtree`
+DELETE_BATCH_SIZE = 1000
+
+# Deletes the nodes with the ids in the `ids` parameter, after their related objects
+# and the references to them, in the order their foreign keys require
+DELETE_NODES_SQL = (
+    """
+    DELETE FROM contentcuration_file WHERE assessment_item_id IN (
+        SELECT id FROM contentcuration_assessmentitem WHERE contentnode_id = ANY(%(ids)s)
+    )
+    """,
+    "DELETE FROM contentcuration_file WHERE contentnode_id = ANY(%(ids)s)",
+    "DELETE FROM contentcuration_assessmentitem WHERE contentnode_id = ANY(%(ids)s)",
+    """
+    DELETE FROM contentcuration_file WHERE slideshow_slide_id IN (
+        SELECT id FROM contentcuration_slideshowslide WHERE contentnode_id = ANY(%(ids)s)
+    )
+    """,
+    "DELETE FROM contentcuration_slideshowslide WHERE contentnode_id = ANY(%(ids)s)",
+    "DELETE FROM contentcuration_exercise WHERE contentnode_id = ANY(%(ids)s)",
+    "DELETE FROM contentcuration_contentnode_tags WHERE contentnode_id = ANY(%(ids)s)",
+    """
+    DELETE FROM contentcuration_prerequisitecontentrelationship
+    WHERE target_node_id = ANY(%(ids)s) OR prerequisite_id = ANY(%(ids)s)
+    """,
+    """
+    DELETE FROM contentcuration_relatedcontentrelationship
+    WHERE contentnode_1_id = ANY(%(ids)s) OR contentnode_2_id = ANY(%(ids)s)
+    """,
+    "UPDATE contentcuration_contentnode SET original_node_id = NULL WHERE original_node_id = ANY(%(ids)s)",
+    "UPDATE contentcuration_contentnode SET cloned_source_id = NULL WHERE cloned_source_id = ANY(%(ids)s)",
+    "DELETE FROM contentcuration_contentnode WHERE id = ANY(%(ids)s)",
+)
+
 
 class CustomManager(Manager.from_queryset(CTEQuerySet)):
     """
@@ -57,6 +99,28 @@ def execute_queryset_without_results(queryset):
     cursor.execute(sql, params)
 
 
+class CopyPositions(object):
+    """
+    Maps the lft and rght values of the nodes in a subtree to those of their copies as a new tree,
+    leaving out the excluded descendants
+    """
+
+    def __init__(self, node, excluded_ranges):
+        self.offset = node.lft - 1
+        self.excluded_lfts = [lft for lft, _ in excluded_ranges]
+        self.excluded_rghts = [rght for _, rght in excluded_ranges]
+        self.excluded_widths = list(accumulate(rght - lft + 1 for lft, rght in excluded_ranges))
+
+    def excludes(self, source):
+        index = bisect_right(self.excluded_lfts, source.lft) - 1
+        return index >= 0 and source.lft <= self.excluded_rghts[index]
+
+    def get(self, value):
+        # less the space of the excluded descendants before the value
+        index = bisect_right(self.excluded_rghts, value)
+        return value - self.offset - (self.excluded_widths[index - 1] if index else 0)
+
+
 class CustomContentNodeTreeManager(TreeManager.from_queryset(CustomTreeQuerySet)):
     # Added 7-31-2018. We can remove this once we are certain we have eliminated all cases
     # where root nodes are getting prepended rather than appended to the tree list.
@@ -394,34 +458,178 @@ class CustomContentNodeTreeManager(TreeManager.from_queryset(CustomTreeQuerySet)
             if progress_tracker:
                 progress_tracker.increment(len(copied_nodes))
             return copied_nodes
-        node_copy = self._shallow_copy(
+        return self._stream_copy(
             node,
             target,
             position,
             source_channel_id,
             pk,
             mods,
+            excluded_descendants,
             can_edit_source_channel,
+            batch_size,
+            progress_tracker=progress_tracker,
         )
-        if progress_tracker:
-            progress_tracker.increment()
-        children = node.get_children().order_by("lft")
-        if excluded_descendants:
-            children = children.exclude(node_id__in=excluded_descendants.keys())
-        for child in children:
-            self._copy(
-                child,
-                node_copy,
-                "last-child",
+
+    def _excluded_ranges(self, node, excluded_descendants):
+        """
+        Returns the lft and rght of the outermost excluded descendants of the node, in tree order
+        """
+        if not excluded_descendants:
+            return []
+        ranges = []
+        for lft, rght in (
+            self.filter(
+                node_id__in=excluded_descendants.keys(),
+                tree_id=node.tree_id,
+                lft__gt=node.lft,
+                rght__lt=node.rght,
+            )
+            .order_by("lft")
+            .values_list("lft", "rght")
+        ):
+            if not ranges or lft > ranges[-1][1]:
+                ranges.append((lft, rght))
+        return ranges
+
+    def _stream_source_nodes(self, node, excluded_descendants, batch_size):
+        """
+        Reads the subtree of the node in tree order with a single query, so that it is a consistent
+        snapshot however long the copy takes, without holding a lock on the source tree while copying.
+
+        :return: A tuple of the excluded ranges and an iterator of the nodes, starting with the node itself
+        """
+        while True:
+            with self.lock_mptt(node.tree_id, shared_tree_ids=[node.tree_id]):
+                self._mptt_refresh(node)
+                excluded_ranges = self._excluded_ranges(node, excluded_descendants)
+            source_nodes = (
+                self.filter(tree_id=node.tree_id, lft__gte=node.lft, lft__lt=node.rght)
+                .order_by("lft")
+                .iterator(chunk_size=batch_size)
+            )
+            root = next(source_nodes, None)
+            # Start over if the subtree changed between reading its bounds and reading its nodes
+            if root is not None and root.id == node.id and root.rght == node.rght:
+                return excluded_ranges, chain([root], source_nodes)
+
+    def _clone_subtree(
+        self,
+        node,
+        source_nodes,
+        positions,
+        tree_id,
+        source_channel_id,
+        can_edit_source_channel,
+        pk,
+        mods,
+    ):
+        """
+        Generates the copies of the source nodes, read in tree order, as the nodes of a new tree
+        """
+        # the rghts of the ancestors of the next node to copy, along with the ids of their copies
+        ancestors = []
+        for source in source_nodes:
+            if positions.excludes(source):
+                continue
+            while ancestors and ancestors[-1][0] < source.lft:
+                ancestors.pop()
+            data = self._clone_node(
+                source,
+                ancestors[-1][1] if ancestors else None,
                 source_channel_id,
-                None,
-                None,
-                excluded_descendants,
                 can_edit_source_channel,
-                batch_size,
-                progress_tracker=progress_tracker,
+                None if ancestors else pk,
+                None if ancestors else mods,
+            )
+            data.update(
+                tree_id=tree_id,
+                lft=positions.get(source.lft),
+                rght=positions.get(source.rght),
+                level=source.level - node.level,
+            )
+            ancestors.append((source.rght, data["id"]))
+            yield source.id, self.model(**data)
+
+    def _stream_copy(
+        self,
+        node,
+        target,
+        position,
+        source_channel_id,
+        pk,
+        mods,
+        excluded_descendants,
+        can_edit_source_channel,
+        batch_size,
+        progress_tracker=None,
+    ):
+        """
+        Copies a large subtree by computing the lft, rght and level of every copy in memory as the source
+        nodes are read in tree order, and creating the copies and their associated objects in batches.
+        The copies are built as a separate tree, then moved into the target tree at once, so the target
+        tree is only locked to make space for them.
+
+        :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+        """
+        excluded_ranges, source_nodes = self._stream_source_nodes(node, excluded_descendants, batch_size)
+        tree_id = self._get_next_tree_id()
+        copies = self._clone_subtree(
+            node,
+            source_nodes,
+            CopyPositions(node, excluded_ranges),
+            tree_id,
+            source_channel_id,
+            can_edit_source_channel,
+            pk,
+            mods,
+        )
+        root_id = None
+        try:
+            while True:
+                batch = list(islice(copies, batch_size))
+                if not batch:
+                    break
+                root_id = root_id or batch[0][1].id
+                self.bulk_create([node_copy for _, node_copy in batch])
+                self._copy_associated_objects({source_id: node_copy.id for source_id, node_copy in batch})
+                if progress_tracker:
+                    progress_tracker.increment(len(batch))
+        except Exception:
+            self.filter(tree_id=tree_id).delete()
+            raise
+
+        if target:
+            self._move_tree_to_target(tree_id, root_id, target, position)
+            self.filter(pk=target.pk).update(changed=True)
+        return [self.get(pk=root_id)]
+
+    def _move_tree_to_target(self, tree_id, root_id, target, position):
+        """
+        Moves a whole tree, that nothing else has access to yet, into the space made for it next to the target
+        """
+        from contentcuration.models import TreeResourceSize
+
+        with self.lock_mptt(target.tree_id):
+            self._mptt_refresh(target)
+            if position in ["last-child", "first-child"]:
+                parent_id = target.id
+                level = target.level + 1
+                cursor = target.lft + 1 if position == "first-child" else target.rght
+            else:
+                parent_id = target.parent_id
+                level = target.level
+                cursor = target.lft if position == "left" else target.rght + 1
+            size = self.filter(pk=root_id).values_list("rght", flat=True)[0]
+            self._create_space(size, cursor - 1, target.tree_id)
+            self.filter(tree_id=tree_id).update(
+                tree_id=target.tree_id,
+                lft=F("lft") + cursor - 1,
+                rght=F("rght") + cursor - 1,
+                level=F("level") + level,
             )
-        return [node_copy]
+            self.filter(pk=root_id).update(parent_id=parent_id)
+        TreeResourceSize.clear(tree_id)
 
     def _copy_tags(self, source_copy_id_map):
         from contentcuration.models import ContentTag
@@ -533,29 +741,6 @@ class CustomContentNodeTreeManager(TreeManager.from_queryset(CustomTreeQuerySet)
 
         self._copy_tags(source_copy_id_map)
 
-    def _shallow_copy(
-        self,
-        node,
-        target,
-        position,
-        source_channel_id,
-        pk,
-        mods,
-        can_edit_source_channel,
-    ):
-        data = self._clone_node(
-            node, None, source_channel_id, can_edit_source_channel, pk, mods,
-        )
-        with self.lock_mptt(target.tree_id if target else None):
-            node_copy = self.model(**data)
-            if target:
-                self._mptt_refresh(target)
-            self.insert_node(node_copy, target, position=position, save=False)
-            node_copy.save(force_insert=True)
-
-        self._copy_associated_objects({node.id: node_copy.id})
-        return node_copy
-
     def _deep_copy(
         self,
         node,
@@ -612,3 +797,64 @@ class CustomContentNodeTreeManager(TreeManager.from_queryset(CustomTreeQuerySet)
         self._copy_associated_objects(source_copy_id_map)
 
         return new_nodes
+
+    def delete_subtree(self, node, batch_size=None):
+        """
+        Deletes the node and its descendants with set based statements, without loading them or sending
+        any signals. The subtree is first moved out of its tree, closing the gap it leaves at once, so
+        the tree is only locked for that move, and then deleted in batches.
+
+        :return: The number of nodes deleted
+        """
+        with self.lock_mptt(node.tree_id):
+            self._mptt_refresh(node)
+            parent_id = self.filter(pk=node.pk).values_list("parent_id", flat=True)[0]
+            # nodes can be parented to another tree without having been moved into it, like deleted chef trees
+            if node.lft == 1:
+                tree_id = node.tree_id
+            else:
+                tree_id = self._get_next_tree_id()
+                self.filter(tree_id=node.tree_id, lft__gte=node.lft, lft__lte=node.rght).update(
+                    tree_id=tree_id,
+                    lft=F("lft") - node.lft + 1,
+                    rght=F("rght") - node.lft + 1,
+                    level=F("level") - node.level,
+                )
+                self.filter(pk=node.pk).update(parent_id=None)
+                self._close_gap(node.rght - node.lft + 1, node.rght, node.tree_id)
+                self.filter(pk=parent_id).update(changed=True)
+        return self.delete_tree(tree_id, batch_size=batch_size)
+
+    def delete_tree(self, tree_id, batch_size=None):
+        """
+        Deletes all the nodes of a tree, deepest first, in batches of `batch_size` nodes
+        that are each deleted in a transaction along with their related objects
+
+        :return: The number of nodes deleted
+        """
+        from contentcuration.models import Channel
+        from contentcuration.models import TreeResourceSize
+        from contentcuration.models import User
+
+        if batch_size is None:
+            batch_size = DELETE_BATCH_SIZE
+
+        # Only the roots of trees are referenced by channels and users
+        root_ids = list(self.filter(tree_id=tree_id, lft=1).values_list("id", flat=True))
+        for field in ("main_tree", "trash_tree", "clipboard_tree", "staging_tree", "chef_tree", "previous_tree"):
+            Channel.objects.filter(**{"{}_id__in".format(field): root_ids}).update(**{field: None})
+        User.objects.filter(clipboard_tree_id__in=root_ids).update(clipboard_tree=None)
+
+        deleted = 0
+        ids = True
+        while ids:
+            with transaction.atomic():
+                # descendants come after their ancestors in lft order, so they are deleted first
+                ids = list(self.filter(tree_id=tree_id).order_by("-lft").values_list("id", flat=True)[:batch_size])
+                if ids:
+                    with connection.cursor() as cursor:
+                        for statement in DELETE_NODES_SQL:
+                            cursor.execute(statement, {"ids": ids})
+                    deleted += len(ids)
+        TreeResourceSize.clear(tree_id)
+        return deleted
@@ -3,12 +3,14 @@
 - ContentNodes older than 2 weeks, whose parents are in the designated "garbage
 tree" (i.e. `settings.ORPHANAGE_ROOT_ID`). Also delete the associated Files in the
 database and in object storage.
+- Tasks older than 2 weeks.
 """
 from django.core.management.base import BaseCommand
 
 from contentcuration.utils.garbage_collect import clean_up_contentnodes
 from contentcuration.utils.garbage_collect import clean_up_deleted_chefs
 from contentcuration.utils.garbage_collect import clean_up_feature_flags
+from contentcuration.utils.garbage_collect import clean_up_tasks
 
 
 class Command(BaseCommand):
@@ -23,3 +25,4 @@ class Command(BaseCommand):
         clean_up_contentnodes()
         clean_up_deleted_chefs()
         clean_up_feature_flags()
+        clean_up_tasks()
@@ -1,7 +1,10 @@
 import logging
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import progressbar
 from django.core.management.base import BaseCommand
+from django.db import connection
 
 from contentcuration.models import Channel
 from contentcuration.utils.nodes import generate_diff
@@ -11,18 +14,40 @@ logging.basicConfig()
 logger = logging.getLogger('command')
 
 
+def generate_channel_diff(channel, force=False, include_nodes=False):
+    try:
+        diff = get_diff(channel.staging_tree, channel.main_tree)
+        if force or not diff or (include_nodes and 'nodes' not in diff):
+            generate_diff(channel.staging_tree.pk, channel.main_tree.pk, include_nodes=include_nodes)
+    finally:
+        # each worker thread opens its own database connection
+        connection.close()
+
+
 class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--force", action="store_true", dest="force", default=False)
+        parser.add_argument("--nodes", action="store_true", dest="nodes", default=False,
+                            help="Also report the nodes added, removed and changed in each staging tree")
+        parser.add_argument("--workers", type=int, dest="workers", default=4,
+                            help="Number of channels to generate diffs for concurrently")
 
     def handle(self, *args, **options):
         # Set up variables for restoration process
         logger.info("\n\n********** GENERATING STAGED DIFFS **********")
-        channels_with_staged_changes = Channel.objects.exclude(staging_tree=None)
+        channels_with_staged_changes = Channel.objects.exclude(staging_tree=None).exclude(main_tree=None)\
+            .select_related("staging_tree", "main_tree")
         bar = progressbar.ProgressBar(max_value=channels_with_staged_changes.count())
-        for i, c in enumerate(channels_with_staged_changes):
-            if options["force"] or not get_diff(c.staging_tree, c.main_tree):
-                generate_diff(c.staging_tree.pk, c.main_tree.pk)
-            bar.update(i)
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            futures = {
+                executor.submit(generate_channel_diff, c, force=options["force"], include_nodes=options["nodes"]): c.pk
+                for c in channels_with_staged_changes.iterator()
+            }
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Failed to generate diff for channel {}: {}".format(futures[future], e))
+                bar.update(i)
         logger.info("\n\nDONE")
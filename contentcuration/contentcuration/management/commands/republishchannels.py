@@ -1,18 +1,133 @@
+"""
+Republishes every published channel, for example after a change to the exported database schema or templates.
+
+Channels are republished concurrently, largest first, either in a local process pool or on the Celery
+workers. The outcome of each channel is saved to a checkpoint file as soon as it finishes, so that an
+interrupted run picks up where it left off when it is started again with the same checkpoint.
+"""
+import json
 import logging as logmodule
+import multiprocessing
+import os
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connections
+from django.db.models import F
 
 from contentcuration.models import Channel
+from contentcuration.tasks import republish_channel_task
+from contentcuration.utils.publish import publish_channel
+
 logmodule.basicConfig()
 logging = logmodule.getLogger(__name__)
 
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def republish_channel(channel_id, use_celery=False):
+    """
+    Republishes the channel, in this process or on a Celery worker, and returns the time it took in seconds
+    """
+    start = time.time()
+    if use_celery:
+        republish_channel_task.apply_async((channel_id,)).get()
+    else:
+        try:
+            publish_channel(None, channel_id, force=True)
+        finally:
+            connections.close_all()
+    return time.time() - start
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(path, checkpoint):
+    # write to a temporary file first so an interruption can't leave a partial checkpoint
+    temp_path = "{}.tmp".format(path)
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+    os.replace(temp_path, path)
+
 
 class Command(BaseCommand):
+    help = "Republishes all published channels concurrently, resuming from a checkpoint of an earlier run"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Maximum number of channels to republish at once")
+        parser.add_argument("--celery", action="store_true", default=False,
+                            help="Republish channels on the Celery workers instead of a local process pool")
+        parser.add_argument("--checkpoint", default="republishchannels.json",
+                            help="File recording which channels have been republished")
+        parser.add_argument("--restart", action="store_true", default=False,
+                            help="Republish all channels again, ignoring the checkpoint of an earlier run")
 
     def handle(self, *args, **options):
-        with transaction.atomic():
-            for channel in Channel.objects.filter(main_tree__published=True):
-                logging.debug("Republishing channel {} ({})".format(channel.pk, channel.name))
-                call_command("exportchannel", channel.pk, force=True)
+        checkpoint_path = options["checkpoint"]
+        checkpoint = {} if options["restart"] else load_checkpoint(checkpoint_path)
+
+        # the number of nodes in a tree follows from the lft and rght of its root
+        channels = list(
+            Channel.objects.filter(main_tree__published=True, deleted=False)
+            .annotate(tree_size=F("main_tree__rght") - F("main_tree__lft"))
+            .order_by("-tree_size")
+            .values_list("id", "tree_size")
+        )
+        pending = [
+            (channel_id, tree_size) for channel_id, tree_size in channels
+            if checkpoint.get(channel_id, {}).get("status") != STATUS_DONE
+        ]
+        skipped = len(channels) - len(pending)
+        if skipped:
+            logging.info("Skipping {} channels already republished according to {}".format(skipped, checkpoint_path))
+
+        if options["celery"]:
+            # each thread waits on one channel at a time, which limits how many are queued at once
+            executor = ThreadPoolExecutor(max_workers=options["workers"])
+        else:
+            # connections can't be shared with forked processes, so each worker opens its own
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options["workers"], mp_context=multiprocessing.get_context("fork"))
+
+        start = time.time()
+        republished_nodes = 0
+        failures = {}
+        with executor:
+            futures = {
+                executor.submit(republish_channel, channel_id, use_celery=options["celery"]): (channel_id, tree_size)
+                for channel_id, tree_size in pending
+            }
+            for index, future in enumerate(as_completed(futures), start=1):
+                channel_id, tree_size = futures[future]
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    logging.error("Failed to republish channel {}: {}".format(channel_id, e))
+                    failures[channel_id] = str(e)
+                    checkpoint[channel_id] = {"status": STATUS_FAILED, "error": str(e)}
+                else:
+                    logging.info("Republished channel {} in {:.1f}s ({}/{})".format(channel_id, seconds, index, len(pending)))
+                    republished_nodes += (tree_size + 1) // 2
+                    checkpoint[channel_id] = {"status": STATUS_DONE, "seconds": round(seconds, 1)}
+                save_checkpoint(checkpoint_path, checkpoint)
+
+        elapsed = time.time() - start
+        republished = len(pending) - len(failures)
+        self.stdout.write("Republished {} channels in {:.1f}s, {} failed, {} skipped".format(
+            republished, elapsed, len(failures), skipped
+        ))
+        if elapsed:
+            self.stdout.write("Throughput: {:.1f} channels per hour, {:.1f} nodes per second".format(
+                republished * 3600 / elapsed, republished_nodes / elapsed
+            ))
+        for channel_id, error in failures.items():
+            self.stdout.write("Failed {}: {}".format(channel_id, error))
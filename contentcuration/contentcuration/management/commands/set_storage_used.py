@@ -2,15 +2,19 @@ import progressbar
 from django.core.management.base import BaseCommand
 
 from contentcuration.models import User
+from contentcuration.models import UserChecksumCount
 
 
 class Command(BaseCommand):
+    help = "Recounts the storage used by each user from their files, logging any user whose storage had drifted"
+
     def add_arguments(self, parser):
+        # storage is kept up to date as files change, so every user is reconciled either way
         parser.add_argument("--force", action="store_true", dest="force", default=False)
 
     def handle(self, *args, **options):
-        users = User.objects.all() if options["force"] else User.objects.filter(disk_space_used=0)
-        bar = progressbar.ProgressBar(max_value=users.count())
-        for index, user in enumerate(users):
-            user.set_space_used()
+        user_ids = User.objects.values_list("id", flat=True)
+        bar = progressbar.ProgressBar(max_value=user_ids.count())
+        for index, user_id in enumerate(user_ids.iterator()):
+            UserChecksumCount.rebuild(user_id)
             bar.update(index)
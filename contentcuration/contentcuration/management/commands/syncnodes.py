@@ -3,7 +3,7 @@ import logging as logmodule
 from django.core.management.base import BaseCommand
 
 from contentcuration.models import Channel
-from contentcuration.views.nodes import sync_channel
+from contentcuration.utils.sync import sync_channel
 logmodule.basicConfig()
 logging = logmodule.getLogger(__name__)
 
@@ -13,7 +13,6 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('channel_id', type=str)
         parser.add_argument('--attributes', action='store_true', dest='attributes', default=False)
-        parser.add_argument('--sort', action='store_true', dest='sort', default=False)
         parser.add_argument('--tags', action='store_true', dest='tags', default=False)
         parser.add_argument('--files', action='store_true', dest='files', default=False)
         parser.add_argument('--assessment-items', action='store_true', dest='assessment_items', default=False)
@@ -24,5 +23,4 @@ class Command(BaseCommand):
                      sync_tags=options.get('tags'),
                      sync_files=options.get('files'),
                      sync_assessment_items=options.get('assessment_items'),
-                     sync_sort_order=options.get('sort'),
                      )
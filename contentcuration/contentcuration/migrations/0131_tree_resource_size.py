@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations
+from django.db import models
+
+
+APPLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_apply_tree_checksum_deltas(p_tree_ids integer[]) RETURNS void AS $$
+DECLARE
+    delta_tree_id integer;
+    size_delta bigint;
+BEGIN
+    -- trees are locked in order, so that concurrent calls can't deadlock
+    FOR delta_tree_id IN
+        SELECT DISTINCT tree_id FROM contentcuration_treechecksumdelta
+        WHERE p_tree_ids IS NULL OR tree_id = ANY(p_tree_ids)
+        ORDER BY tree_id
+    LOOP
+        PERFORM pg_advisory_xact_lock(hashtext('contentcuration_treechecksumdelta'), delta_tree_id);
+
+        WITH deltas AS (
+            DELETE FROM contentcuration_treechecksumdelta WHERE tree_id = delta_tree_id
+            RETURNING checksum, file_size, delta
+        ), grouped AS (
+            SELECT checksum, file_size, SUM(delta)::integer AS delta FROM deltas
+            GROUP BY checksum, file_size HAVING SUM(delta) <> 0
+        ), counts AS (
+            INSERT INTO contentcuration_treechecksumcount AS c (tree_id, checksum, file_size, count)
+            SELECT delta_tree_id, checksum, file_size, delta FROM grouped
+            ON CONFLICT (tree_id, checksum, file_size) DO UPDATE SET count = c.count + EXCLUDED.count
+            RETURNING c.checksum, c.file_size, c.count
+        )
+        -- the size of a checksum only counts once per tree, when it first appears and last disappears
+        SELECT COALESCE(SUM(
+            CASE
+                WHEN counts.count > 0 AND counts.count - grouped.delta <= 0 THEN counts.file_size
+                WHEN counts.count <= 0 AND counts.count - grouped.delta > 0 THEN -counts.file_size
+                ELSE 0
+            END
+        ), 0) INTO size_delta
+        FROM counts INNER JOIN grouped
+        ON grouped.checksum = counts.checksum AND grouped.file_size = counts.file_size;
+
+        DELETE FROM contentcuration_treechecksumcount WHERE tree_id = delta_tree_id AND count <= 0;
+
+        IF size_delta <> 0 THEN
+            INSERT INTO contentcuration_treeresourcesize (tree_id, resource_size) VALUES (delta_tree_id, 0)
+            ON CONFLICT (tree_id) DO NOTHING;
+            UPDATE contentcuration_treeresourcesize
+            SET resource_size = resource_size + size_delta WHERE tree_id = delta_tree_id;
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+FILE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_file_tree_checksum_count() RETURNS trigger AS $$
+BEGIN
+    -- changes are queued rather than applied to the tree's counts, so that concurrent changes to
+    -- the same tree don't wait on each other (see contentcuration_apply_tree_checksum_deltas)
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.checksum IS NOT NULL THEN
+        INSERT INTO contentcuration_treechecksumdelta (tree_id, checksum, file_size, delta)
+        SELECT tree_id, OLD.checksum, COALESCE(OLD.file_size, 0), -1
+        FROM contentcuration_contentnode WHERE id = OLD.contentnode_id AND complete;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') AND NEW.checksum IS NOT NULL THEN
+        INSERT INTO contentcuration_treechecksumdelta (tree_id, checksum, file_size, delta)
+        SELECT tree_id, NEW.checksum, COALESCE(NEW.file_size, 0), 1
+        FROM contentcuration_contentnode WHERE id = NEW.contentnode_id AND complete;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_file_tree_checksum_count_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_file
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_file_tree_checksum_count();
+
+CREATE TRIGGER contentcuration_file_tree_checksum_count_update
+AFTER UPDATE OF contentnode_id, checksum, file_size ON contentcuration_file
+FOR EACH ROW
+WHEN (
+    OLD.contentnode_id IS DISTINCT FROM NEW.contentnode_id
+    OR OLD.checksum IS DISTINCT FROM NEW.checksum
+    OR OLD.file_size IS DISTINCT FROM NEW.file_size
+)
+EXECUTE PROCEDURE contentcuration_file_tree_checksum_count();
+"""
+
+NODE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_contentnode_tree_checksum_count() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO contentcuration_treechecksumdelta (tree_id, checksum, file_size, delta)
+    SELECT OLD.tree_id, checksum, COALESCE(file_size, 0), -1
+    FROM contentcuration_file WHERE contentnode_id = NEW.id AND checksum IS NOT NULL AND OLD.complete
+    UNION ALL
+    SELECT NEW.tree_id, checksum, COALESCE(file_size, 0), 1
+    FROM contentcuration_file WHERE contentnode_id = NEW.id AND checksum IS NOT NULL AND NEW.complete;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_contentnode_tree_checksum_count
+AFTER UPDATE OF tree_id, complete ON contentcuration_contentnode
+FOR EACH ROW
+WHEN (OLD.tree_id IS DISTINCT FROM NEW.tree_id OR OLD.complete IS DISTINCT FROM NEW.complete)
+EXECUTE PROCEDURE contentcuration_contentnode_tree_checksum_count();
+"""
+
+POPULATE_SQL = """
+INSERT INTO contentcuration_treechecksumcount (tree_id, checksum, file_size, count)
+SELECT n.tree_id, f.checksum, COALESCE(f.file_size, 0), COUNT(*)
+FROM contentcuration_file f INNER JOIN contentcuration_contentnode n ON n.id = f.contentnode_id
+WHERE n.complete AND f.checksum IS NOT NULL
+GROUP BY n.tree_id, f.checksum, COALESCE(f.file_size, 0);
+
+INSERT INTO contentcuration_treeresourcesize (tree_id, resource_size)
+SELECT tree_id, SUM(file_size) FROM contentcuration_treechecksumcount GROUP BY tree_id;
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS contentcuration_contentnode_tree_checksum_count ON contentcuration_contentnode;
+DROP TRIGGER IF EXISTS contentcuration_file_tree_checksum_count_update ON contentcuration_file;
+DROP TRIGGER IF EXISTS contentcuration_file_tree_checksum_count_insert_delete ON contentcuration_file;
+DROP FUNCTION IF EXISTS contentcuration_contentnode_tree_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_file_tree_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_apply_tree_checksum_deltas(integer[]);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0130_auto_20210706_2005'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeChecksumCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tree_id', models.IntegerField()),
+                ('checksum', models.CharField(max_length=400)),
+                ('file_size', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('tree_id', 'checksum', 'file_size')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TreeResourceSize',
+            fields=[
+                ('tree_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('resource_size', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TreeChecksumDelta',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('tree_id', models.IntegerField(db_index=True)),
+                ('checksum', models.CharField(max_length=400)),
+                ('file_size', models.BigIntegerField()),
+                ('delta', models.IntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=APPLY_FUNCTION_SQL + FILE_TRIGGER_SQL + NODE_TRIGGER_SQL,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+        migrations.RunSQL(
+            sql=POPULATE_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import django.db.models.deletion
+from django.db import migrations
+from django.db import models
+
+
+STALE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_channelsummary_mark_stale() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'contentcuration_treeresourcesize' THEN
+        UPDATE contentcuration_channelsummary SET stale = true WHERE tree_id = NEW.tree_id AND NOT stale;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE contentcuration_channelsummary SET stale = true WHERE tree_id = OLD.tree_id AND NOT stale;
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.tree_id IS DISTINCT FROM OLD.tree_id) THEN
+        UPDATE contentcuration_channelsummary SET stale = true WHERE tree_id = NEW.tree_id AND NOT stale;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_contentnode_channelsummary_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_contentnode
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_channelsummary_mark_stale();
+
+CREATE TRIGGER contentcuration_contentnode_channelsummary_update
+AFTER UPDATE OF tree_id, modified, content_id, kind_id, language_id ON contentcuration_contentnode
+FOR EACH ROW
+WHEN (
+    OLD.tree_id IS DISTINCT FROM NEW.tree_id
+    OR OLD.modified IS DISTINCT FROM NEW.modified
+    OR OLD.content_id IS DISTINCT FROM NEW.content_id
+    OR OLD.kind_id IS DISTINCT FROM NEW.kind_id
+    OR OLD.language_id IS DISTINCT FROM NEW.language_id
+)
+EXECUTE PROCEDURE contentcuration_channelsummary_mark_stale();
+
+CREATE TRIGGER contentcuration_treeresourcesize_channelsummary
+AFTER UPDATE OF resource_size ON contentcuration_treeresourcesize
+FOR EACH ROW
+WHEN (OLD.resource_size IS DISTINCT FROM NEW.resource_size)
+EXECUTE PROCEDURE contentcuration_channelsummary_mark_stale();
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS contentcuration_treeresourcesize_channelsummary ON contentcuration_treeresourcesize;
+DROP TRIGGER IF EXISTS contentcuration_contentnode_channelsummary_update ON contentcuration_contentnode;
+DROP TRIGGER IF EXISTS contentcuration_contentnode_channelsummary_insert_delete ON contentcuration_contentnode;
+DROP FUNCTION IF EXISTS contentcuration_channelsummary_mark_stale();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0131_tree_resource_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelSummary',
+            fields=[
+                ('channel', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='contentcuration.channel')),
+                ('tree_id', models.IntegerField(db_index=True)),
+                ('resource_count', models.IntegerField(default=0)),
+                ('modified', models.DateTimeField(null=True)),
+                ('languages', models.JSONField(default=list)),
+                ('kinds', models.JSONField(default=list)),
+                ('resource_size', models.BigIntegerField(default=0)),
+                ('stale', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=STALE_TRIGGER_SQL,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+    ]
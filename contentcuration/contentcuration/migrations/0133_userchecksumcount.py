@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations
+from django.db import models
+
+
+ACTIVE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_user_tree_is_active(
+    p_user_id integer, p_tree_id integer, p_exclude_channel_id varchar
+) RETURNS boolean AS $$
+    SELECT EXISTS (
+        SELECT 1 FROM contentcuration_channel c
+        INNER JOIN contentcuration_channel_editors e ON e.channel_id = c.id
+        INNER JOIN contentcuration_contentnode r ON r.id = c.main_tree_id
+        WHERE e.user_id = p_user_id AND r.tree_id = p_tree_id AND NOT c.deleted
+        AND (p_exclude_channel_id IS NULL OR c.id <> p_exclude_channel_id)
+    );
+$$ LANGUAGE sql STABLE;
+"""
+
+APPLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_apply_user_checksum_deltas(p_user_ids integer[]) RETURNS void AS $$
+DECLARE
+    delta_user_id integer;
+    size_delta bigint;
+BEGIN
+    -- users are locked in order, so that concurrent calls can't deadlock
+    FOR delta_user_id IN
+        SELECT DISTINCT user_id FROM contentcuration_userchecksumdelta
+        WHERE p_user_ids IS NULL OR user_id = ANY(p_user_ids)
+        ORDER BY user_id
+    LOOP
+        PERFORM pg_advisory_xact_lock(hashtext('contentcuration_userchecksumdelta'), delta_user_id);
+
+        IF NOT EXISTS (SELECT 1 FROM contentcuration_user WHERE id = delta_user_id) THEN
+            DELETE FROM contentcuration_userchecksumdelta WHERE user_id = delta_user_id;
+            CONTINUE;
+        END IF;
+
+        WITH deltas AS (
+            DELETE FROM contentcuration_userchecksumdelta WHERE user_id = delta_user_id
+            RETURNING checksum, file_size, delta
+        ), grouped AS (
+            SELECT checksum, file_size, SUM(delta)::integer AS delta FROM deltas
+            GROUP BY checksum, file_size HAVING SUM(delta) <> 0
+        ), counts AS (
+            INSERT INTO contentcuration_userchecksumcount AS c (user_id, checksum, file_size, count)
+            SELECT delta_user_id, checksum, file_size, delta FROM grouped
+            ON CONFLICT (user_id, checksum, file_size) DO UPDATE SET count = c.count + EXCLUDED.count
+            RETURNING c.checksum, c.file_size, c.count
+        )
+        -- the size of a checksum only counts once per user, when it first appears and last disappears
+        SELECT COALESCE(SUM(
+            CASE
+                WHEN counts.count > 0 AND counts.count - grouped.delta <= 0 THEN counts.file_size
+                WHEN counts.count <= 0 AND counts.count - grouped.delta > 0 THEN -counts.file_size
+                ELSE 0
+            END
+        ), 0) INTO size_delta
+        FROM counts INNER JOIN grouped
+        ON grouped.checksum = counts.checksum AND grouped.file_size = counts.file_size;
+
+        DELETE FROM contentcuration_userchecksumcount WHERE user_id = delta_user_id AND count <= 0;
+
+        IF size_delta <> 0 THEN
+            UPDATE contentcuration_user
+            SET disk_space_used = GREATEST(disk_space_used + size_delta, 0) WHERE id = delta_user_id;
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION contentcuration_queue_user_tree(
+    p_user_id integer, p_tree_id integer, p_sign integer
+) RETURNS void AS $$
+    INSERT INTO contentcuration_userchecksumdelta (user_id, checksum, file_size, delta)
+    SELECT p_user_id, f.checksum, COALESCE(f.file_size, 0), p_sign * COUNT(*)
+    FROM contentcuration_file f INNER JOIN contentcuration_contentnode n ON n.id = f.contentnode_id
+    WHERE n.tree_id = p_tree_id AND f.uploaded_by_id = p_user_id AND f.checksum IS NOT NULL
+    GROUP BY f.checksum, COALESCE(f.file_size, 0);
+$$ LANGUAGE sql;
+"""
+
+FILE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_file_user_checksum_count() RETURNS trigger AS $$
+BEGIN
+    -- changes are queued rather than applied to the user's counts, so that concurrent changes to
+    -- files of the same user don't wait on each other (see contentcuration_apply_user_checksum_deltas)
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.uploaded_by_id IS NOT NULL AND OLD.checksum IS NOT NULL THEN
+        INSERT INTO contentcuration_userchecksumdelta (user_id, checksum, file_size, delta)
+        SELECT OLD.uploaded_by_id, OLD.checksum, COALESCE(OLD.file_size, 0), -1
+        FROM contentcuration_contentnode WHERE id = OLD.contentnode_id
+        AND contentcuration_user_tree_is_active(OLD.uploaded_by_id, tree_id, NULL);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') AND NEW.uploaded_by_id IS NOT NULL AND NEW.checksum IS NOT NULL THEN
+        INSERT INTO contentcuration_userchecksumdelta (user_id, checksum, file_size, delta)
+        SELECT NEW.uploaded_by_id, NEW.checksum, COALESCE(NEW.file_size, 0), 1
+        FROM contentcuration_contentnode WHERE id = NEW.contentnode_id
+        AND contentcuration_user_tree_is_active(NEW.uploaded_by_id, tree_id, NULL);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_file_user_checksum_count_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_file
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_file_user_checksum_count();
+
+CREATE TRIGGER contentcuration_file_user_checksum_count_update
+AFTER UPDATE OF contentnode_id, checksum, file_size, uploaded_by_id ON contentcuration_file
+FOR EACH ROW
+WHEN (
+    OLD.contentnode_id IS DISTINCT FROM NEW.contentnode_id
+    OR OLD.checksum IS DISTINCT FROM NEW.checksum
+    OR OLD.file_size IS DISTINCT FROM NEW.file_size
+    OR OLD.uploaded_by_id IS DISTINCT FROM NEW.uploaded_by_id
+)
+EXECUTE PROCEDURE contentcuration_file_user_checksum_count();
+"""
+
+NODE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_contentnode_user_checksum_count() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO contentcuration_userchecksumdelta (user_id, checksum, file_size, delta)
+    SELECT uploaded_by_id, checksum, COALESCE(file_size, 0), -1
+    FROM contentcuration_file
+    WHERE contentnode_id = NEW.id AND uploaded_by_id IS NOT NULL AND checksum IS NOT NULL
+    AND contentcuration_user_tree_is_active(uploaded_by_id, OLD.tree_id, NULL)
+    UNION ALL
+    SELECT uploaded_by_id, checksum, COALESCE(file_size, 0), 1
+    FROM contentcuration_file
+    WHERE contentnode_id = NEW.id AND uploaded_by_id IS NOT NULL AND checksum IS NOT NULL
+    AND contentcuration_user_tree_is_active(uploaded_by_id, NEW.tree_id, NULL);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_contentnode_user_checksum_count
+AFTER UPDATE OF tree_id ON contentcuration_contentnode
+FOR EACH ROW
+WHEN (OLD.tree_id IS DISTINCT FROM NEW.tree_id)
+EXECUTE PROCEDURE contentcuration_contentnode_user_checksum_count();
+"""
+
+POPULATE_SQL = """
+INSERT INTO contentcuration_userchecksumcount (user_id, checksum, file_size, count)
+SELECT f.uploaded_by_id, f.checksum, COALESCE(f.file_size, 0), COUNT(*)
+FROM contentcuration_file f INNER JOIN contentcuration_contentnode n ON n.id = f.contentnode_id
+INNER JOIN (
+    SELECT DISTINCT e.user_id, r.tree_id FROM contentcuration_channel c
+    INNER JOIN contentcuration_channel_editors e ON e.channel_id = c.id
+    INNER JOIN contentcuration_contentnode r ON r.id = c.main_tree_id
+    WHERE NOT c.deleted
+) a ON a.user_id = f.uploaded_by_id AND a.tree_id = n.tree_id
+WHERE f.checksum IS NOT NULL
+GROUP BY f.uploaded_by_id, f.checksum, COALESCE(f.file_size, 0);
+
+UPDATE contentcuration_user u SET disk_space_used = COALESCE((
+    SELECT SUM(c.file_size) FROM contentcuration_userchecksumcount c WHERE c.user_id = u.id
+), 0);
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS contentcuration_channel_user_checksum_count ON contentcuration_channel;
+DROP TRIGGER IF EXISTS contentcuration_channel_editors_user_checksum_count ON contentcuration_channel_editors;
+DROP TRIGGER IF EXISTS contentcuration_contentnode_user_checksum_count ON contentcuration_contentnode;
+DROP TRIGGER IF EXISTS contentcuration_file_user_checksum_count_update ON contentcuration_file;
+DROP TRIGGER IF EXISTS contentcuration_file_user_checksum_count_insert_delete ON contentcuration_file;
+DROP FUNCTION IF EXISTS contentcuration_channel_user_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_channel_editors_user_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_contentnode_user_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_file_user_checksum_count();
+DROP FUNCTION IF EXISTS contentcuration_queue_user_tree(integer, integer, integer);
+DROP FUNCTION IF EXISTS contentcuration_apply_user_checksum_deltas(integer[]);
+DROP FUNCTION IF EXISTS contentcuration_user_tree_is_active(integer, integer, varchar);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0132_channelsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserChecksumCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checksum', models.CharField(max_length=400)),
+                ('file_size', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checksum_counts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'checksum', 'file_size')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UserChecksumDelta',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('user_id', models.IntegerField(db_index=True)),
+                ('checksum', models.CharField(max_length=400)),
+                ('file_size', models.BigIntegerField()),
+                ('delta', models.IntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=ACTIVE_FUNCTION_SQL + APPLY_FUNCTION_SQL + FILE_TRIGGER_SQL + NODE_TRIGGER_SQL + PERMISSION_TRIGGER_SQL,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+        migrations.RunSQL(
+            sql=POPULATE_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
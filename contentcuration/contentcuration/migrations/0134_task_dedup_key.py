@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0133_userchecksumcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(status__in=('QUEUED', 'PENDING', 'RECEIVED', 'STARTED')),
+                fields=('dedup_key',),
+                name='task_dedup_key_active',
+            ),
+        ),
+    ]
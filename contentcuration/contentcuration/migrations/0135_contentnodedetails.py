@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import django.db.models.deletion
+from django.db import migrations
+from django.db import models
+
+
+MARK_STALE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_contentnodedetails_mark_stale(
+    p_tree_id integer, p_contentnode_id varchar
+) RETURNS void AS $$
+BEGIN
+    IF p_tree_id IS NULL OR p_contentnode_id IS NULL THEN
+        RETURN;
+    END IF;
+    -- most trees never have their details computed, so skip walking up those
+    IF NOT EXISTS (SELECT 1 FROM contentcuration_contentnodedetails WHERE tree_id = p_tree_id) THEN
+        RETURN;
+    END IF;
+
+    WITH RECURSIVE ancestors(id, parent_id) AS (
+        SELECT id, parent_id FROM contentcuration_contentnode WHERE id = p_contentnode_id
+        UNION ALL
+        SELECT n.id, n.parent_id FROM contentcuration_contentnode n
+        INNER JOIN ancestors a ON n.id = a.parent_id
+    )
+    UPDATE contentcuration_contentnodedetails d SET stale = true
+    FROM ancestors a WHERE d.contentnode_id = a.id AND NOT d.stale;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+NODE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_contentnode_details_mark_stale() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.tree_id IS DISTINCT FROM NEW.tree_id) THEN
+        DELETE FROM contentcuration_contentnodedetails WHERE contentnode_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM contentcuration_contentnodedetails_mark_stale(OLD.tree_id, OLD.parent_id);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        PERFORM contentcuration_contentnodedetails_mark_stale(NEW.tree_id, NEW.parent_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_contentnode_details_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_contentnode
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_contentnode_details_mark_stale();
+
+CREATE TRIGGER contentcuration_contentnode_details_update
+AFTER UPDATE OF
+    parent_id, tree_id, kind_id, title, description, thumbnail_encoding, author, aggregator,
+    provider, copyright_holder, license_id, language_id, role_visibility, original_channel_id, complete
+ON contentcuration_contentnode
+FOR EACH ROW
+WHEN (
+    OLD.parent_id IS DISTINCT FROM NEW.parent_id
+    OR OLD.tree_id IS DISTINCT FROM NEW.tree_id
+    OR OLD.kind_id IS DISTINCT FROM NEW.kind_id
+    OR OLD.title IS DISTINCT FROM NEW.title
+    OR OLD.description IS DISTINCT FROM NEW.description
+    OR OLD.thumbnail_encoding IS DISTINCT FROM NEW.thumbnail_encoding
+    OR OLD.author IS DISTINCT FROM NEW.author
+    OR OLD.aggregator IS DISTINCT FROM NEW.aggregator
+    OR OLD.provider IS DISTINCT FROM NEW.provider
+    OR OLD.copyright_holder IS DISTINCT FROM NEW.copyright_holder
+    OR OLD.license_id IS DISTINCT FROM NEW.license_id
+    OR OLD.language_id IS DISTINCT FROM NEW.language_id
+    OR OLD.role_visibility IS DISTINCT FROM NEW.role_visibility
+    OR OLD.original_channel_id IS DISTINCT FROM NEW.original_channel_id
+    OR OLD.complete IS DISTINCT FROM NEW.complete
+)
+EXECUTE PROCEDURE contentcuration_contentnode_details_mark_stale();
+"""
+
+RELATED_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION contentcuration_contentnode_related_details_mark_stale() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.contentnode_id IS NOT NULL THEN
+        PERFORM contentcuration_contentnodedetails_mark_stale(n.tree_id, n.id)
+        FROM contentcuration_contentnode n WHERE n.id = OLD.contentnode_id;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') AND NEW.contentnode_id IS NOT NULL THEN
+        PERFORM contentcuration_contentnodedetails_mark_stale(n.tree_id, n.id)
+        FROM contentcuration_contentnode n WHERE n.id = NEW.contentnode_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contentcuration_file_details_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_file
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_contentnode_related_details_mark_stale();
+
+CREATE TRIGGER contentcuration_file_details_update
+AFTER UPDATE OF contentnode_id, checksum, file_size, language_id, preset_id ON contentcuration_file
+FOR EACH ROW
+WHEN (
+    OLD.contentnode_id IS DISTINCT FROM NEW.contentnode_id
+    OR OLD.checksum IS DISTINCT FROM NEW.checksum
+    OR OLD.file_size IS DISTINCT FROM NEW.file_size
+    OR OLD.language_id IS DISTINCT FROM NEW.language_id
+    OR OLD.preset_id IS DISTINCT FROM NEW.preset_id
+)
+EXECUTE PROCEDURE contentcuration_contentnode_related_details_mark_stale();
+
+CREATE TRIGGER contentcuration_contentnode_tags_details
+AFTER INSERT OR UPDATE OR DELETE ON contentcuration_contentnode_tags
+FOR EACH ROW EXECUTE PROCEDURE contentcuration_contentnode_related_details_mark_stale();
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS contentcuration_contentnode_tags_details ON contentcuration_contentnode_tags;
+DROP TRIGGER IF EXISTS contentcuration_file_details_update ON contentcuration_file;
+DROP TRIGGER IF EXISTS contentcuration_file_details_insert_delete ON contentcuration_file;
+DROP TRIGGER IF EXISTS contentcuration_contentnode_details_update ON contentcuration_contentnode;
+DROP TRIGGER IF EXISTS contentcuration_contentnode_details_insert_delete ON contentcuration_contentnode;
+DROP FUNCTION IF EXISTS contentcuration_contentnode_related_details_mark_stale();
+DROP FUNCTION IF EXISTS contentcuration_contentnode_details_mark_stale();
+DROP FUNCTION IF EXISTS contentcuration_contentnodedetails_mark_stale(integer, varchar);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0134_task_dedup_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentNodeDetails',
+            fields=[
+                ('contentnode', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='details', serialize=False, to='contentcuration.contentnode')),
+                ('tree_id', models.IntegerField(db_index=True)),
+                ('aggregates', models.JSONField(default=dict)),
+                ('data', models.TextField(blank=True, null=True)),
+                ('etag', models.CharField(blank=True, max_length=32, null=True)),
+                ('stale', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=MARK_STALE_FUNCTION_SQL + NODE_TRIGGER_SQL + RELATED_TRIGGER_SQL,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+    ]
@@ -5,9 +5,8 @@ import logging
 import os
 import urllib.parse
 import uuid
-from datetime import datetime
 
-import pytz
+from celery import states
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.base_user import BaseUserManager
@@ -23,8 +22,10 @@ from django.core.mail import send_mail
 from django.db import connection
 from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
 from django.db.models import Count
 from django.db.models import Exists
+from django.db.models import F
 from django.db.models import Index
 from django.db.models import IntegerField
 from django.db.models import JSONField
@@ -35,14 +36,12 @@ from django.db.models import Subquery
 from django.db.models import Sum
 from django.db.models import UUIDField as DjangoUUIDField
 from django.db.models import Value
-from django.db.models.expressions import RawSQL
 from django.db.models.expressions import ExpressionList
 from django.db.models.functions import Cast
 from django.db.models.functions import Lower
 from django.db.models.indexes import IndexExpression
 from django.db.models.query_utils import DeferredAttribute
 from django.db.models.sql import Query
-from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext as _
 from django_cte import With
@@ -186,11 +185,6 @@ class User(AbstractBaseUser, PermissionsMixin):
     policies = JSONField(default=dict, null=True)
     feature_flags = JSONField(default=dict, null=True)
 
-    _field_updates = FieldTracker(fields=[
-        # Field to watch for changes
-        "disk_space",
-    ])
-
     objects = UserManager()
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name']
@@ -225,25 +219,25 @@ class User(AbstractBaseUser, PermissionsMixin):
         return Channel.filter_edit_queryset(Channel.objects.all(), self).filter(pk=channel_id).exists()
 
     def check_space(self, size, checksum):
-        active_files = self.get_user_active_files()
-        if active_files.filter(checksum=checksum).exists():
+        UserChecksumCount.apply_deltas([self.pk])
+        if self.checksum_counts.filter(checksum=checksum).exists():
             return True
 
-        space = self.get_available_space(active_files=active_files)
+        space = self.get_available_space()
         if space < size:
             raise PermissionDenied(_("Not enough space. Check your storage under Settings page."))
 
     def check_channel_space(self, channel):
-        active_files = self.get_user_active_files()
+        UserChecksumCount.apply_deltas([self.pk])
         staging_tree_id = channel.staging_tree.tree_id
         channel_files = self.files\
                             .filter(contentnode__tree_id=staging_tree_id)\
                             .values('checksum')\
                             .distinct()\
-                            .exclude(checksum__in=active_files.values_list('checksum', flat=True))
+                            .exclude(checksum__in=self.checksum_counts.values_list('checksum', flat=True))
         staged_size = float(channel_files.aggregate(used=Sum('file_size'))['used'] or 0)
 
-        if self.get_available_space(active_files=active_files) < (staged_size):
+        if self.get_available_space() < (staged_size):
             raise PermissionDenied(_('Out of storage! Request more space under Settings > Storage.'))
 
     def check_staged_space(self, size, checksum):
@@ -270,13 +264,21 @@ class User(AbstractBaseUser, PermissionsMixin):
             .values('checksum').distinct()
 
     def get_space_used(self, active_files=None):
-        active_files = active_files or self.get_user_active_files()
+        if active_files is None:
+            # disk_space_used is kept up to date from the deltas queued by the UserChecksumCount
+            # triggers, so apply them and read the current value rather than the one this
+            # instance was loaded with
+            UserChecksumCount.apply_deltas([self.pk])
+            space_used = User.objects.filter(pk=self.pk).values_list('disk_space_used', flat=True).first()
+            return float(space_used or 0)
         files = active_files.aggregate(total_used=Sum('file_size'))
         return float(files['total_used'] or 0)
 
     def set_space_used(self):
-        self.disk_space_used = self.get_space_used()
-        self.save()
+        """
+        Recounts the storage used by the user from their files, in case it has drifted
+        """
+        self.disk_space_used = UserChecksumCount.rebuild(self.pk)
         return self.disk_space_used
 
     def get_space_used_by_kind(self):
@@ -321,12 +323,15 @@ class User(AbstractBaseUser, PermissionsMixin):
         return token.key
 
     def save(self, *args, **kwargs):
-        from contentcuration.utils.user import calculate_user_storage
+        if not self._state.adding and not args and kwargs.get("update_fields") is None:
+            # disk_space_used is maintained by database triggers, so don't overwrite it
+            # with the value this instance was loaded with
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "disk_space_used"
+            ]
         super(User, self).save(*args, **kwargs)
 
-        if 'disk_space' in self._field_updates.changed():
-            calculate_user_storage(self.pk)
-
         changed = False
 
         if not self.content_defaults:
@@ -576,6 +581,329 @@ class ChannelResourceSize(models.Model):
         db_table = "contentcuration_channel_resource_sizes"
 
 
+class TreeChecksumCount(models.Model):
+    """
+    Number of files with the same checksum and size on the complete nodes of a tree.
+
+    Database triggers on the file and contentnode tables queue a TreeChecksumDelta for every change
+    (see migration 0131), so that adding, removing, moving and copying content keeps them up to date
+    however the change is made.
+    """
+    tree_id = models.IntegerField()
+    checksum = models.CharField(max_length=400)
+    file_size = models.BigIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['tree_id', 'checksum', 'file_size']
+
+
+class TreeChecksumDelta(models.Model):
+    """
+    A queued change to a TreeChecksumCount. The triggers only append these, rather than adjusting
+    the counts and size of the tree themselves, so that concurrent changes to files of the same tree
+    don't wait on each other for its size row. They're applied together, per tree, by
+    TreeResourceSize.apply_deltas.
+    """
+    id = models.BigAutoField(primary_key=True)
+    tree_id = models.IntegerField(db_index=True)
+    checksum = models.CharField(max_length=400)
+    file_size = models.BigIntegerField()
+    delta = models.IntegerField()
+
+
+class TreeResourceSize(models.Model):
+    """
+    Total size of the distinct files on the complete nodes of a tree, kept in step with
+    TreeChecksumCount as its deltas are applied.
+    """
+    tree_id = models.IntegerField(primary_key=True)
+    resource_size = models.BigIntegerField(default=0)
+
+    checksum_table = "contentcuration_treechecksumcount"
+    delta_table = "contentcuration_treechecksumdelta"
+    size_table = "contentcuration_treeresourcesize"
+    file_table = "contentcuration_file"
+    node_table = "contentcuration_contentnode"
+
+    @classmethod
+    def apply_deltas(cls, tree_ids=None):
+        """
+        Applies the queued checksum deltas of the given trees, or of every tree when None, to their
+        checksum counts and sizes
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT contentcuration_apply_tree_checksum_deltas(%s::integer[])",
+                [list(tree_ids) if tree_ids is not None else None],
+            )
+
+    @classmethod
+    def get_size(cls, tree_id):
+        cls.apply_deltas([tree_id])
+        size = cls.objects.filter(tree_id=tree_id).values_list("resource_size", flat=True).first()
+        return size or 0
+
+    @classmethod
+    def clear(cls, tree_id):
+        """
+        Removes the counts and size of a tree that no longer exists, along with its queued deltas
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", [cls.delta_table, tree_id])
+            for table in (cls.delta_table, cls.checksum_table, cls.size_table):
+                cursor.execute('DELETE FROM "{table}" WHERE tree_id = %s'.format(table=table), [tree_id])
+
+    @classmethod
+    def rebuild(cls, tree_id):
+        """
+        Recounts the checksums of a tree from its files, in case the aggregate has drifted
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            # keep the tree's deltas from being applied while it's recounted
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", [cls.delta_table, tree_id])
+            cursor.execute('DELETE FROM "{checksum}" WHERE tree_id = %s'.format(checksum=cls.checksum_table), [tree_id])
+            # the deltas are dropped in the same statement as the files are counted, so that they
+            # share a snapshot, and only the deltas of changes the count doesn't see are kept
+            cursor.execute(
+                'WITH dropped AS (DELETE FROM "{delta}" WHERE tree_id = %s) '
+                'INSERT INTO "{checksum}" (tree_id, checksum, file_size, count) '
+                'SELECT n.tree_id, f.checksum, COALESCE(f.file_size, 0), COUNT(*) '
+                'FROM "{file_table}" f INNER JOIN "{node}" n ON n.id = f.contentnode_id '
+                'WHERE n.tree_id = %s AND n.complete AND f.checksum IS NOT NULL '
+                'GROUP BY n.tree_id, f.checksum, COALESCE(f.file_size, 0)'.format(
+                    delta=cls.delta_table, checksum=cls.checksum_table, file_table=cls.file_table, node=cls.node_table
+                ),
+                [tree_id, tree_id],
+            )
+            cursor.execute(
+                'INSERT INTO "{size}" (tree_id, resource_size) '
+                'SELECT %s, COALESCE(SUM(file_size), 0) FROM "{checksum}" WHERE tree_id = %s '
+                'ON CONFLICT (tree_id) DO UPDATE SET resource_size = EXCLUDED.resource_size'.format(
+                    size=cls.size_table, checksum=cls.checksum_table
+                ),
+                [tree_id, tree_id],
+            )
+        return cls.get_size(tree_id)
+
+
+class UserChecksumCount(models.Model):
+    """
+    Number of files with the same checksum and size that a user has uploaded to the main trees
+    of the channels they can edit, and which count towards their storage.
+
+    Rows, and `User.disk_space_used` as their total size, are maintained from the UserChecksumDelta
+    queued by database triggers on the file, contentnode, channel and channel editors tables (see
+    migration 0133), so that uploads, moves and permission changes keep them up to date however
+    the change is made.
+    """
+    user = models.ForeignKey(User, related_name="checksum_counts", on_delete=models.CASCADE)
+    checksum = models.CharField(max_length=400)
+    file_size = models.BigIntegerField()
+    count = models.IntegerField(default=0)
+
+    checksum_table = "contentcuration_userchecksumcount"
+    delta_table = "contentcuration_userchecksumdelta"
+    user_table = "contentcuration_user"
+    file_table = "contentcuration_file"
+    node_table = "contentcuration_contentnode"
+    channel_table = "contentcuration_channel"
+    editors_table = "contentcuration_channel_editors"
+
+    class Meta:
+        unique_together = ['user', 'checksum', 'file_size']
+
+    @classmethod
+    def apply_deltas(cls, user_ids=None):
+        """
+        Applies the queued checksum deltas of the given users, or of every user when None, to their
+        checksum counts and storage used
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT contentcuration_apply_user_checksum_deltas(%s::integer[])",
+                [list(user_ids) if user_ids is not None else None],
+            )
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """
+        Recounts the checksums of a user from their files, logging a warning if the ledger has drifted
+
+        :return: The storage used by the user
+        """
+        cls.apply_deltas([user_id])
+        with transaction.atomic(), connection.cursor() as cursor:
+            # keep the user's deltas from being applied while they're recounted
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", [cls.delta_table, user_id])
+            cursor.execute(
+                'SELECT disk_space_used FROM "{user}" WHERE id = %s FOR UPDATE'.format(user=cls.user_table), [user_id]
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return 0.0
+            space_used = float(row[0])
+            cursor.execute('DELETE FROM "{checksum}" WHERE user_id = %s'.format(checksum=cls.checksum_table), [user_id])
+            # the deltas are dropped in the same statement as the files are counted, so that they
+            # share a snapshot, and only the deltas of changes the count doesn't see are kept
+            cursor.execute(
+                'WITH dropped AS (DELETE FROM "{delta}" WHERE user_id = %s) '
+                'INSERT INTO "{checksum}" (user_id, checksum, file_size, count) '
+                'SELECT f.uploaded_by_id, f.checksum, COALESCE(f.file_size, 0), COUNT(*) '
+                'FROM "{file_table}" f INNER JOIN "{node}" n ON n.id = f.contentnode_id '
+                'WHERE f.uploaded_by_id = %s AND f.checksum IS NOT NULL AND n.tree_id IN ('
+                'SELECT r.tree_id FROM "{channel}" c '
+                'INNER JOIN "{editors}" e ON e.channel_id = c.id '
+                'INNER JOIN "{node}" r ON r.id = c.main_tree_id '
+                'WHERE e.user_id = %s AND NOT c.deleted'
+                ') GROUP BY f.uploaded_by_id, f.checksum, COALESCE(f.file_size, 0)'.format(
+                    delta=cls.delta_table,
+                    checksum=cls.checksum_table,
+                    file_table=cls.file_table,
+                    node=cls.node_table,
+                    channel=cls.channel_table,
+                    editors=cls.editors_table,
+                ),
+                [user_id, user_id, user_id],
+            )
+            cursor.execute(
+                'UPDATE "{user}" SET disk_space_used = ('
+                'SELECT COALESCE(SUM(file_size), 0) FROM "{checksum}" WHERE user_id = %s'
+                ') WHERE id = %s RETURNING disk_space_used'.format(user=cls.user_table, checksum=cls.checksum_table),
+                [user_id, user_id],
+            )
+            new_space_used = float(cursor.fetchone()[0])
+        if new_space_used != space_used:
+            logging.warning(
+                "Storage used by user {} had drifted from {} to {}".format(user_id, space_used, new_space_used)
+            )
+        return new_space_used
+
+
+class UserChecksumDelta(models.Model):
+    """
+    A queued change to a UserChecksumCount, appended by the triggers so that concurrent changes to a
+    user's files don't wait on each other for their user row. They're applied together, per user, by
+    UserChecksumCount.apply_deltas.
+    """
+    id = models.BigAutoField(primary_key=True)
+    user_id = models.IntegerField(db_index=True)
+    checksum = models.CharField(max_length=400)
+    file_size = models.BigIntegerField()
+    delta = models.IntegerField()
+
+
+class ChannelSummary(models.Model):
+    """
+    Summary of the main tree of a channel for channel listings, so that they don't have to
+    aggregate over every node of every channel listed.
+
+    A trigger on the contentnode table marks the summary of a tree stale whenever one of its
+    nodes is added, changed or removed (see migration 0132). Listings serve the stored summaries,
+    and queue a refresh of the stale ones (see queue_channel_summaries_refresh in tasks.py), and
+    publishing refreshes the summary of the published channel.
+    """
+    channel = models.OneToOneField("Channel", primary_key=True, related_name="summary", on_delete=models.CASCADE)
+    tree_id = models.IntegerField(db_index=True)
+    resource_count = models.IntegerField(default=0)
+    modified = models.DateTimeField(null=True)
+    languages = JSONField(default=list)
+    kinds = JSONField(default=list)
+    resource_size = models.BigIntegerField(default=0)
+    stale = models.BooleanField(default=True)
+
+    @classmethod
+    def refresh(cls, channel_ids):
+        """
+        Recomputes the summaries of the given channels from their main trees
+        """
+        from django.contrib.postgres.aggregates import ArrayAgg
+
+        channel_trees = dict(
+            Channel.objects.filter(pk__in=channel_ids, main_tree__isnull=False).values_list("id", "main_tree__tree_id")
+        )
+        if not channel_trees:
+            return
+        # Apply the trees' queued checksum deltas first, as changing their sizes marks them stale
+        TreeResourceSize.apply_deltas(set(channel_trees.values()))
+        # Clear the flag before reading the trees, so that any edit made while reading marks them stale again
+        existing = set(
+            cls.objects.filter(channel_id__in=channel_trees.keys()).values_list("channel_id", flat=True)
+        )
+        cls.objects.filter(channel_id__in=existing).update(stale=False)
+
+        tree_ids = set(channel_trees.values())
+        not_topic = ~Q(kind_id=content_kinds.TOPIC)
+        tree_summaries = {
+            summary.pop("tree_id"): summary
+            for summary in ContentNode.objects.filter(tree_id__in=tree_ids)
+            .values("tree_id")
+            .annotate(
+                resource_count=Count("content_id", filter=not_topic, distinct=True),
+                modified=Max("modified"),
+                languages=ArrayAgg("language_id", filter=Q(language_id__isnull=False), distinct=True),
+                kinds=ArrayAgg("kind_id", filter=not_topic, distinct=True),
+            )
+            .order_by()
+        }
+        tree_sizes = dict(TreeResourceSize.objects.filter(tree_id__in=tree_ids).values_list("tree_id", "resource_size"))
+
+        for channel_id, tree_id in channel_trees.items():
+            summary = tree_summaries.get(tree_id, {})
+            defaults = {
+                "tree_id": tree_id,
+                "resource_count": summary.get("resource_count") or 0,
+                "modified": summary.get("modified"),
+                "languages": sorted(summary.get("languages") or []),
+                "kinds": sorted(summary.get("kinds") or []),
+                "resource_size": tree_sizes.get(tree_id) or 0,
+            }
+            if channel_id not in existing:
+                # new summaries weren't there to have their flag cleared above
+                defaults["stale"] = False
+            cls.objects.update_or_create(channel_id=channel_id, defaults=defaults)
+
+    @classmethod
+    def get_stale_ids(cls, channel_queryset):
+        """
+        Returns the ids of the channels in the queryset whose summaries are missing, stale, or were
+        computed for a tree that is no longer their main tree
+        """
+        return list(
+            Channel.objects.filter(pk__in=channel_queryset.values("pk"), main_tree__isnull=False)
+            .filter(
+                Q(summary__isnull=True)
+                | Q(summary__stale=True)
+                | ~Q(summary__tree_id=F("main_tree__tree_id"))
+            )
+            .values_list("pk", flat=True)
+        )
+
+
+class ContentNodeDetails(models.Model):
+    """
+    Details of a node and its descendants, for the channel look-inside previews.
+
+    `aggregates` holds partial aggregates of the node's subtree, merged upwards from those of its
+    child topics, so that a refresh only recomputes the topics whose subtrees have changed. Triggers
+    on the contentnode, file and tag tables mark the details of every ancestor of a changed node
+    stale (see migration 0135). `data` is the serialized details served to previews, with `etag`
+    identifying its contents.
+    """
+    contentnode = models.OneToOneField(
+        "ContentNode",
+        primary_key=True,
+        related_name="details",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+    tree_id = models.IntegerField(db_index=True)
+    aggregates = JSONField(default=dict)
+    data = models.TextField(null=True, blank=True)
+    etag = models.CharField(max_length=32, null=True, blank=True)
+    stale = models.BooleanField(default=True)
+
+
 class SecretToken(models.Model):
     """Tokens for channels"""
     token = models.CharField(max_length=100, unique=True)
@@ -817,23 +1145,8 @@ class Channel(models.Model):
     def get_all_channels(cls):
         return cls.objects.select_related('main_tree').prefetch_related('editors', 'viewers').distinct()
 
-    def resource_size_key(self):
-        return "{}_resource_size".format(self.pk)
-
-    # Might be good to display resource size, but need to improve query time first
-
     def get_resource_size(self):
-        cached_data = cache.get(self.resource_size_key())
-        if cached_data:
-            return cached_data
-        tree_id = self.main_tree.tree_id
-        files = File.objects.select_related('contentnode', 'assessment_item')\
-            .filter(contentnode__tree_id=tree_id)\
-            .values('checksum', 'file_size')\
-            .distinct()\
-            .aggregate(resource_size=Sum('file_size'))
-        cache.set(self.resource_size_key(), files['resource_size'] or 0, None)
-        return files['resource_size'] or 0
+        return TreeResourceSize.get_size(self.main_tree.tree_id)
 
     def on_create(self):
         record_channel_stats(self, None)
@@ -869,7 +1182,6 @@ class Channel(models.Model):
             delete_public_channel_cache_keys()
 
     def on_update(self):
-        from contentcuration.utils.user import calculate_user_storage
         original_values = self._field_updates.changed()
         record_channel_stats(self, original_values)
 
@@ -888,11 +1200,6 @@ class Channel(models.Model):
             filename, ext = os.path.splitext(original_values["thumbnail"])
             delete_empty_file_reference(filename, ext[1:])
 
-        # Refresh storage for all editors on the channel
-        if "deleted" in original_values:
-            for editor in self.editors.all():
-                calculate_user_storage(editor.pk)
-
         # Delete db if channel has been deleted and mark as unpublished
         if "deleted" in original_values and not original_values["deleted"]:
             self.pending_editors.all().delete()
@@ -1277,38 +1584,74 @@ class ContentNode(MPTTModel, models.Model):
     def get_tree_data(self, levels=float('inf')):
         """
         Returns `levels`-deep tree information starting at current node.
+        The subtree is read in one query, and the assessment item counts and file sizes
+        are each read in one grouped query, however large the tree is.
         Args:
           levels (int): depth of tree hierarchy to return
         Returns:
           tree (dict): starting with self, with children list containing either
                        the just the children's `node_id`s or full recusive tree.
         """
-        if self.kind_id == content_kinds.TOPIC:
-            node_data = {
-                "title": self.title,
-                "kind": self.kind_id,
-                "node_id": self.node_id,
-                "studio_id": self.id,
-            }
-            children = self.children.all()
-            if levels > 0:
-                node_data["children"] = [c.get_tree_data(levels=levels - 1) for c in children]
-            return node_data
-        if self.kind_id == content_kinds.EXERCISE:
-            return {
-                "title": self.title,
-                "kind": self.kind_id,
-                "count": self.assessment_items.count(),
-                "node_id": self.node_id,
-                "studio_id": self.id,
-            }
-        return {
-            "title": self.title,
-            "kind": self.kind_id,
-            "file_size": self.files.values('file_size').aggregate(size=Sum('file_size'))['size'],
-            "node_id": self.node_id,
-            "studio_id": self.id,
-        }
+        descendants = ContentNode.objects.filter(
+            tree_id=self.tree_id, lft__gte=self.lft, rght__lte=self.rght
+        )
+        if levels != float('inf'):
+            descendants = descendants.filter(level__lte=self.level + levels)
+
+        assessment_counts = dict(
+            AssessmentItem.objects.filter(
+                contentnode_id__in=descendants.filter(kind_id=content_kinds.EXERCISE).values("id")
+            )
+            .values_list("contentnode_id")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        file_sizes = dict(
+            File.objects.filter(
+                contentnode_id__in=descendants.exclude(
+                    kind_id__in=[content_kinds.TOPIC, content_kinds.EXERCISE]
+                ).values("id")
+            )
+            .values_list("contentnode_id")
+            .annotate(size=Sum("file_size"))
+            .order_by()
+        )
+
+        tree_data = {}
+        nodes = descendants.values(
+            "id", "parent_id", "title", "kind_id", "node_id", "level"
+        ).order_by("lft")
+        for node in nodes.iterator():
+            if node["kind_id"] == content_kinds.TOPIC:
+                node_data = {
+                    "title": node["title"],
+                    "kind": node["kind_id"],
+                    "node_id": node["node_id"],
+                    "studio_id": node["id"],
+                }
+                if node["level"] - self.level < levels:
+                    node_data["children"] = []
+            elif node["kind_id"] == content_kinds.EXERCISE:
+                node_data = {
+                    "title": node["title"],
+                    "kind": node["kind_id"],
+                    "count": assessment_counts.get(node["id"], 0),
+                    "node_id": node["node_id"],
+                    "studio_id": node["id"],
+                }
+            else:
+                node_data = {
+                    "title": node["title"],
+                    "kind": node["kind_id"],
+                    "file_size": file_sizes.get(node["id"]),
+                    "node_id": node["node_id"],
+                    "studio_id": node["id"],
+                }
+            tree_data[node["id"]] = node_data
+            # ordering by lft means parents are always read before their children
+            if node["id"] != self.id:
+                tree_data[node["parent_id"]]["children"].append(node_data)
+        return tree_data[self.id]
 
     def get_original_node(self):
         original_node = self.original_node or self
@@ -1394,262 +1737,10 @@ class ContentNode(MPTTModel, models.Model):
 
         :return: A dictionary with detailed statistics and information about the node.
         """
-        from contentcuration.viewsets.common import SQArrayAgg
-        from contentcuration.viewsets.common import SQCount
-        from contentcuration.viewsets.common import SQRelatedArrayAgg
-        from contentcuration.viewsets.common import SQSum
-
-        node = ContentNode.objects.filter(pk=self.id).order_by()
-
-        descendants = (
-            self.get_descendants()
-            .prefetch_related("children", "files", "tags")
-            .select_related("license", "language")
-            .values("id")
-        )
+        from contentcuration.utils.node_details import refresh_node_details
 
-        if channel_id:
-            channel = Channel.objects.filter(id=channel_id)[0]
-        else:
-            channel = self.get_channel()
-
-        if not descendants.exists():
-            data = {
-                "last_update": pytz.utc.localize(datetime.now()).strftime(
-                    settings.DATE_TIME_FORMAT
-                ),
-                "created": self.created.strftime(settings.DATE_TIME_FORMAT),
-                "resource_count": 0,
-                "resource_size": 0,
-                "includes": {"coach_content": 0, "exercises": 0},
-                "kind_count": [],
-                "languages": "",
-                "accessible_languages": "",
-                "licenses": "",
-                "tags": [],
-                "copyright_holders": "",
-                "authors": "",
-                "aggregators": "",
-                "providers": "",
-                "sample_pathway": [],
-                "original_channels": [],
-                "sample_nodes": [],
-            }
-
-            # Set cache with latest data
-            cache.set("details_{}".format(self.node_id), json.dumps(data), None)
-            return data
-
-        # Get resources
-        resources = descendants.exclude(kind=content_kinds.TOPIC).order_by()
-        nodes = With(
-            File.objects.filter(contentnode_id__in=Subquery(resources.values("id")))
-            .values("checksum", "file_size")
-            .order_by(),
-            name="nodes",
-        )
-        file_query = (
-            nodes.queryset().with_cte(nodes).values("checksum", "file_size").distinct()
-        )
-        l_nodes = With(
-            File.objects.filter(contentnode_id__in=Subquery(resources.values("id")))
-            .values("language_id", "preset_id")
-            .order_by(),
-            name="l_nodes",
-        )
-        accessible_languages_query = (
-            l_nodes.queryset()
-            .filter(preset_id=format_presets.VIDEO_SUBTITLE)
-            .with_cte(l_nodes)
-            .values("language__native_name")
-            .distinct()
-        )
-
-        tags_query = str(
-            ContentTag.objects.filter(
-                tagged_content__pk__in=descendants.values_list("pk", flat=True)
-            )
-            .values("tag_name")
-            .annotate(count=Count("tag_name"))
-            .query
-        ).replace("topic", "'topic'")
-        kind_count_query = str(
-            resources.values("kind_id").annotate(count=Count("kind_id")).query
-        ).replace("topic", "'topic'")
-
-        node = node.annotate(
-            resource_count=SQCount(resources, field="id"),
-            resource_size=SQSum(file_query, field="file_size"),
-            copyright_holders=SQArrayAgg(
-                resources.distinct("copyright_holder").order_by("copyright_holder"),
-                field="copyright_holder",
-            ),
-            authors=SQArrayAgg(
-                resources.distinct("author").order_by("author"), field="author"
-            ),
-            aggregators=SQArrayAgg(
-                resources.distinct("aggregator").order_by("aggregator"),
-                field="aggregator",
-            ),
-            providers=SQArrayAgg(
-                resources.distinct("provider").order_by("provider"), field="provider"
-            ),
-            languages=SQRelatedArrayAgg(
-                descendants.exclude(language=None)
-                .distinct("language__native_name")
-                .order_by(),
-                field="language__native_name",
-                fieldname="native_name",
-            ),
-            accessible_languages=SQRelatedArrayAgg(
-                accessible_languages_query,
-                field="language__native_name",
-                fieldname="native_name",
-            ),
-            licenses=SQRelatedArrayAgg(
-                resources.exclude(license=None)
-                .distinct("license__license_name")
-                .order_by("license__license_name"),
-                field="license__license_name",
-                fieldname="license_name",
-            ),
-            kind_count=RawSQL(
-                "SELECT json_agg(row_to_json (x)) FROM ({}) as x".format(
-                    kind_count_query
-                ),
-                (),
-            ),
-            tags_list=RawSQL(
-                "SELECT json_agg(row_to_json (x)) FROM ({}) as x".format(tags_query), ()
-            ),
-            coach_content=SQCount(
-                resources.filter(role_visibility=roles.COACH), field="id"
-            ),
-            exercises=SQCount(
-                resources.filter(kind_id=content_kinds.EXERCISE), field="id"
-            ),
-        )
-
-        # Get sample pathway by getting longest path
-        # Using resources.aggregate adds a lot of time, use values that have already been fetched
-        max_level = max(
-            resources.values_list("level", flat=True).order_by().distinct() or [0]
-        )
-        m_nodes = With(
-            resources.values("id", "level", "tree_id", "lft").order_by(),
-            name="m_nodes",
-        )
-        deepest_node_record = (
-            m_nodes.queryset()
-            .with_cte(m_nodes)
-            .filter(level=max_level)
-            .values("id")
-            .order_by("tree_id", "lft")
-            .first()
-        )
-        if deepest_node_record:
-            deepest_node = ContentNode.objects.get(pk=deepest_node_record["id"])
-        pathway = (
-            list(
-                deepest_node.get_ancestors()
-                .order_by()
-                .exclude(parent=None)
-                .values("title", "node_id", "kind_id")
-                .order_by()
-            )
-            if deepest_node_record
-            else []
-        )
-        sample_nodes = (
-            [
-                {
-                    "node_id": n.node_id,
-                    "title": n.title,
-                    "description": n.description,
-                    "thumbnail": n.get_thumbnail(),
-                    "kind": n.kind_id,
-                }
-                for n in deepest_node.get_siblings(include_self=True)[0:4]
-            ]
-            if deepest_node_record
-            else []
-        )
-
-        # Get list of channels nodes were originally imported from (omitting the current channel)
-        channel_id = channel and channel.id
-        originals = (
-            resources.values("original_channel_id")
-            .annotate(count=Count("original_channel_id"))
-            .order_by("original_channel_id")
-        )
-        originals = {c["original_channel_id"]: c["count"] for c in originals}
-        original_channels = (
-            Channel.objects.exclude(pk=channel_id)
-            .filter(pk__in=originals.keys(), deleted=False)
-            .order_by()
-        )
-        original_channels = [
-            {
-                "id": c.id,
-                "name": "{}{}".format(
-                    c.name, _(" (Original)") if channel_id == c.id else ""
-                ),
-                "thumbnail": c.get_thumbnail(),
-                "count": originals[c.id],
-            }
-            for c in original_channels
-        ]
-
-        node = (
-            node.order_by()
-            .values(
-                "id",
-                "resource_count",
-                "resource_size",
-                "copyright_holders",
-                "authors",
-                "aggregators",
-                "providers",
-                "languages",
-                "accessible_languages",
-                "coach_content",
-                "licenses",
-                "tags_list",
-                "kind_count",
-                "exercises",
-            )
-            .first()
-        )
-        for_educators = {
-            "coach_content": node["coach_content"],
-            "exercises": node["exercises"],
-        }
-        # Serialize data
-        data = {
-            "last_update": pytz.utc.localize(datetime.now()).strftime(
-                settings.DATE_TIME_FORMAT
-            ),
-            "created": self.created.strftime(settings.DATE_TIME_FORMAT),
-            "resource_count": node.get("resource_count", 0),
-            "resource_size": node.get("resource_size", 0),
-            "includes": for_educators,
-            "kind_count": node.get("kind_count", []),
-            "languages": node.get("languages", ""),
-            "accessible_languages": node.get("accessible_languages", ""),
-            "licenses": node.get("licenses", ""),
-            "tags": node.get("tags_list", []),
-            "copyright_holders": node["copyright_holders"],
-            "authors": node["authors"],
-            "aggregators": node["aggregators"],
-            "providers": node["providers"],
-            "sample_pathway": pathway,
-            "original_channels": original_channels,
-            "sample_nodes": sample_nodes,
-        }
-
-        # Set cache with latest data
-        cache.set("details_{}".format(self.node_id), json.dumps(data), None)
-        return data
+        data, _etag = refresh_node_details(self, channel_id=channel_id)
+        return json.loads(data)
 
     def has_changes(self):
         mptt_opts = self._mptt_meta
@@ -1666,26 +1757,12 @@ class ContentNode(MPTTModel, models.Model):
         original_values = self._field_updates.changed()
         return any((True for field in original_values if field not in blacklist))
 
-    def recalculate_editors_storage(self):
-        from contentcuration.utils.user import calculate_user_storage
-        for editor in self.files.values_list('uploaded_by_id', flat=True).distinct():
-            calculate_user_storage(editor)
-
     def on_create(self):
         self.changed = True
-        self.recalculate_editors_storage()
 
     def on_update(self):
         self.changed = self.changed or self.has_changes()
 
-    def move_to(self, target, *args, **kwargs):
-        parent_was_trashtree = self.parent.channel_trash.exists()
-        super(ContentNode, self).move_to(target, *args, **kwargs)
-
-        # Recalculate storage if node was moved to or from the trash tree
-        if target.channel_trash.exists() or parent_was_trashtree:
-            self.recalculate_editors_storage()
-
     def save(self, skip_lock=False, *args, **kwargs):
         if self._state.adding:
             self.on_create()
@@ -1742,8 +1819,6 @@ class ContentNode(MPTTModel, models.Model):
             parent.changed = True
             parent.save()
 
-        self.recalculate_editors_storage()
-
         # Lock the mptt fields for the tree of this node
         with ContentNode.objects.lock_mptt(self.tree_id):
             return super(ContentNode, self).delete(*args, **kwargs)
@@ -2059,7 +2134,6 @@ class File(models.Model):
             1. generate the MD5 from the content copy
             2. fill the other fields accordingly
         """
-        from contentcuration.utils.user import calculate_user_storage
         if set_by_file_on_disk and self.file_on_disk:  # if file_on_disk is supplied, hash out the file
             if self.checksum is None or self.checksum == "":
                 md5 = hashlib.md5()
@@ -2078,9 +2152,6 @@ class File(models.Model):
 
         super(File, self).save(*args, **kwargs)
 
-        if self.uploaded_by_id:
-            calculate_user_storage(self.uploaded_by_id)
-
     class Meta:
         indexes = [
             models.Index(fields=['checksum', 'file_size'], name=FILE_DISTINCT_INDEX_NAME),
@@ -2088,19 +2159,6 @@ class File(models.Model):
         ]
 
 
-@receiver(models.signals.post_delete, sender=File)
-def auto_delete_file_on_delete(sender, instance, **kwargs):
-    """
-    Deletes file from filesystem if no other File objects are referencing the same file on disk
-    when corresponding `File` object is deleted.
-    Be careful! we don't know if this will work when perform bash delete on File obejcts.
-    """
-    # Recalculate storage
-    from contentcuration.utils.user import calculate_user_storage
-    if instance.uploaded_by_id:
-        calculate_user_storage(instance.uploaded_by_id)
-
-
 def delete_empty_file_reference(checksum, extension):
     filename = checksum + '.' + extension
     if not File.objects.filter(checksum=checksum).exists() and not Channel.objects.filter(thumbnail=filename).exists():
@@ -2226,6 +2284,12 @@ class Invitation(models.Model):
         ).distinct()
 
 
+STATE_QUEUED = "QUEUED"
+
+# Statuses of tasks that haven't finished yet, only one of which may have a given dedup_key
+ACTIVE_TASK_STATUSES = (STATE_QUEUED, states.PENDING, states.RECEIVED, states.STARTED)
+
+
 class Task(models.Model):
     """Asynchronous tasks"""
     task_id = UUIDField(db_index=True, default=uuid.uuid4)  # This ID is used as the Celery task ID
@@ -2236,3 +2300,32 @@ class Task(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="task", on_delete=models.CASCADE)
     metadata = JSONField()
     channel_id = DjangoUUIDField(db_index=True, null=True, blank=True)
+    # Hash of the task type and arguments, set for tasks that shouldn't be queued twice
+    dedup_key = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dedup_key"],
+                condition=Q(status__in=ACTIVE_TASK_STATUSES),
+                name="task_dedup_key_active",
+            ),
+        ]
+
+    @classmethod
+    def generate_dedup_key(cls, task_type, task_args):
+        """
+        Hash of the task type and its arguments, which is the same for tasks that would do the same work
+        """
+        data = json.dumps([task_type, task_args], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_active(cls, task_type, task_args):
+        """
+        :return: The unfinished task of the type with the same arguments, if there is one
+        """
+        return cls.objects.filter(
+            dedup_key=cls.generate_dedup_key(task_type, task_args),
+            status__in=ACTIVE_TASK_STATUSES,
+        ).first()
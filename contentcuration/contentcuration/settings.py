@@ -366,6 +366,7 @@ CELERY_WORKER_SEND_TASK_EVENTS = True
 # our default threshold is two weeks ago
 TWO_WEEKS_AGO = datetime.now() - timedelta(days=14)
 ORPHAN_DATE_CLEAN_UP_THRESHOLD = TWO_WEEKS_AGO
+TASK_CLEAN_UP_THRESHOLD = TWO_WEEKS_AGO
 
 # CLOUD STORAGE SETTINGS
 DEFAULT_FILE_STORAGE = 'django_s3_storage.storage.S3Storage'
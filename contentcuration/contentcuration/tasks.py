@@ -8,8 +8,10 @@ from builtins import str
 from celery import states
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import EmailMessage
 from django.db import IntegrityError
+from django.db import transaction
 from django.db.utils import OperationalError
 from django.template.loader import render_to_string
 from django.utils.translation import gettext as _
@@ -17,9 +19,13 @@ from django.utils.translation import override
 
 from contentcuration.celery import app
 from contentcuration.models import Channel
+from contentcuration.models import ChannelSummary
 from contentcuration.models import ContentNode
+from contentcuration.models import STATE_QUEUED
 from contentcuration.models import Task
+from contentcuration.models import TreeResourceSize
 from contentcuration.models import User
+from contentcuration.models import UserChecksumCount
 from contentcuration.utils.csv_writer import write_channel_csv_file
 from contentcuration.utils.csv_writer import write_user_csv
 from contentcuration.utils.nodes import calculate_resource_size
@@ -35,15 +41,27 @@ from contentcuration.viewsets.user import AdminUserFilter
 
 logger = get_task_logger(__name__)
 
+# seconds to wait before refreshing stale channel summaries, so that edits made in the meantime are
+# picked up by the same refresh
+CHANNEL_SUMMARY_REFRESH_DELAY = 30
+
+# seconds a channel is kept from queueing another refresh, in case its queued refresh is lost
+CHANNEL_SUMMARY_REFRESH_TIMEOUT = 10 * 60
+
+# seconds to wait before applying queued checksum deltas, so that they're applied in bigger batches
+CHECKSUM_DELTAS_APPLY_DELAY = 10
+
+# seconds to keep from queueing another application of checksum deltas, in case the queued one is lost
+CHECKSUM_DELTAS_APPLY_TIMEOUT = 10 * 60
+
+CHECKSUM_DELTAS_APPLY_KEY = "checksum_deltas_apply"
+
 
 # if we're running tests, import our test tasks as well
 if settings.RUNNING_TESTS:
     from .tasks_test import caught_error_test_task, error_test_task, progress_test_task, test_task
 
 
-STATE_QUEUED = "QUEUED"
-
-
 @app.task(bind=True, name="delete_node_task")
 def delete_node_task(
     self,
@@ -61,7 +79,7 @@ def delete_node_task(
     try:
         while not deleted and attempts < 10:
             try:
-                node.delete()
+                ContentNode.objects.delete_subtree(node)
                 deleted = True
             except OperationalError as e:
                 if "deadlock detected" in e.args[0]:
@@ -171,6 +189,11 @@ def export_channel_task(self, user_id, channel_id, version_notes="", language=se
     ]}
 
 
+@app.task(name="republish_channel_task")
+def republish_channel_task(channel_id):
+    publish_channel(None, channel_id, force=True)
+
+
 @app.task(bind=True, name="sync_channel_task", track_progress=True)
 def sync_channel_task(
     self,
@@ -187,7 +210,7 @@ def sync_channel_task(
         sync_attributes,
         sync_tags,
         sync_files,
-        sync_tags,
+        sync_assessment_items,
         progress_tracker=self.progress,
     )
 
@@ -251,7 +274,7 @@ def generateusercsv_task(user_id, language=settings.LANGUAGE_CODE):
 
 @app.task(name="deletetree_task")
 def deletetree_task(tree_id):
-    ContentNode.objects.filter(tree_id=tree_id).delete()
+    ContentNode.objects.delete_tree(tree_id)
 
 
 @app.task(name="getnodedetails_task")
@@ -260,20 +283,56 @@ def getnodedetails_task(node_id):
     return node.get_details()
 
 
+@app.task(name="apply_checksum_deltas_task")
+def apply_checksum_deltas_task():
+    # Let another application be queued before applying them, so that deltas queued while
+    # applying aren't left behind
+    cache.delete(CHECKSUM_DELTAS_APPLY_KEY)
+    TreeResourceSize.apply_deltas()
+    UserChecksumCount.apply_deltas()
+
+
+def queue_checksum_deltas_apply():
+    """
+    Queues the application of the tree and user checksum deltas queued by the database triggers,
+    unless one is already queued. Anything reading the counts or sizes applies the deltas of its
+    trees or users first, so this only keeps the queues short.
+    """
+    if cache.add(CHECKSUM_DELTAS_APPLY_KEY, True, CHECKSUM_DELTAS_APPLY_TIMEOUT):
+        apply_checksum_deltas_task.apply_async(countdown=CHECKSUM_DELTAS_APPLY_DELAY)
+
+
+@app.task(name="refresh_channel_summaries_task")
+def refresh_channel_summaries_task(channel_ids):
+    # Let the channels queue another refresh before reading their trees, so that edits made
+    # while refreshing aren't missed
+    cache.delete_many([get_channel_summary_refresh_key(channel_id) for channel_id in channel_ids])
+    ChannelSummary.refresh(channel_ids)
+
+
+def get_channel_summary_refresh_key(channel_id):
+    return "channel_summary_refresh_{}".format(channel_id)
+
+
+def queue_channel_summaries_refresh(channel_queryset):
+    """
+    Queues a refresh of the stale summaries of the channels in the queryset, unless one is already
+    queued for them, so that listing channels never has to write their summaries
+    """
+    channel_ids = [
+        channel_id
+        for channel_id in ChannelSummary.get_stale_ids(channel_queryset)
+        if cache.add(get_channel_summary_refresh_key(channel_id), True, CHANNEL_SUMMARY_REFRESH_TIMEOUT)
+    ]
+    if channel_ids:
+        refresh_channel_summaries_task.apply_async((channel_ids,), countdown=CHANNEL_SUMMARY_REFRESH_DELAY)
+
+
 @app.task(name="generatenodediff_task")
 def generatenodediff_task(updated_id, original_id):
     return generate_diff(updated_id, original_id)
 
 
-@app.task(name="calculate_user_storage_task")
-def calculate_user_storage_task(user_id):
-    try:
-        user = User.objects.get(pk=user_id)
-        user.set_space_used()
-    except User.DoesNotExist:
-        logging.error("Tried to calculate user storage for user with id {} but they do not exist".format(user_id))
-
-
 @app.task(name="calculate_resource_size_task")
 def calculate_resource_size_task(node_id, channel_id):
     node = ContentNode.objects.get(pk=node_id)
@@ -299,7 +358,6 @@ type_mapping = {
     "export-channel": export_channel_task,
     "sync-channel": sync_channel_task,
     "get-node-diff": generatenodediff_task,
-    "calculate-user-storage": calculate_user_storage_task,
     "calculate-resource-size": calculate_resource_size_task,
 }
 
@@ -327,25 +385,21 @@ def get_or_create_async_task(task_name, user, **task_args):
     if user is None or not isinstance(user, User):
         raise TypeError("All tasks must be assigned to a user.")
 
-    qs = Task.objects.filter(
-        task_type=task_name,
-        status__in=[STATE_QUEUED, states.PENDING, states.RECEIVED, states.STARTED],
-        channel_id=task_args.get("channel_id"),
-        metadata={"args": task_args},
-    )
-
-    try:
-        task_info = qs[0]
-    except IndexError:
-        task_info = None
+    task_info = Task.get_active(task_name, task_args)
 
     if task_info is None:
-        _, task_info = create_async_task(task_name, user, **task_args)
+        try:
+            _, task_info = create_async_task(
+                task_name, user, dedup_key=Task.generate_dedup_key(task_name, task_args), **task_args
+            )
+        except IntegrityError:
+            # the same task was queued concurrently, so use that one instead
+            task_info = Task.get_active(task_name, task_args)
 
     return task_info
 
 
-def create_async_task(task_name, user, apply_async=True, **task_args):
+def create_async_task(task_name, user, apply_async=True, dedup_key=None, **task_args):
     """
     Starts a long-running task that runs asynchronously using Celery. Also creates a Task object that can be used by
     Studio to keep track of the Celery task's status and progress.
@@ -360,8 +414,10 @@ def create_async_task(task_name, user, apply_async=True, **task_args):
     :param task_name: Name of the task function (omitting the word 'task', and with dashes in place of underscores)
     :param user: User object of the user performing the operation
     :param apply_async: Boolean whether to call the Task asynchronously (the default)
+    :param dedup_key: Key of the task for deduplication, raises IntegrityError if an unfinished task has the same key
     :param task_args: A dictionary of keyword arguments to be passed down to the task, must be JSON serializable.
     :return: a tuple of the Task object and a dictionary containing information about the created task.
+        When called inside a transaction, the task is only sent once it commits, and the Task object is None.
     """
     if task_name not in type_mapping:
         raise KeyError("Need to define task in type_mapping first.")
@@ -370,23 +426,35 @@ def create_async_task(task_name, user, apply_async=True, **task_args):
         raise TypeError("All tasks must be assigned to a user.")
 
     async_task = type_mapping[task_name]
-    task_info = Task.objects.create(
-        task_type=task_name,
-        status=STATE_QUEUED,
-        user=user,
-        channel_id=task_args.get("channel_id"),
-        metadata={"args": task_args},
-    )
+    with transaction.atomic():
+        task_info = Task.objects.create(
+            task_type=task_name,
+            status=STATE_QUEUED,
+            user=user,
+            channel_id=task_args.get("channel_id"),
+            metadata={"args": task_args},
+            dedup_key=dedup_key,
+        )
     task_sig = async_task.signature(
         task_id=str(task_info.task_id),
         kwargs=task_args,
     )
 
-    if apply_async:
-        task = task_sig.apply_async()
-    else:
+    if not apply_async:
         task = task_sig.apply()
+    elif transaction.get_connection().in_atomic_block and not app.conf.task_always_eager:
+        # Only send the task once the transaction commits, otherwise the worker
+        # might not be able to see the Task object or the data it works on yet
+        transaction.on_commit(lambda: _check_task_started(task_sig.apply_async(), task_info))
+        return None, task_info
+    else:
+        task = task_sig.apply_async()
 
+    _check_task_started(task, task_info)
+    return task, task_info
+
+
+def _check_task_started(task, task_info):
     # If there was a failure to create the task, the apply_async call will return failed, but
     # checking the status will still show PENDING. So make sure we write the failure to the
     # db directly so the frontend can know of the failure.
@@ -404,5 +472,3 @@ def create_async_task(task_name, user, apply_async=True, **task_args):
             task_info.metadata["error"] = {}
         task_info.metadata["error"].update(error_data)
         task_info.save()
-
-    return task, task_info
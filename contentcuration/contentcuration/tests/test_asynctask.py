@@ -7,6 +7,7 @@ from builtins import str
 import pytest
 from celery import states
 from django.db import connection
+from django.db import IntegrityError
 from django.db.utils import OperationalError
 from django.test import TransactionTestCase
 from django.urls import reverse
@@ -194,12 +195,52 @@ class AsyncTaskTestCase(BaseAPITestCase):
             user=self.user,
             metadata={"args": {
                 "is_test": True
-            }}
+            }},
+            dedup_key=Task.generate_dedup_key("progress-test", {"is_test": True}),
         )
 
         actual_task = get_or_create_async_task("progress-test", self.user, is_test=True)
         self.assertEqual(expected_task.task_id, actual_task.task_id)
 
+    def test_get_or_create_task_finished(self):
+        finished_task = Task.objects.create(
+            task_type="progress-test",
+            status=states.SUCCESS,
+            user=self.user,
+            metadata={"args": {
+                "is_test": True
+            }},
+            dedup_key=Task.generate_dedup_key("progress-test", {"is_test": True}),
+        )
+
+        actual_task = get_or_create_async_task("progress-test", self.user, is_test=True)
+        self.assertNotEqual(finished_task.task_id, actual_task.task_id)
+
+    def test_create_task_duplicate_dedup_key(self):
+        dedup_key = Task.generate_dedup_key("progress-test", {"is_test": True})
+        Task.objects.create(
+            task_type="progress-test",
+            status=states.STARTED,
+            user=self.user,
+            metadata={"args": {
+                "is_test": True
+            }},
+            dedup_key=dedup_key,
+        )
+
+        with self.assertRaises(IntegrityError):
+            create_async_task("progress-test", self.user, dedup_key=dedup_key, is_test=True)
+
+    def test_dedup_key_argument_order(self):
+        self.assertEqual(
+            Task.generate_dedup_key("get-node-diff", {"updated_id": "a", "original_id": "b"}),
+            Task.generate_dedup_key("get-node-diff", {"original_id": "b", "updated_id": "a"}),
+        )
+        self.assertNotEqual(
+            Task.generate_dedup_key("get-node-diff", {"updated_id": "a", "original_id": "b"}),
+            Task.generate_dedup_key("get-node-diff", {"updated_id": "b", "original_id": "a"}),
+        )
+
 
 class DBFailTestCase(TransactionTestCase):
 
@@ -18,13 +18,16 @@ from past.utils import old_div
 from . import testdata
 from .base import BaseTestCase
 from .testdata import create_studio_file
+from contentcuration.models import AssessmentItem
 from contentcuration.models import Channel
 from contentcuration.models import ContentKind
 from contentcuration.models import ContentNode
 from contentcuration.models import ContentTag
+from contentcuration.models import File
 from contentcuration.models import FormatPreset
 from contentcuration.models import generate_storage_url
 from contentcuration.models import Language
+from contentcuration.models import SlideshowSlide
 from contentcuration.utils.db_tools import TreeBuilder
 from contentcuration.utils.files import create_thumbnail_from_base64
 from contentcuration.utils.sync import sync_node
@@ -78,6 +81,18 @@ def _check_tags_for_node(source, copy):
         assert copy_tag.channel_id is None
 
 
+def _check_tree_structure(root):
+    for node in root.get_descendants(include_self=True):
+        # children must fill the space of their parent in order, without gaps
+        position = node.lft
+        for child in ContentNode.objects.filter(parent_id=node.id).order_by("lft"):
+            assert child.lft == position + 1
+            assert child.level == node.level + 1
+            assert child.tree_id == node.tree_id
+            position = child.rght
+        assert node.rght == position + 1
+
+
 def _check_node_copy(source, copy, original_channel_id=None, channel=None):
     source_children = source.get_children()
     copy.refresh_from_db()
@@ -487,6 +502,28 @@ class NodeOperationsTestCase(BaseTestCase):
             self.channel.main_tree.get_children().count() - 1,
         )
 
+    def test_duplicate_nodes_streamed_with_excluded_descendants(self):
+        """
+        Ensures that when we copy large subtrees in batches while excluding descendants,
+        the copies are placed consistently in the target tree
+        """
+        new_channel = testdata.channel()
+        target = new_channel.main_tree.get_children().first()
+
+        excluded_node = self.channel.main_tree.get_children()[1]
+        copy = self.channel.main_tree.copy_to(
+            target, position="left", excluded_descendants={excluded_node.node_id: True}, batch_size=2,
+        )
+
+        self.assertEqual(
+            copy.get_descendant_count(),
+            self.channel.main_tree.get_descendant_count() - excluded_node.get_descendant_count() - 1,
+        )
+        self.assertEqual(copy.parent_id, new_channel.main_tree.id)
+        self.assertEqual(new_channel.main_tree.get_children().first(), copy)
+        new_channel.main_tree.refresh_from_db()
+        _check_tree_structure(new_channel.main_tree)
+
     def test_duplicate_nodes_freeze_authoring_data_no_edit(self):
         """
         Ensures that when we copy nodes, we can exclude nodes from the descendant
@@ -633,6 +670,43 @@ class NodeOperationsTestCase(BaseTestCase):
             prev_channel.main_tree.refresh_from_db()
             self.assertFalse(prev_channel.main_tree.changed)
 
+    def test_delete_subtree(self):
+        """
+        Ensures that deleting a subtree removes its nodes and their related objects,
+        and closes the gap it leaves in the tree
+        """
+        self.channel.main_tree.changed = False
+        self.channel.main_tree.save()
+        topic = self.channel.main_tree.get_children().filter(kind_id=content_kinds.TOPIC).first()
+        slideshow = ContentNode.objects.create(kind_id=content_kinds.SLIDESHOW, title="Slideshow", parent=topic)
+        slide = SlideshowSlide.objects.create(contentnode=slideshow)
+        slide_file = File.objects.create(slideshow_slide=slide, checksum="a" * 32, file_size=100)
+        topic.refresh_from_db()
+        self.channel.main_tree.refresh_from_db()
+        descendant_ids = list(topic.get_descendants(include_self=True).values_list("id", flat=True))
+        node_count = self.channel.main_tree.get_descendant_count()
+
+        self.assertEqual(len(descendant_ids), ContentNode.objects.delete_subtree(topic, batch_size=2))
+
+        self.assertFalse(ContentNode.objects.filter(id__in=descendant_ids).exists())
+        self.assertFalse(File.objects.filter(contentnode_id__in=descendant_ids).exists())
+        self.assertFalse(AssessmentItem.objects.filter(contentnode_id__in=descendant_ids).exists())
+        self.assertFalse(SlideshowSlide.objects.filter(pk=slide.pk).exists())
+        self.assertFalse(File.objects.filter(pk=slide_file.pk).exists())
+        self.channel.main_tree.refresh_from_db()
+        self.assertEqual(node_count - len(descendant_ids), self.channel.main_tree.get_descendant_count())
+        self.assertTrue(self.channel.main_tree.changed)
+        _check_tree_structure(self.channel.main_tree)
+
+    def test_delete_tree(self):
+        tree_id = self.channel.main_tree.tree_id
+
+        ContentNode.objects.delete_tree(tree_id)
+
+        self.assertFalse(ContentNode.objects.filter(tree_id=tree_id).exists())
+        self.channel.refresh_from_db()
+        self.assertIsNone(self.channel.main_tree)
+
     def test_move_nodes(self):
         """
         Ensures that moving nodes properly removes them from the original parent
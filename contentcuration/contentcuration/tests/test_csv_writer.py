@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+from le_utils.constants import content_kinds
+
+from .base import StudioTestCase
+from contentcuration.models import ContentTag
+from contentcuration.tests import testdata
+from contentcuration.utils.csv_writer import CHANNEL_CSV_HEADER
+from contentcuration.utils.csv_writer import iter_channel_csv_rows
+from contentcuration.utils.csv_writer import stream_channel_csv
+
+
+class ChannelCSVTestCase(StudioTestCase):
+    def setUp(self):
+        super(ChannelCSVTestCase, self).setUp()
+        self.channel = testdata.channel()
+        self.resources = list(
+            self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).order_by("lft")
+        )
+
+    def test_rows_in_tree_order(self):
+        rows = list(iter_channel_csv_rows(self.channel, "example.com"))
+        self.assertEqual([row[1] for row in rows], [node.title for node in self.resources])
+
+    def test_row_path_and_url(self):
+        rows = list(iter_channel_csv_rows(self.channel, "example.com"))
+        for row, node in zip(rows, self.resources):
+            self.assertEqual(row[0], "/".join(node.get_ancestors().values_list("title", flat=True)))
+            self.assertEqual(
+                row[4],
+                "/".join(["example.com", "channels", self.channel.pk, "view", node.parent.node_id[:7], node.node_id[:7]]),
+            )
+
+    def test_row_tags(self):
+        node = self.resources[0]
+        node.tags.add(ContentTag.objects.create(tag_name="csv tag", channel=self.channel))
+        rows = list(iter_channel_csv_rows(self.channel, "example.com"))
+        self.assertEqual(rows[0][11], "csv tag")
+
+    def test_stream(self):
+        lines = list(stream_channel_csv(self.channel, "example.com"))
+        self.assertEqual(lines[0].strip(), ",".join(CHANNEL_CSV_HEADER))
+        self.assertEqual(len(lines), len(self.resources) + 1)
@@ -2,12 +2,15 @@ from __future__ import absolute_import
 
 import os
 import random
+import shutil
+import sqlite3
 import string
 import tempfile
 
 import pytest
 from django.core.management import call_command
 from django.db import connections
+from django.utils import timezone
 from kolibri_content import models as kolibri_models
 from kolibri_content.router import get_active_content_database
 from kolibri_content.router import set_active_content_database
@@ -15,16 +18,25 @@ from mock import patch
 
 from .base import StudioTestCase
 from .testdata import channel
+from .testdata import fileobj_exercise_image
 from .testdata import node as create_node
 from .testdata import slideshow
 from contentcuration import models as cc
 from contentcuration.utils.publish import convert_channel_thumbnail
 from contentcuration.utils.publish import create_bare_contentnode
 from contentcuration.utils.publish import create_content_database
+from contentcuration.utils.publish import create_perseus_exercises
 from contentcuration.utils.publish import create_slideshow_manifest
 from contentcuration.utils.publish import fill_published_fields
+from contentcuration.utils.publish import get_assessment_metadata
+from contentcuration.utils.publish import get_perseus_cache_key
+from contentcuration.utils.publish import get_publishable_tree_structure
+from contentcuration.utils.publish import increment_channel_version
+from contentcuration.utils.publish import is_content_database_reusable
+from contentcuration.utils.publish import mark_all_nodes_as_published
 from contentcuration.utils.publish import map_prerequisites
 from contentcuration.utils.publish import MIN_SCHEMA_VERSION
+from contentcuration.utils.publish import PerseusImageCache
 from contentcuration.utils.publish import set_channel_icon_encoding
 from contentcuration.utils.publish import wait_for_async_tasks
 
@@ -148,6 +160,219 @@ class ExportChannelTestCase(StudioTestCase):
         self.assertIsNotNone(self.content_channel.icon_encoding)
 
 
+# Columns populated with randomly generated values, which differ between any two exports
+NONDETERMINISTIC_COLUMNS = {
+    "content_assessmentmetadata": {"id"},
+    "content_contentnode_tags": {"id"},
+    "content_contentnode_has_prerequisite": {"id"},
+    # Thumbnails are regenerated as new Studio files on every export
+    "content_file": {"id"},
+}
+
+
+def export_database_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [
+            row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'content_%'")
+        ]
+        rows = {}
+        for table in tables:
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info({})".format(table))
+                if row[1] not in NONDETERMINISTIC_COLUMNS.get(table, set())
+            ]
+            rows[table] = sorted(
+                conn.execute("SELECT {} FROM {}".format(", ".join(columns), table)).fetchall(),
+                key=repr,
+            )
+        return rows
+    finally:
+        conn.close()
+
+
+class BulkExportChannelTestCase(StudioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BulkExportChannelTestCase, cls).setUpClass()
+        cls.patch_copy_db = patch('contentcuration.utils.publish.save_export_database')
+        cls.patch_copy_db.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(BulkExportChannelTestCase, cls).tearDownClass()
+        cls.patch_copy_db.stop()
+
+    def setUp(self):
+        super(BulkExportChannelTestCase, self).setUp()
+        self.content_channel = channel()
+
+        new_node = create_node({'kind_id': 'topic', 'title': 'Incomplete topic', 'children': []})
+        new_node.complete = False
+        new_node.parent = self.content_channel.main_tree
+        new_node.save()
+
+        new_video = create_node({'kind_id': 'video', 'title': 'Complete video', 'children': []})
+        new_video.complete = True
+        new_video.parent = new_node
+        new_video.save()
+
+        empty_topic = create_node({'kind_id': 'topic', 'title': 'Empty topic', 'children': []})
+        empty_topic.parent = self.content_channel.main_tree
+        empty_topic.save()
+
+        set_channel_icon_encoding(self.content_channel)
+        self.tempdbs = []
+
+    def tearDown(self):
+        for tempdb in self.tempdbs:
+            if tempdb in connections.databases:
+                connections[tempdb].close()
+                del connections.databases[tempdb]
+            if os.path.exists(tempdb):
+                os.remove(tempdb)
+        set_active_content_database(None)
+        super(BulkExportChannelTestCase, self).tearDown()
+
+    def _export(self, bulk):
+        tempdb = create_content_database(self.content_channel, True, None, True, bulk=bulk)
+        self.tempdbs.append(tempdb)
+        connections[tempdb].close()
+        return tempdb
+
+    def test_bulk_export_matches_node_by_node_export(self):
+        node_by_node_rows = export_database_rows(self._export(False))
+        bulk_rows = export_database_rows(self._export(True))
+        self.assertTrue(bulk_rows["content_contentnode"])
+        self.assertEqual(node_by_node_rows, bulk_rows)
+
+    def test_publishable_tree_structure(self):
+        root = self.content_channel.main_tree
+        structure = get_publishable_tree_structure(root)
+        published_ids = set(n["id"] for n in structure)
+
+        for node in root.get_descendants(include_self=True):
+            publishable = (
+                node.complete
+                and node.get_descendants(include_self=True).exclude(kind_id="topic").exists()
+                and not node.get_ancestors().exclude(complete=True).exists()
+                and all(a.get_descendants().exclude(kind_id="topic").exists() for a in node.get_ancestors())
+            )
+            self.assertEqual(bool(publishable), node.id in published_ids)
+
+        # Export tree values are a valid mptt tree spanning all published nodes
+        self.assertEqual(structure[0]["id"], root.id)
+        self.assertEqual(structure[0]["export_lft"], 1)
+        self.assertEqual(structure[0]["export_rght"], len(structure) * 2)
+        by_id = {n["id"]: n for n in structure}
+        for node in structure[1:]:
+            parent = by_id[node["parent_id"]]
+            self.assertGreater(node["export_lft"], parent["export_lft"])
+            self.assertLess(node["export_rght"], parent["export_rght"])
+            self.assertEqual(node["export_level"], parent["export_level"] + 1)
+
+
+class IncrementalExportChannelTestCase(StudioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(IncrementalExportChannelTestCase, cls).setUpClass()
+        cls.patch_copy_db = patch('contentcuration.utils.publish.save_export_database')
+        cls.patch_copy_db.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(IncrementalExportChannelTestCase, cls).tearDownClass()
+        cls.patch_copy_db.stop()
+
+    def setUp(self):
+        super(IncrementalExportChannelTestCase, self).setUp()
+        self.content_channel = channel()
+        set_channel_icon_encoding(self.content_channel)
+        self.tempdbs = []
+        self.previous_db = self._export()
+        # Record the export as published, as publish_channel would
+        increment_channel_version(self.content_channel)
+        mark_all_nodes_as_published(self.content_channel)
+        self.content_channel.last_published = timezone.now()
+        self.content_channel.save()
+
+    def tearDown(self):
+        for tempdb in self.tempdbs:
+            if tempdb in connections.databases:
+                connections[tempdb].close()
+                del connections.databases[tempdb]
+            if os.path.exists(tempdb):
+                os.remove(tempdb)
+        set_active_content_database(None)
+        super(IncrementalExportChannelTestCase, self).tearDown()
+
+    def _export(self, incremental=False):
+        tempdb = create_content_database(self.content_channel, True, None, False, incremental=incremental)
+        self.tempdbs.append(tempdb)
+        connections[tempdb].close()
+        return tempdb
+
+    def _copy_previous_db(self, channel):
+        fh, tempdb = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fh)
+        shutil.copyfile(self.previous_db, tempdb)
+        self.tempdbs.append(tempdb)
+        return tempdb
+
+    def test_previous_database_reusable(self):
+        self.assertTrue(is_content_database_reusable(self.previous_db, self.content_channel))
+
+    def test_previous_database_not_reusable_for_other_version(self):
+        increment_channel_version(self.content_channel)
+        self.assertFalse(is_content_database_reusable(self.previous_db, self.content_channel))
+
+    def test_previous_database_not_reusable_for_other_default_language(self):
+        self.content_channel.language = cc.Language.objects.exclude(pk=self.content_channel.language_id).first()
+        self.content_channel.save()
+        self.assertFalse(is_content_database_reusable(self.previous_db, self.content_channel))
+
+    def test_incremental_export_renamed_channel(self):
+        self.content_channel.name = "Renamed channel"
+        self.content_channel.save()
+
+        with patch('contentcuration.utils.publish.get_previous_content_database', side_effect=self._copy_previous_db):
+            incremental_rows = export_database_rows(self._export(incremental=True))
+        full_rows = export_database_rows(self._export())
+
+        self.assertEqual(full_rows, incremental_rows)
+        self.assertTrue(any("Renamed channel" in r for r in incremental_rows["content_contentnode"]))
+
+    def test_incremental_export_matches_full_export(self):
+        root = self.content_channel.main_tree
+        videos = root.get_descendants().filter(kind_id="video").order_by("lft")
+        edited_video = videos[0]
+        edited_video.title = "Edited video"
+        edited_video.save()
+        videos[1].delete()
+        new_topic = create_node({'kind_id': 'topic', 'title': 'New topic', 'children': []})
+        new_topic.parent = root.get_children().first()
+        new_topic.save()
+        create_node({'kind_id': 'video', 'title': 'New video', 'children': []}, parent=new_topic)
+        root.refresh_from_db()
+
+        with patch('contentcuration.utils.publish.get_previous_content_database', side_effect=self._copy_previous_db):
+            incremental_rows = export_database_rows(self._export(incremental=True))
+        full_rows = export_database_rows(self._export())
+
+        self.assertEqual(full_rows, incremental_rows)
+        titles = [r for r in incremental_rows["content_contentnode"] if "Edited video" in r or "New video" in r]
+        self.assertEqual(len(titles), 2)
+
+    def test_incremental_export_falls_back_to_full_export(self):
+        with patch('contentcuration.utils.publish.get_previous_content_database', return_value=None):
+            with patch('contentcuration.utils.publish.map_content_nodes_incremental') as incremental_mock:
+                tempdb = self._export(incremental=True)
+        incremental_mock.assert_not_called()
+        self.assertTrue(export_database_rows(tempdb)["content_contentnode"])
+
+
 class ChannelExportUtilityFunctionTestCase(StudioTestCase):
     @classmethod
     def setUpClass(cls):
@@ -204,6 +429,64 @@ class ChannelExportUtilityFunctionTestCase(StudioTestCase):
         manifest_collection = cc.File.objects.filter(contentnode=ccnode, preset_id=u"slideshow_manifest")
         assert len(manifest_collection) == 1
 
+    def test_create_perseus_exercises(self):
+        content_channel = channel()
+        exercises = content_channel.main_tree.get_descendants().filter(kind_id="exercise")
+        assert exercises.exists()
+        create_perseus_exercises(content_channel.main_tree, force_exercises=True, workers=2)
+        for exercise in exercises:
+            self.assertEqual(exercise.files.filter(preset_id=u"exercise").count(), 1)
+
+    def test_create_perseus_exercises_skips_unchanged(self):
+        content_channel = channel()
+        create_perseus_exercises(content_channel.main_tree, force_exercises=True)
+        content_channel.main_tree.get_descendants().update(changed=False)
+        exercise_files = set(cc.File.objects.filter(preset_id=u"exercise").values_list("id", flat=True))
+        create_perseus_exercises(content_channel.main_tree)
+        self.assertEqual(exercise_files, set(cc.File.objects.filter(preset_id=u"exercise").values_list("id", flat=True)))
+
+    def test_create_perseus_exercises_reuses_cached_zips(self):
+        content_channel = channel()
+        create_perseus_exercises(content_channel.main_tree, force_exercises=True)
+        checksums = set(cc.File.objects.filter(preset_id=u"exercise").values_list("checksum", flat=True))
+        cc.File.objects.filter(preset_id=u"exercise").delete()
+        with patch("contentcuration.utils.publish.create_perseus_zip_file") as create_zip:
+            create_perseus_exercises(content_channel.main_tree, force_exercises=True)
+            create_zip.assert_not_called()
+        self.assertEqual(checksums, set(cc.File.objects.filter(preset_id=u"exercise").values_list("checksum", flat=True)))
+
+    def test_perseus_cache_key(self):
+        content_channel = channel()
+        exercise = content_channel.main_tree.get_descendants().filter(kind_id="exercise").first()
+        items = list(exercise.assessment_items.order_by("order"))
+        exercise_data, _ = get_assessment_metadata(exercise, items)
+        key = get_perseus_cache_key(exercise_data, items)
+        self.assertEqual(key, get_perseus_cache_key(exercise_data, items))
+
+        items[0].question = "A different question"
+        self.assertNotEqual(key, get_perseus_cache_key(exercise_data, items))
+
+    def test_perseus_cache_key_template_version(self):
+        content_channel = channel()
+        exercise = content_channel.main_tree.get_descendants().filter(kind_id="exercise").first()
+        items = list(exercise.assessment_items.order_by("order"))
+        exercise_data, _ = get_assessment_metadata(exercise, items)
+        key = get_perseus_cache_key(exercise_data, items)
+        with patch("contentcuration.utils.publish.PERSEUS_TEMPLATE_VERSION", -1):
+            self.assertNotEqual(key, get_perseus_cache_key(exercise_data, items))
+
+    def test_perseus_image_cache_reads_storage_once(self):
+        image = fileobj_exercise_image()
+        storage_name = cc.generate_object_storage_name(image.checksum, str(image))
+        image_cache = PerseusImageCache()
+        try:
+            content = image_cache.read(storage_name)
+            with patch("contentcuration.utils.publish.storage.open") as storage_open:
+                self.assertEqual(content, image_cache.read(storage_name))
+                storage_open.assert_not_called()
+        finally:
+            image_cache.cleanup()
+
     def test_blocking_task_detection(self):
         with patch('time.sleep') as patched_time_sleep:
             user = cc.User.objects.create()
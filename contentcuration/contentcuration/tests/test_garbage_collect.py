@@ -15,8 +15,10 @@ from .base import BaseTestCase
 from .base import StudioTestCase
 from contentcuration.models import ContentNode
 from contentcuration.models import File
+from contentcuration.models import Task
 from contentcuration.utils.garbage_collect import clean_up_contentnodes
 from contentcuration.utils.garbage_collect import clean_up_feature_flags
+from contentcuration.utils.garbage_collect import clean_up_tasks
 
 
 THREE_MONTHS_AGO = datetime.now() - timedelta(days=93)
@@ -213,3 +215,22 @@ class CleanUpFeatureFlagsTestCase(BaseTestCase):
         clean_up_feature_flags()
         self.user.refresh_from_db()
         self.assertNotIn(key, self.user.feature_flags)
+
+
+class CleanUpTasksTestCase(BaseTestCase):
+    def _create_task(self, created, status="SUCCESS"):
+        return Task.objects.create(
+            task_type="test",
+            status=status,
+            user=self.user,
+            metadata={},
+            created=created,
+        )
+
+    def test_clean_up(self):
+        old_task = self._create_task(THREE_MONTHS_AGO)
+        stuck_task = self._create_task(THREE_MONTHS_AGO, status="STARTED")
+        new_task = self._create_task(datetime.now())
+        clean_up_tasks()
+        self.assertFalse(Task.objects.filter(pk__in=[old_task.pk, stuck_task.pk]).exists())
+        self.assertTrue(Task.objects.filter(pk=new_task.pk).exists())
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 from future import standard_library
 standard_library.install_aliases()
+import gzip
+import os
+import shutil
+import tempfile
 from io import BytesIO
 
 import pytest
@@ -10,9 +14,11 @@ from google.cloud.storage import Client
 from google.cloud.storage.blob import Blob
 from mixer.main import mixer
 from mock import create_autospec
-from mock import patch
 
+from contentcuration.utils.gcs_storage import DATABASE_UPLOAD_CHUNK_SIZE
 from contentcuration.utils.gcs_storage import GoogleCloudStorage as gcs
+from contentcuration.utils.gcs_storage import GzipReader
+from contentcuration.utils.gcs_storage import LocalClient
 
 
 class GoogleCloudStorageSaveTestCase(TestCase):
@@ -73,17 +79,34 @@ class GoogleCloudStorageSaveTestCase(TestCase):
         self.storage.save(filename, self.content, blob_object=self.blob_obj)
         assert "private" in self.blob_obj.cache_control
 
-    @patch("contentcuration.utils.gcs_storage.BytesIO")
-    @patch("contentcuration.utils.gcs_storage.GoogleCloudStorage._is_file_empty", return_value=False)
-    def test_gzip_if_content_database(self, bytesio_mock, file_empty_mock):
+    def test_gzip_if_content_database(self):
         """
-        Check that if we're uploading a gzipped content database and
-        if the BytesIO object has been closed.
+        Check that we upload a content database gzipped, streaming it through a resumable upload.
         """
         filename = "content/databases/myfile.sqlite3"
         self.storage.save(filename, self.content, blob_object=self.blob_obj)
         assert self.blob_obj.content_encoding == "gzip"
-        assert bytesio_mock.called
+        assert self.blob_obj.chunk_size == DATABASE_UPLOAD_CHUNK_SIZE
+
+        stream = self.blob_obj.upload_from_file.call_args[0][0]
+        assert isinstance(stream, GzipReader)
+        assert gzip.decompress(stream.read()) == b"content"
+
+    def test_gzip_reader_reads_in_pieces(self):
+        """
+        Check that a database compressed while being read in pieces decompresses to its content.
+        """
+        content = os.urandom(3 * 1024 * 1024)
+        stream = GzipReader(BytesIO(content))
+        pieces = []
+        while True:
+            piece = stream.read(256 * 1024)
+            if not piece:
+                break
+            assert len(piece) <= 256 * 1024
+            pieces.append(piece)
+        assert stream.tell() == sum(len(piece) for piece in pieces)
+        assert gzip.decompress(b"".join(pieces)) == content
 
 
 class GoogleCloudStorageOpenTestCase(TestCase):
@@ -101,6 +124,9 @@ class GoogleCloudStorageOpenTestCase(TestCase):
     def setUp(self):
         self.blob_class = create_autospec(Blob)
         self.blob_obj = self.blob_class("blob", "blob")
+        self.blob_obj.name = "blob"
+        self.blob_obj.size = 10
+        self.blob_obj.content_encoding = None
         self.mock_client = create_autospec(Client)
         self.storage = gcs(client=self.mock_client())
         self.local_file = mixer.blend(self.RandomFileSchema)
@@ -112,13 +138,35 @@ class GoogleCloudStorageOpenTestCase(TestCase):
         with pytest.raises(AssertionError):
             self.storage.open("randfile", mode="wb")
 
-    def test_calls_blob_download_to_file(self):
+    def test_does_not_download_on_open(self):
         """
-        Check that open() eventually calls blob.download_to_file().
+        Check that open() doesn't download anything until the file is read.
         """
         self.storage.open(self.local_file.filename, blob_object=self.blob_obj)
 
-        # assert that we called download_from_file
+        self.blob_obj.download_to_file.assert_not_called()
+        self.blob_obj.download_as_bytes.assert_not_called()
+
+    def test_reads_byte_ranges(self):
+        """
+        Check that reads only download the range read, plus any read ahead.
+        """
+        contents = b"0123456789"
+        self.blob_obj.download_as_bytes.side_effect = lambda start, end: contents[start:end + 1]
+        f = self.storage.open(self.local_file.filename, blob_object=self.blob_obj)
+        f.seek(4)
+
+        assert f.read(2) == b"45"
+        assert f.read(2) == b"67"
+        self.blob_obj.download_as_bytes.assert_called_once_with(start=4, end=9)
+
+    def test_downloads_gzip_encoded_blobs_in_full(self):
+        """
+        Check that gzip encoded blobs are downloaded, since GCS ignores ranges for them.
+        """
+        self.blob_obj.content_encoding = "gzip"
+        self.storage.open(self.local_file.filename, blob_object=self.blob_obj)
+
         self.blob_obj.download_to_file.assert_called()
 
     def test_returns_django_file(self):
@@ -128,5 +176,48 @@ class GoogleCloudStorageOpenTestCase(TestCase):
         f = self.storage.open(self.local_file.filename, blob_object=self.blob_obj)
 
         assert isinstance(f, File)
-        # This checks that an actual temp file was written on disk for the file.git
         assert f.name
+        assert f.size == 10
+
+
+class GoogleCloudStorageLocalTestCase(TestCase):
+    """
+    Tests for GoogleCloudStorage against the local stand-in for GCS.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = gcs(client=LocalClient(self.root))
+        self.content = b"".join(bytes([i % 256]) for i in range(4096))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_save_and_open(self):
+        self.storage.save("a/b/myfile.jpg", BytesIO(self.content))
+
+        assert self.storage.exists("a/b/myfile.jpg")
+        assert self.storage.size("a/b/myfile.jpg") == len(self.content)
+        with self.storage.open("a/b/myfile.jpg") as f:
+            assert f.read() == self.content
+
+    def test_open_seek(self):
+        self.storage.save("myfile.jpg", BytesIO(self.content))
+
+        with self.storage.open("myfile.jpg") as f:
+            f.seek(-10, os.SEEK_END)
+            assert f.read() == self.content[-10:]
+            f.seek(100)
+            assert f.read(5) == self.content[100:105]
+
+    def test_open_content_database(self):
+        self.storage.save("content/databases/myfile.sqlite3", BytesIO(self.content))
+
+        with self.storage.open("content/databases/myfile.sqlite3") as f:
+            assert f.read() == self.content
+
+    def test_delete(self):
+        self.storage.save("myfile.jpg", BytesIO(self.content))
+        self.storage.delete("myfile.jpg")
+
+        assert not self.storage.exists("myfile.jpg")
@@ -8,12 +8,15 @@ from le_utils.constants import content_kinds
 
 from contentcuration.models import AssessmentItem
 from contentcuration.models import Channel
+from contentcuration.models import ChannelSummary
 from contentcuration.models import ContentNode
 from contentcuration.models import File
 from contentcuration.models import generate_object_storage_name
 from contentcuration.models import Invitation
 from contentcuration.models import object_storage_name
 from contentcuration.models import User
+from contentcuration.models import UserChecksumCount
+from contentcuration.models import UserChecksumDelta
 from contentcuration.tests import testdata
 from contentcuration.tests.base import StudioTestCase
 
@@ -690,3 +693,132 @@ class UserTestCase(StudioTestCase):
 
         # ensure nothing found doesn't error
         self.assertIsNone(User.get_for_email("tester@tester.com"))
+
+
+class ChannelSummaryTestCase(StudioTestCase):
+    def setUp(self):
+        super(ChannelSummaryTestCase, self).setUp()
+        self.channel = testdata.channel()
+
+    def _expected_count(self):
+        return (
+            self.channel.main_tree.get_descendants()
+            .exclude(kind_id=content_kinds.TOPIC)
+            .values("content_id")
+            .distinct()
+            .count()
+        )
+
+    def test_refresh(self):
+        ChannelSummary.refresh([self.channel.id])
+        summary = ChannelSummary.objects.get(channel=self.channel)
+        self.assertFalse(summary.stale)
+        self.assertEqual(summary.tree_id, self.channel.main_tree.tree_id)
+        self.assertEqual(summary.resource_count, self._expected_count())
+        self.assertNotIn(content_kinds.TOPIC, summary.kinds)
+        self.assertEqual(
+            summary.modified,
+            ContentNode.objects.filter(tree_id=self.channel.main_tree.tree_id).order_by("-modified")[0].modified,
+        )
+
+    def test_edit_marks_stale(self):
+        ChannelSummary.refresh([self.channel.id])
+        node = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        node.title = "new title"
+        node.save()
+        self.assertTrue(ChannelSummary.objects.get(channel=self.channel).stale)
+
+    def test_get_stale_ids(self):
+        channels = Channel.objects.filter(pk=self.channel.pk)
+        self.assertEqual(ChannelSummary.get_stale_ids(channels), [self.channel.id])
+        ChannelSummary.refresh([self.channel.id])
+        self.assertEqual(ChannelSummary.get_stale_ids(channels), [])
+        self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first().delete()
+        self.assertEqual(ChannelSummary.get_stale_ids(channels), [self.channel.id])
+        ChannelSummary.refresh([self.channel.id])
+        summary = ChannelSummary.objects.get(channel=self.channel)
+        self.assertFalse(summary.stale)
+        self.assertEqual(summary.resource_count, self._expected_count())
+
+
+class UserStorageTestCase(StudioTestCase):
+    def setUp(self):
+        super(UserStorageTestCase, self).setUp()
+        self.user = testdata.user("storage@test.com")
+        self.channel = testdata.channel()
+        self.channel.editors.add(self.user)
+        self.node = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+
+    def _create_file(self, checksum, file_size=100, node=None):
+        return File.objects.create(
+            checksum=checksum,
+            file_size=file_size,
+            contentnode=node or self.node,
+            uploaded_by=self.user,
+        )
+
+    def _space_used(self):
+        UserChecksumCount.apply_deltas([self.user.pk])
+        return User.objects.get(pk=self.user.pk).disk_space_used
+
+    def test_file_changes_queued(self):
+        self._create_file("a" * 32)
+        self._create_file("a" * 32)
+        self.assertEqual(UserChecksumDelta.objects.filter(user_id=self.user.pk).count(), 2)
+        self.assertEqual(User.objects.get(pk=self.user.pk).disk_space_used, 0)
+        UserChecksumCount.apply_deltas()
+        self.assertFalse(UserChecksumDelta.objects.filter(user_id=self.user.pk).exists())
+        self.assertEqual(User.objects.get(pk=self.user.pk).disk_space_used, 100)
+        self.assertEqual(UserChecksumCount.objects.get(user=self.user, checksum="a" * 32).count, 2)
+
+    def test_duplicate_checksum_counts_once(self):
+        self._create_file("a" * 32)
+        self._create_file("a" * 32)
+        self._create_file("b" * 32, file_size=50)
+        self.assertEqual(self._space_used(), 150)
+        self.assertEqual(self.user.get_space_used(), 150)
+
+    def test_delete_file(self):
+        first = self._create_file("a" * 32)
+        second = self._create_file("a" * 32)
+        first.delete()
+        self.assertEqual(self._space_used(), 100)
+        second.delete()
+        self.assertEqual(self._space_used(), 0)
+
+    def test_editor_permission_changes(self):
+        self._create_file("a" * 32)
+        self.channel.editors.remove(self.user)
+        self.assertEqual(self._space_used(), 0)
+        self.channel.editors.add(self.user)
+        self.assertEqual(self._space_used(), 100)
+
+    def test_deleted_channel(self):
+        self._create_file("a" * 32)
+        self.channel.deleted = True
+        self.channel.save()
+        self.assertEqual(self._space_used(), 0)
+
+    def test_move_to_other_tree(self):
+        self._create_file("a" * 32)
+        self.node.move_to(testdata.channel().main_tree, "last-child")
+        self.assertEqual(self._space_used(), 0)
+
+    def test_save_does_not_overwrite(self):
+        user = User.objects.get(pk=self.user.pk)
+        self._create_file("a" * 32)
+        user.first_name = "Storage"
+        user.save()
+        self.assertEqual(self._space_used(), 100)
+
+    def test_set_space_used_reconciles_drift(self):
+        self._create_file("a" * 32)
+        User.objects.filter(pk=self.user.pk).update(disk_space_used=5)
+        self.assertEqual(self.user.set_space_used(), 100)
+        self.assertEqual(self._space_used(), 100)
+
+    def test_check_space_existing_checksum(self):
+        self._create_file("a" * 32)
+        User.objects.filter(pk=self.user.pk).update(disk_space=100)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_space(200, "a" * 32))
@@ -1,11 +1,8 @@
 from __future__ import absolute_import
 
-import datetime
 import json
 
-import pytz
-from django.conf import settings
-from django.core.cache import cache
+from le_utils.constants import content_kinds
 from mock import patch
 from rest_framework.reverse import reverse
 
@@ -25,19 +22,36 @@ class NodeViewsUtilityTestCase(BaseAPITestCase):
         assert len(details['kind_count']) > 0
 
     def test_get_channel_details_cached(self):
-        cache_key = "details_{}".format(self.channel.main_tree.id)
+        url = reverse('get_channel_details', [self.channel.id])
+        self.get(url)
 
-        # force the cache to update by adding a very old cache entry. Since Celery tasks run sync in the test suite,
-        # get_channel_details will return an updated cache value rather than generate it async.
-        data = {"last_update": pytz.utc.localize(datetime.datetime(1990, 1, 1)).strftime(settings.DATE_TIME_FORMAT)}
-        cache.set(cache_key, json.dumps(data))
+        # an edit marks the stored details stale, so they are served while being updated asynchronously
+        node = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        node.title = "new title"
+        node.save()
 
         with patch("contentcuration.views.nodes.getnodedetails_task") as task_mock:
-            url = reverse('get_channel_details', [self.channel.id])
             self.get(url)
-            # Check that the outdated cache prompts an asynchronous cache update
+            # Check that the outdated details prompt an asynchronous update
             task_mock.apply_async.assert_called_once_with((self.channel.main_tree.id,))
 
+    def test_get_channel_details_etag(self):
+        url = reverse('get_channel_details', [self.channel.id])
+        response = self.get(url)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        node = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        node.author = "new author"
+        node.save()
+        self.channel.main_tree.get_details()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("new author", json.loads(response.content)["authors"])
+
 
 class GetTopicDetailsEndpointTestCase(BaseAPITestCase):
     def test_200_post(self):
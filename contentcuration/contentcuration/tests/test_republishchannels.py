@@ -0,0 +1,39 @@
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from mock import patch
+
+from .base import StudioTestCase
+from .testdata import channel
+from contentcuration.models import ContentNode
+
+
+class RepublishChannelsTestCase(StudioTestCase):
+    def setUp(self):
+        super(RepublishChannelsTestCase, self).setUp()
+        self.channels = [channel(), channel()]
+        ContentNode.objects.filter(pk__in=[c.main_tree_id for c in self.channels]).update(published=True)
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+    def republish(self, **options):
+        with patch("contentcuration.management.commands.republishchannels.republish_channel_task") as task:
+            call_command("republishchannels", celery=True, checkpoint=self.checkpoint, **options)
+        return sorted(c[0][0][0] for c in task.apply_async.call_args_list)
+
+    def read_checkpoint(self):
+        with open(self.checkpoint) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def test_republishes_published_channels(self):
+        self.assertEqual(sorted(c.id for c in self.channels), self.republish())
+        checkpoint = self.read_checkpoint()
+        for c in self.channels:
+            self.assertEqual("done", checkpoint[c.id]["status"])
+
+    def test_resumes_from_checkpoint(self):
+        with open(self.checkpoint, "w") as checkpoint_file:
+            json.dump({self.channels[0].id: {"status": "done"}, self.channels[1].id: {"status": "failed"}}, checkpoint_file)
+        self.assertEqual([self.channels[1].id], self.republish())
+        self.assertEqual(sorted(c.id for c in self.channels), self.republish(restart=True))
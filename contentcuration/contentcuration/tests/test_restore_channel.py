@@ -6,21 +6,30 @@ standard_library.install_aliases()
 from builtins import str
 import datetime
 import json
+import sqlite3
 import sys
 import uuid
 from io import BytesIO
 
 from django.core.files.storage import default_storage
 from django.template.loader import render_to_string
+from le_utils.constants import content_kinds
 from le_utils.constants import exercises
+from le_utils.constants import format_presets
 from mixer.backend.django import mixer
 from mock import MagicMock
 from mock import patch
 
 from .base import StudioTestCase
 from contentcuration.models import AssessmentItem
+from contentcuration.models import Channel
+from contentcuration.models import ContentNode
+from contentcuration.models import ContentTag
 from contentcuration.models import generate_object_storage_name
+from contentcuration.models import License
 from contentcuration.utils.import_tools import create_channel
+from contentcuration.utils.import_tools import create_node_tags
+from contentcuration.utils.import_tools import create_nodes
 from contentcuration.utils.import_tools import generate_assessment_item
 from contentcuration.utils.import_tools import process_content
 
@@ -182,3 +191,107 @@ class PerseusRestoreTestCase(StudioTestCase):
                 self.assertTrue(any(h for h in data['hints'] if h['hint'] == hint['hint']))
             for answer in json.loads(assessment_item.answers):
                 self.assertTrue(any(a for a in data['answers'] if a['answer'] == str(answer['answer']) and a['correct'] == answer['correct']))
+
+
+class CreateNodesTestCase(StudioTestCase):
+    def setUp(self):
+        super(CreateNodesTestCase, self).setUp()
+        default_storage.save(generate_object_storage_name('test', 'test.png'), BytesIO(b'test'))
+        self.root_pk = uuid.uuid4().hex
+        self.topic_pk = uuid.uuid4().hex
+        self.video_pk = uuid.uuid4().hex
+        self.document_pk = uuid.uuid4().hex
+        self.tag_pk = uuid.uuid4().hex
+        self.license = License.objects.first()
+
+        self.conn = sqlite3.connect(":memory:")
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "CREATE TABLE content_contentnode (id, parent_id, title, content_id, description, sort_order, "
+            "license_owner, author, license_id, kind, coach_content, lang_id)"
+        )
+        cursor.execute("CREATE TABLE content_assessmentmetadata (contentnode_id, mastery_model, randomize)")
+        cursor.execute("CREATE TABLE content_file (checksum, extension, file_size, contentnode_id, lang_id, preset)")
+        cursor.execute("CREATE TABLE content_contenttag (id, tag_name)")
+        cursor.execute("CREATE TABLE content_contentnode_tags (contentnode_id, contenttag_id)")
+        cursor.execute("CREATE TABLE content_license (id, license_name, license_description)")
+        cursor.executemany(
+            "INSERT INTO content_contentnode VALUES (?, ?, ?, ?, '', ?, '', '', 1, ?, 0, NULL)",
+            [
+                (self.document_pk, self.root_pk, "Document", uuid.uuid4().hex, 2, content_kinds.DOCUMENT),
+                (self.topic_pk, self.root_pk, "Topic", uuid.uuid4().hex, 1, content_kinds.TOPIC),
+                (self.video_pk, self.topic_pk, "Video", uuid.uuid4().hex, 1, content_kinds.VIDEO),
+            ],
+        )
+        cursor.execute("INSERT INTO content_file VALUES ('test', 'png', 4, ?, NULL, ?)", (self.video_pk, format_presets.VIDEO_THUMBNAIL))
+        cursor.execute("INSERT INTO content_contenttag VALUES (?, 'test tag')", (self.tag_pk,))
+        cursor.execute("INSERT INTO content_contentnode_tags VALUES (?, ?)", (self.video_pk, self.tag_pk))
+        cursor.execute("INSERT INTO content_license VALUES (1, ?, 'description')", (self.license.license_name,))
+
+        self.channel = mixer.blend(Channel)
+        self.root = ContentNode.objects.create(node_id=self.root_pk, title="Root", kind_id=content_kinds.TOPIC)
+        self.count = create_nodes(cursor, self.channel.id, self.root)
+
+    def tearDown(self):
+        self.conn.close()
+        super(CreateNodesTestCase, self).tearDown()
+
+    def test_create_nodes_tree(self):
+        self.assertEqual(self.count, 3)
+        self.root.refresh_from_db()
+        self.assertEqual(
+            [node.node_id for node in self.root.get_descendants()],
+            [self.topic_pk, self.video_pk, self.document_pk],
+        )
+        video = ContentNode.objects.get(node_id=self.video_pk, tree_id=self.root.tree_id)
+        self.assertEqual(video.parent.node_id, self.topic_pk)
+        self.assertEqual(video.level, 2)
+        self.assertEqual(video.license_id, self.license.id)
+        self.assertEqual((self.root.lft, self.root.rght), (1, 8))
+        self.assertEqual(
+            [(node.lft, node.rght, node.level) for node in self.root.get_descendants()],
+            [(2, 5, 1), (3, 4, 2), (6, 7, 1)],
+        )
+
+    def test_create_nodes_tags_and_files(self):
+        video = ContentNode.objects.get(node_id=self.video_pk, tree_id=self.root.tree_id)
+        self.assertEqual(list(video.tags.values_list("tag_name", flat=True)), ["test tag"])
+        video_file = video.files.get()
+        self.assertEqual(video_file.checksum, "test")
+        self.assertEqual(video_file.file_on_disk.name, generate_object_storage_name('test', 'test.png'))
+
+
+class CreateNodeTagsTestCase(StudioTestCase):
+    def setUp(self):
+        super(CreateNodeTagsTestCase, self).setUp()
+        self.channel = mixer.blend(Channel)
+        self.node = ContentNode.objects.create(title="Video", kind_id=content_kinds.VIDEO)
+        self.export_node_pk = uuid.uuid4().hex
+        self.conn = sqlite3.connect(":memory:")
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("CREATE TABLE content_contenttag (id, tag_name)")
+        self.cursor.execute("CREATE TABLE content_contentnode_tags (contentnode_id, contenttag_id)")
+
+    def tearDown(self):
+        self.conn.close()
+        super(CreateNodeTagsTestCase, self).tearDown()
+
+    def _add_export_tag(self, tag_id, tag_name):
+        self.cursor.execute("INSERT INTO content_contenttag VALUES (?, ?)", (tag_id, tag_name))
+        self.cursor.execute("INSERT INTO content_contentnode_tags VALUES (?, ?)", (self.export_node_pk, tag_id))
+
+    def test_export_tag_id_taken_by_other_channel(self):
+        other_tag = ContentTag.objects.create(tag_name="test tag", channel=mixer.blend(Channel))
+        self._add_export_tag(other_tag.id, "test tag")
+        create_node_tags(self.cursor, self.channel.id, {self.export_node_pk: self.node.id})
+        tag = self.node.tags.get()
+        self.assertEqual(tag.tag_name, "test tag")
+        self.assertEqual(tag.channel_id, self.channel.id)
+        self.assertNotEqual(tag.id, other_tag.id)
+
+    def test_export_tags_sharing_a_name(self):
+        self._add_export_tag(uuid.uuid4().hex, "test tag")
+        self._add_export_tag(uuid.uuid4().hex, "test tag")
+        create_node_tags(self.cursor, self.channel.id, {self.export_node_pk: self.node.id})
+        self.assertEqual(list(self.node.tags.values_list("tag_name", flat=True)), ["test tag"])
+        self.assertEqual(ContentTag.objects.filter(channel=self.channel).count(), 1)
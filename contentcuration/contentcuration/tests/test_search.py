@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+from django.urls import reverse
+from django.utils import timezone
+from le_utils.constants import content_kinds
+from search.models import ContentNodeFullTextSearch
+
+from contentcuration.models import ContentNode
+from contentcuration.models import ContentTag
+from contentcuration.tests import testdata
+from contentcuration.tests.base import StudioAPITestCase
+
+
+class ContentNodeFullTextSearchTestCase(StudioAPITestCase):
+    def setUp(self):
+        super(ContentNodeFullTextSearchTestCase, self).setUp()
+        self.channel = testdata.channel()
+        self.user = testdata.user()
+        self.channel.editors.add(self.user)
+        self.node = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+
+    def _search(self, keywords):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(
+            reverse("search-list"), {"keywords": keywords, "channel_list": "edit"}, format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return [item["id"] for item in response.data["results"]]
+
+    def test_index_follows_node_save(self):
+        self.node.title = "Photosynthesis in plants"
+        self.node.save()
+        index = ContentNodeFullTextSearch.objects.get(contentnode_id=self.node.id)
+        self.assertIn("photosynthesis", index.keywords_text)
+
+    def test_index_follows_tags(self):
+        tag = ContentTag.objects.create(tag_name="chlorophyll", channel=self.channel)
+        self.node.tags.add(tag)
+        self.assertIn("chlorophyll", ContentNodeFullTextSearch.objects.get(contentnode_id=self.node.id).keywords_text)
+        self.node.tags.remove(tag)
+        self.assertNotIn("chlorophyll", ContentNodeFullTextSearch.objects.get(contentnode_id=self.node.id).keywords_text)
+
+    def test_index_removed_with_node(self):
+        node_id = self.node.id
+        ContentNode.objects.filter(id=node_id).delete()
+        self.assertFalse(ContentNodeFullTextSearch.objects.filter(contentnode_id=node_id).exists())
+
+    def test_search_whole_and_partial_words(self):
+        self.node.title = "Photosynthesis in plants"
+        self.node.save()
+        self.assertIn(self.node.id, self._search("photosynthesis"))
+        self.assertIn(self.node.id, self._search("synthes"))
+        self.assertNotIn(self.node.id, self._search("astronomy"))
+
+    def test_search_ranks_title_matches_first(self):
+        nodes = list(self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC)[:2])
+        nodes[0].title = "Other"
+        nodes[0].description = "All about volcanoes"
+        nodes[0].save()
+        nodes[1].title = "Volcanoes"
+        nodes[1].save()
+        results = self._search("volcanoes")
+        self.assertLess(results.index(nodes[1].id), results.index(nodes[0].id))
+
+
+class SearchCursorPaginationTestCase(StudioAPITestCase):
+    def setUp(self):
+        super(SearchCursorPaginationTestCase, self).setUp()
+        self.channel = testdata.channel()
+        self.user = testdata.user()
+        self.channel.editors.add(self.user)
+        self.client.force_authenticate(user=self.user)
+        # nodes modified within the same millisecond, some of them at the very same time
+        modified = timezone.now()
+        for index, node_id in enumerate(self.channel.main_tree.get_descendants().values_list("id", flat=True)):
+            ContentNode.objects.filter(id=node_id).update(modified=modified + timedelta(microseconds=index // 2))
+
+    def _get(self, **params):
+        params.update({"channel_list": "edit"})
+        response = self.client.get(reverse("search-list"), params, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def test_pages_through_sub_millisecond_modified(self):
+        expected_ids = [item["id"] for item in self._get(page_size=100)["results"]]
+        ids = []
+        data = self._get(cursor="", page_size=2)
+        ids.extend(item["id"] for item in data["results"])
+        while data["next"]:
+            data = self._get(cursor=data["next"], page_size=2)
+            ids.extend(item["id"] for item in data["results"])
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(sorted(ids), sorted(expected_ids))
+
+    def test_keywords_ignore_cursor(self):
+        nodes = list(self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC)[:2])
+        nodes[0].title = "Other"
+        nodes[0].description = "All about volcanoes"
+        nodes[0].save()
+        nodes[1].title = "Volcanoes"
+        nodes[1].save()
+        data = self._get(cursor="", keywords="volcanoes")
+        self.assertNotIn("next", data)
+        results = [item["id"] for item in data["results"]]
+        self.assertLess(results.index(nodes[1].id), results.index(nodes[0].id))
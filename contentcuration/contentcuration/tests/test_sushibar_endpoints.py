@@ -183,6 +183,33 @@ class SushibarEndpointsTestCase(BaseAPITestCase):
         )
         assert not diff, "Found difference in tree structures:" + str(diff)
 
+    def test_get_tree_data_method_query_count(self):
+        main_tree = self.channel.main_tree
+        with self.assertNumQueries(3):
+            main_tree.get_tree_data()
+
+    def test_get_tree_data_method_counts_and_sizes(self):
+        main_tree = self.channel.main_tree
+        tree_data = main_tree.get_tree_data()
+        nodes = [tree_data]
+        while nodes:
+            node_data = nodes.pop()
+            node = cc.ContentNode.objects.get(id=node_data["studio_id"])
+            if node.kind_id == "topic":
+                nodes.extend(node_data["children"])
+            elif node.kind_id == "exercise":
+                assert node_data["count"] == node.assessment_items.count()
+            else:
+                expected_size = sum(f.file_size for f in node.files.all()) if node.files.exists() else None
+                assert node_data["file_size"] == expected_size
+
+    def test_get_tree_data_method_onelevel_children(self):
+        main_tree = self.channel.main_tree
+        tree_data = main_tree.get_tree_data(levels=1)
+        assert len(tree_data["children"]) == main_tree.children.count()
+        for child_data in tree_data["children"]:
+            assert "children" not in child_data
+
     def test_get_node_tree_data_endpoint(self):
         channel_id = self.channel.id
         url = reverse_lazy("get_node_tree_data")
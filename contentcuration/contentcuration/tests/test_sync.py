@@ -1,11 +1,13 @@
 from __future__ import absolute_import
 
+import mock
 from le_utils.constants import content_kinds
 
 from .base import BaseTestCase
 from .testdata import create_temp_file
 from contentcuration.models import AssessmentItem
 from contentcuration.models import Channel
+from contentcuration.models import ContentTag
 from contentcuration.utils.publish import mark_all_nodes_as_published
 from contentcuration.utils.sync import sync_channel
 
@@ -156,3 +158,60 @@ class SyncTestCase(BaseTestCase):
         self.assertEqual(target_ai.files.filter(checksum=db_file.checksum).count(), 1)
 
         self.assertTrue(self.derivative_channel.has_changes())
+
+    def _get_target_node(self, contentnode):
+        return self.derivative_channel.main_tree.get_descendants().get(
+            source_node_id=contentnode.node_id
+        )
+
+    def test_sync_attributes(self):
+        """
+        Test that calling sync_attributes syncs the metadata of the original node to the copied node.
+        """
+        contentnode = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        target_child = self._get_target_node(contentnode)
+
+        contentnode.title = "Updated title"
+        contentnode.author = "Updated author"
+        contentnode.save()
+
+        sync_channel(self.derivative_channel, sync_attributes=True)
+
+        target_child.refresh_from_db()
+        self.assertEqual(target_child.title, "Updated title")
+        self.assertEqual(target_child.author, "Updated author")
+        self.assertTrue(target_child.changed)
+        self.assertTrue(self.derivative_channel.has_changes())
+
+    def test_sync_tags(self):
+        """
+        Test that calling sync_tags adds and removes tags on the copied node to match the original node.
+        """
+        contentnode = self.channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        target_child = self._get_target_node(contentnode)
+
+        removed_tag = ContentTag.objects.create(tag_name="removed")
+        target_child.tags.add(removed_tag)
+        added_tag = ContentTag.objects.create(tag_name="added", channel=self.channel)
+        contentnode.tags.add(added_tag)
+
+        sync_channel(self.derivative_channel, sync_tags=True)
+
+        tag_names = set(target_child.tags.values_list("tag_name", flat=True))
+        self.assertIn("added", tag_names)
+        self.assertNotIn("removed", tag_names)
+        self.assertEqual(target_child.tags.get(tag_name="added").channel_id, None)
+        self.assertTrue(self.derivative_channel.has_changes())
+
+    @mock.patch("contentcuration.utils.sync.SYNC_BATCH_SIZE", 2)
+    def test_sync_channel_progress(self):
+        """
+        Test that progress is reported for every node synced, across batches.
+        """
+        progress_tracker = mock.Mock()
+
+        sync_channel(self.derivative_channel, sync_files=True, progress_tracker=progress_tracker)
+
+        total = progress_tracker.set_total.call_args[0][0]
+        self.assertEqual(total, sum(call[0][0] for call in progress_tracker.increment.call_args_list))
+        self.assertFalse(self.derivative_channel.has_changes())
@@ -4,7 +4,11 @@ import os
 import tempfile
 import zipfile
 
+import mock
+from django.conf import settings
+
 from .base import BaseTestCase
+from contentcuration.views.zip import ZIP_INDEX_CACHE_TIMEOUT
 
 
 class ZipFileTestCase(BaseTestCase):
@@ -19,16 +23,27 @@ class ZipFileTestCase(BaseTestCase):
         for temp_file in self.temp_files:
             os.remove(temp_file)
 
-    def do_create_zip(self):
+    def do_create_zip(self, files=None, compression=zipfile.ZIP_STORED):
         zip_handle, zip_filename = tempfile.mkstemp(suffix='.zip')
         self.temp_files.append(zip_filename)
         os.close(zip_handle)
 
-        with zipfile.ZipFile(zip_filename, 'w') as zip:
-            zip.writestr("index.html", "<html><head></head><body><p>Hello World!</p></body></html>")
+        files = files or {"index.html": "<html><head></head><body><p>Hello World!</p></body></html>"}
+        with zipfile.ZipFile(zip_filename, 'w', compression=compression) as zip:
+            for name, content in files.items():
+                zip.writestr(name, content)
 
         return zip_filename
 
+    def upload_zip(self, myzip):
+        self.sign_in()
+        temp_file, response = self.upload_temp_file(open(myzip, 'rb').read(), preset='html5_zip', ext='zip')
+        assert response.status_code == 200
+        return temp_file
+
+    def get_range(self, url, byte_range):
+        return self.client.get(url, HTTP_RANGE=byte_range, HTTP_USER_AGENT=settings.SUPPORTED_BROWSERS[0])
+
     def test_invalid_zip(self):
         temp_file, response = self.upload_temp_file(b"Hello!", ext="zip")
         url = '{}{}/'.format(self.zipfile_url, temp_file['name'])
@@ -74,3 +89,66 @@ class ZipFileTestCase(BaseTestCase):
         url = '{}{}/../outsidejson.js'.format(self.zipfile_url, temp_file['name'])
         response = self.get(url)
         assert response.status_code == 404
+
+    def test_stored_file_content(self):
+        temp_file = self.upload_zip(self.do_create_zip(files={"media.mp3": b"0123456789"}))
+        url = '{}{}/media.mp3'.format(self.zipfile_url, temp_file['name'])
+        response = self.get(url)
+        assert response.status_code == 200
+        assert b"".join(response.streaming_content) == b"0123456789"
+        assert response["Accept-Ranges"] == "bytes"
+        assert response["Content-Length"] == "10"
+
+    def test_stored_file_range(self):
+        temp_file = self.upload_zip(self.do_create_zip(files={"media.mp3": b"0123456789"}))
+        url = '{}{}/media.mp3'.format(self.zipfile_url, temp_file['name'])
+        response = self.get_range(url, "bytes=2-5")
+        assert response.status_code == 206
+        assert b"".join(response.streaming_content) == b"2345"
+        assert response["Content-Range"] == "bytes 2-5/10"
+        assert response["Content-Length"] == "4"
+
+    def test_stored_file_suffix_range(self):
+        temp_file = self.upload_zip(self.do_create_zip(files={"media.mp3": b"0123456789"}))
+        url = '{}{}/media.mp3'.format(self.zipfile_url, temp_file['name'])
+        response = self.get_range(url, "bytes=-3")
+        assert response.status_code == 206
+        assert b"".join(response.streaming_content) == b"789"
+        assert response["Content-Range"] == "bytes 7-9/10"
+
+    def test_stored_file_unsatisfiable_range(self):
+        temp_file = self.upload_zip(self.do_create_zip(files={"media.mp3": b"0123456789"}))
+        url = '{}{}/media.mp3'.format(self.zipfile_url, temp_file['name'])
+        response = self.get_range(url, "bytes=20-")
+        assert response.status_code == 416
+        assert response["Content-Range"] == "bytes */10"
+
+    def test_deflated_file_content(self):
+        content = b"<html><body>" + b"Hello World! " * 1000 + b"</body></html>"
+        myzip = self.do_create_zip(files={"index.html": content}, compression=zipfile.ZIP_DEFLATED)
+        temp_file = self.upload_zip(myzip)
+        url = '{}{}/index.html'.format(self.zipfile_url, temp_file['name'])
+        response = self.get_range(url, "bytes=2-5")
+        assert response.status_code == 200
+        assert b"".join(response.streaming_content) == content
+        assert response["Accept-Ranges"] == "none"
+
+    def test_zip_index_cached(self):
+        temp_file = self.upload_zip(self.do_create_zip(files={"a.js": b"a", "b.js": b"b"}))
+        url = '{}{}/'.format(self.zipfile_url, temp_file['name'])
+        response = self.get(url + "a.js")
+        assert b"".join(response.streaming_content) == b"a"
+        with mock.patch("contentcuration.views.zip.zipfile.ZipFile") as zip_file:
+            response = self.get(url + "b.js")
+            assert b"".join(response.streaming_content) == b"b"
+            zip_file.assert_not_called()
+
+    def test_zip_index_cache_expires(self):
+        temp_file = self.upload_zip(self.do_create_zip())
+        url = '{}{}/index.html'.format(self.zipfile_url, temp_file['name'])
+        with mock.patch("contentcuration.views.zip.cache") as cache:
+            cache.get.return_value = None
+            self.get(url)
+            cache.set.assert_called_once_with(
+                "zip_index_{}".format(temp_file['name']), mock.ANY, ZIP_INDEX_CACHE_TIMEOUT
+            )
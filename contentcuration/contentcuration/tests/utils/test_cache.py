@@ -4,6 +4,8 @@ from django.test import SimpleTestCase
 from ..base import mock_class_instance
 from contentcuration.models import ContentNode
 from contentcuration.utils.cache import ResourceSizeCache
+from contentcuration.utils.cache import USER_EVENTS_MAX_LENGTH
+from contentcuration.utils.cache import UserEventsCache
 
 
 class ResourceSizeCacheTestCase(SimpleTestCase):
@@ -81,3 +83,39 @@ class ResourceSizeCacheTestCase(SimpleTestCase):
         with mock.patch.object(self.helper, 'cache_set') as cache_set:
             self.helper.set_modified('2021-01-01 00:00:00')
             cache_set.assert_called_once_with(self.helper.modified_key, '2021-01-01 00:00:00')
+
+
+class UserEventsCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        super(UserEventsCacheTestCase, self).setUp()
+        self.redis_client = mock_class_instance("redis.client.StrictRedis")
+        self.pipeline = mock.Mock()
+        self.redis_client.pipeline.return_value = self.pipeline
+        self.cache_client = mock_class_instance("django_redis.client.DefaultClient")
+        self.cache_client.get_client.return_value = self.redis_client
+        self.cache = mock.Mock(client=self.cache_client)
+        self.helper = UserEventsCache("user_changes_1", self.cache)
+
+    def test_add_events(self):
+        self.helper.add_events([{"key": "a"}, {"key": "b"}])
+        self.pipeline.rpush.assert_called_once_with("user_changes_1", '{"key": "a"}', '{"key": "b"}')
+        self.pipeline.ltrim.assert_called_once_with("user_changes_1", -USER_EVENTS_MAX_LENGTH, -1)
+        self.pipeline.execute.assert_called_once_with()
+
+    def test_add_events__not_redis(self):
+        self.cache.client = mock.Mock()
+        self.cache.get.return_value = ['{"key": "a"}']
+        self.helper.add_events([{"key": "b"}])
+        self.cache.set.assert_called_once_with("user_changes_1", ['{"key": "a"}', '{"key": "b"}'], None)
+
+    def test_read_events(self):
+        self.pipeline.execute.return_value = [['{"key": "a"}', '{"key": "b"}'], True]
+        self.assertEqual([{"key": "a"}, {"key": "b"}], self.helper.read_events(count=10))
+        self.pipeline.lrange.assert_called_once_with("user_changes_1", 0, 9)
+        self.pipeline.ltrim.assert_called_once_with("user_changes_1", 10, -1)
+
+    def test_read_events__not_redis(self):
+        self.cache.client = mock.Mock()
+        self.cache.get.return_value = ['{"key": "a"}', '{"key": "b"}', '{"key": "c"}']
+        self.assertEqual([{"key": "a"}, {"key": "b"}], self.helper.read_events(count=2))
+        self.cache.set.assert_called_once_with("user_changes_1", ['{"key": "c"}'], None)
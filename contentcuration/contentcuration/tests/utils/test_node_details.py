@@ -0,0 +1,93 @@
+from le_utils.constants import content_kinds
+
+from ..base import StudioTestCase
+from .. import testdata
+from contentcuration.models import ContentNode
+from contentcuration.models import ContentNodeDetails
+from contentcuration.models import ContentTag
+from contentcuration.models import File
+from contentcuration.utils.node_details import refresh_node_details
+
+
+class RefreshNodeDetailsTestCase(StudioTestCase):
+    def setUp(self):
+        super(RefreshNodeDetailsTestCase, self).setUp()
+        self.channel = testdata.channel()
+        self.root = self.channel.main_tree
+        refresh_node_details(self.root)
+
+    def _get_aggregates(self, node):
+        return ContentNodeDetails.objects.get(contentnode=node).aggregates
+
+    def _assert_matches_full_refresh(self):
+        aggregates = self._get_aggregates(self.root)
+        ContentNodeDetails.objects.filter(tree_id=self.root.tree_id).delete()
+        refresh_node_details(self.root)
+        self.assertEqual(aggregates, self._get_aggregates(self.root))
+
+    def test_details(self):
+        resources = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC)
+        aggregates = self._get_aggregates(self.root)
+        self.assertEqual(aggregates["resource_count"], resources.count())
+        self.assertGreater(aggregates["resource_size"], 0)
+        self.assertEqual(
+            aggregates["kind_count"],
+            {kind_id: resources.filter(kind_id=kind_id).count() for kind_id in resources.values_list("kind_id", flat=True)},
+        )
+
+    def test_edit_only_marks_ancestors_stale(self):
+        resource = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC).filter(level__gt=1).first()
+        resource.author = "new author"
+        resource.save()
+
+        stale_ids = set(ContentNodeDetails.objects.filter(stale=True).values_list("contentnode_id", flat=True))
+        self.assertEqual(stale_ids, set(resource.get_ancestors().values_list("id", flat=True)))
+
+        refresh_node_details(self.root)
+        self.assertFalse(ContentNodeDetails.objects.filter(stale=True).exists())
+        self.assertIn("new author", self._get_aggregates(self.root)["authors"])
+        self._assert_matches_full_refresh()
+
+    def test_mark_incomplete(self):
+        resource = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC).filter(level__gt=1).first()
+        File.objects.create(contentnode=resource, checksum="a" * 32, file_size=100)
+        refresh_node_details(self.root)
+        size = self._get_aggregates(resource.parent)["resource_size"]
+
+        # only complete resources count towards the size
+        ContentNode.objects.filter(pk=resource.pk).update(complete=False)
+        stale_ids = set(ContentNodeDetails.objects.filter(stale=True).values_list("contentnode_id", flat=True))
+        self.assertEqual(stale_ids, set(resource.get_ancestors().values_list("id", flat=True)))
+
+        refresh_node_details(self.root)
+        self.assertLessEqual(self._get_aggregates(resource.parent)["resource_size"], size - 100)
+        self._assert_matches_full_refresh()
+
+    def test_add_tag(self):
+        resource = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        resource.tags.add(ContentTag.objects.create(tag_name="details tag"))
+        refresh_node_details(self.root)
+        self.assertEqual(self._get_aggregates(self.root)["tags"].get("details tag"), 1)
+        self._assert_matches_full_refresh()
+
+    def test_move_between_topics(self):
+        resource = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC).filter(level__gt=1).first()
+        new_topic = ContentNode.objects.create(title="new topic", kind_id=content_kinds.TOPIC, parent=self.root)
+        ContentNode.objects.get(pk=resource.pk).move_to(new_topic, "last-child")
+        refresh_node_details(self.root)
+        self.assertEqual(self._get_aggregates(ContentNode.objects.get(pk=new_topic.pk))["resource_count"], 1)
+        self._assert_matches_full_refresh()
+
+    def test_delete_resource(self):
+        resources = self.root.get_descendants().exclude(kind_id=content_kinds.TOPIC)
+        count = resources.count()
+        resources.first().delete()
+        refresh_node_details(self.root)
+        self.assertEqual(self._get_aggregates(self.root)["resource_count"], count - 1)
+        self._assert_matches_full_refresh()
+
+    def test_etag_unchanged_without_edits(self):
+        _, etag = refresh_node_details(self.root)
+        ContentNodeDetails.objects.filter(contentnode=self.root).update(data=None)
+        _, new_etag = refresh_node_details(self.root)
+        self.assertEqual(etag, new_etag)
@@ -7,10 +7,17 @@ from dateutil.parser import isoparse
 from django.db.models import F
 from django.db.models import Max
 from django.test import SimpleTestCase
+from le_utils.constants import content_kinds
 
+from .. import testdata
 from ..base import BaseTestCase
 from contentcuration.models import ContentNode
+from contentcuration.models import File
+from contentcuration.models import TreeChecksumDelta
+from contentcuration.models import TreeResourceSize
 from contentcuration.utils.nodes import calculate_resource_size
+from contentcuration.utils.nodes import generate_diff
+from contentcuration.utils.nodes import get_diff
 from contentcuration.utils.nodes import ResourceSizeHelper
 from contentcuration.utils.nodes import SlowCalculationError
 from contentcuration.utils.nodes import STALE_MAX_CALCULATION_SIZE
@@ -46,6 +53,7 @@ class CalculateResourceSizeTestCase(SimpleTestCase):
     def setUp(self):
         super(CalculateResourceSizeTestCase, self).setUp()
         self.node = mock.Mock(spec_set=ContentNode())
+        self.node.is_root_node.return_value = False
 
     def assertCalculation(self, cache, helper, force=False):
         helper().get_size.return_value = 456
@@ -115,6 +123,106 @@ class CalculateResourceSizeTestCase(SimpleTestCase):
             self.assertIsInstance(report_exception.mock_calls[0][1][0], SlowCalculationError)
 
 
+@mock.patch("contentcuration.utils.nodes.TreeResourceSize")
+class CalculateResourceSizeRootTestCase(SimpleTestCase):
+    def setUp(self):
+        super(CalculateResourceSizeRootTestCase, self).setUp()
+        self.node = mock.Mock(spec_set=ContentNode())
+        self.node.is_root_node.return_value = True
+        self.node.tree_id = 12
+
+    def test_maintained(self, tree_size):
+        tree_size.get_size.return_value = 123
+        size, stale = calculate_resource_size(self.node)
+        self.assertEqual(123, size)
+        self.assertFalse(stale)
+        tree_size.get_size.assert_called_once_with(12)
+        tree_size.rebuild.assert_not_called()
+
+    def test_forced(self, tree_size):
+        tree_size.rebuild.return_value = 456
+        size, stale = calculate_resource_size(self.node, force=True)
+        self.assertEqual(456, size)
+        self.assertFalse(stale)
+        tree_size.rebuild.assert_called_once_with(12)
+
+
+class TreeResourceSizeTestCase(BaseTestCase):
+    def setUp(self):
+        super(TreeResourceSizeTestCase, self).setUp()
+        self.root = self.channel.main_tree
+        self.node = self.root.get_descendants().filter(files__isnull=False).first()
+
+    def get_size(self):
+        return TreeResourceSize.get_size(self.root.tree_id)
+
+    def test_matches_calculation(self):
+        self.assertEqual(ResourceSizeHelper(self.root).get_size(), self.get_size())
+
+    def test_file_added_and_removed(self):
+        size = self.get_size()
+        new_file = File.objects.create(contentnode=self.node, checksum="a" * 32, file_size=100)
+        self.assertEqual(size + 100, self.get_size())
+        new_file.delete()
+        self.assertEqual(size, self.get_size())
+
+    def test_file_changes_queued(self):
+        size = self.get_size()
+        File.objects.create(contentnode=self.node, checksum="a" * 32, file_size=100)
+        File.objects.create(contentnode=self.node, checksum="b" * 32, file_size=50)
+        self.assertEqual(TreeChecksumDelta.objects.filter(tree_id=self.root.tree_id).count(), 2)
+        self.assertEqual(size, TreeResourceSize.objects.get(tree_id=self.root.tree_id).resource_size)
+        TreeResourceSize.apply_deltas()
+        self.assertFalse(TreeChecksumDelta.objects.filter(tree_id=self.root.tree_id).exists())
+        self.assertEqual(size + 150, TreeResourceSize.objects.get(tree_id=self.root.tree_id).resource_size)
+
+    def test_duplicate_checksum_counted_once(self):
+        size = self.get_size()
+        File.objects.create(contentnode=self.node, checksum="a" * 32, file_size=100)
+        duplicate = File.objects.create(contentnode=self.root, checksum="a" * 32, file_size=100)
+        self.assertEqual(size + 100, self.get_size())
+        duplicate.delete()
+        self.assertEqual(size + 100, self.get_size())
+
+    def test_node_incomplete(self):
+        self.node.complete = False
+        self.node.save()
+        self.assertEqual(ResourceSizeHelper(self.root).get_size() or 0, self.get_size())
+        self.node.complete = True
+        self.node.save()
+        self.assertEqual(ResourceSizeHelper(self.root).get_size(), self.get_size())
+
+    def test_node_moved(self):
+        other_channel = testdata.channel()
+        other_root = other_channel.main_tree
+        other_size = TreeResourceSize.get_size(other_root.tree_id)
+        self.node.move_to(other_root, "last-child")
+        self.root.refresh_from_db()
+        other_root.refresh_from_db()
+        self.assertEqual(ResourceSizeHelper(self.root).get_size() or 0, self.get_size())
+        self.assertEqual(ResourceSizeHelper(other_root).get_size(), TreeResourceSize.get_size(other_root.tree_id))
+        self.assertGreaterEqual(TreeResourceSize.get_size(other_root.tree_id), other_size)
+
+    def test_node_copied(self):
+        other_channel = testdata.channel()
+        other_root = other_channel.main_tree
+        self.node.copy_to(other_root)
+        other_root.refresh_from_db()
+        self.assertEqual(ResourceSizeHelper(other_root).get_size(), TreeResourceSize.get_size(other_root.tree_id))
+
+    def test_rebuild_drops_queued_deltas(self):
+        File.objects.create(contentnode=self.node, checksum="a" * 32, file_size=100)
+        size = TreeResourceSize.rebuild(self.root.tree_id)
+        self.assertFalse(TreeChecksumDelta.objects.filter(tree_id=self.root.tree_id).exists())
+        self.assertEqual(ResourceSizeHelper(self.root).get_size(), size)
+
+    def test_rebuild(self):
+        size = self.get_size()
+        TreeResourceSize.objects.filter(tree_id=self.root.tree_id).update(resource_size=0)
+        self.assertEqual(size, TreeResourceSize.rebuild(self.root.tree_id))
+        self.assertEqual(size, self.get_size())
+
+
 class CalculateResourceSizeIntegrationTestCase(BaseTestCase):
     """
     Integration test case
@@ -132,3 +240,45 @@ class CalculateResourceSizeIntegrationTestCase(BaseTestCase):
         size, stale = calculate_resource_size(self.root)
         self.assertEqual(10, size)
         self.assertFalse(stale)
+
+
+class GenerateDiffTestCase(BaseTestCase):
+    def setUp(self):
+        super(GenerateDiffTestCase, self).setUp()
+        self.original = self.channel.main_tree
+        self.updated = self.original.copy()
+        # staging trees keep the node_ids of the nodes they update
+        ContentNode.objects.filter(tree_id=self.updated.tree_id).update(node_id=F("source_node_id"))
+
+    def get_stat(self, diff, field):
+        return next(stat for stat in diff["stats"] if stat["field"] == field)
+
+    def test_unchanged(self):
+        diff = generate_diff(self.updated.pk, self.original.pk, include_nodes=True)
+        resource_count = self.original.get_descendants().exclude(kind_id=content_kinds.TOPIC).count()
+        self.assertEqual(resource_count, self.get_stat(diff, "count_resources")["original"])
+        for stat in diff["stats"][2:]:
+            self.assertEqual(0, stat["difference"])
+        self.assertEqual({"added": {}, "removed": {}, "changed": {}}, diff["nodes"])
+
+    def test_changed(self):
+        removed = self.updated.get_descendants().filter(kind_id=content_kinds.VIDEO).first()
+        removed.delete()
+        changed = self.updated.get_descendants().exclude(kind_id=content_kinds.TOPIC).first()
+        changed.title = "Changed title"
+        changed.save()
+        added = testdata.node(
+            {"kind_id": content_kinds.VIDEO, "title": "Added video", "node_id": "a" * 32}, parent=self.updated
+        )
+
+        diff = generate_diff(self.updated.pk, self.original.pk, include_nodes=True)
+        self.assertEqual(0, self.get_stat(diff, "count_resources")["difference"])
+        self.assertEqual(0, self.get_stat(diff, "count_videos")["difference"])
+        self.assertEqual([removed.node_id], list(diff["nodes"]["removed"]))
+        self.assertEqual([added.node_id], list(diff["nodes"]["added"]))
+        self.assertEqual(["title"], diff["nodes"]["changed"][changed.node_id]["fields"])
+
+    def test_nodes_not_included(self):
+        diff = generate_diff(self.updated.pk, self.original.pk)
+        self.assertNotIn("nodes", diff)
+        self.assertEqual(diff, get_diff(self.updated, self.original))
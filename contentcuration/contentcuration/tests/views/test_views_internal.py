@@ -24,6 +24,7 @@ from ..testdata import user
 from contentcuration import ricecooker_versions as rc
 from contentcuration.models import Channel
 from contentcuration.models import ContentNode
+from contentcuration.models import ContentTag
 from contentcuration.views import internal
 
 
@@ -177,6 +178,91 @@ class ApiAddNodesToTreeTestCase(StudioTestCase):
         self.assertFalse(node_3.complete)
 
 
+class ApiAddSubtreeToTreeTestCase(StudioTestCase):
+    """
+    Tests for contentcuration.views.internal.api_add_nodes_to_tree function for nodes
+    sent along with their children.
+    """
+
+    def setUp(self):
+        super(ApiAddSubtreeToTreeTestCase, self).setUp()
+        self.channel = channel()
+        self.root_node = self.channel.main_tree
+        self.fileobj = fileobj_video()
+
+    def _make_node_data(self, kind="document", children=None, tags=None):
+        random_data = mixer.blend(SampleContentNodeDataSchema)
+        node_data = {
+            "title": random_data.title,
+            "language": "en",
+            "description": random_data.description,
+            "node_id": uuid.uuid4().hex,
+            "content_id": uuid.uuid4().hex,
+            "source_domain": random_data.source_domain,
+            "source_id": random_data.source_id,
+            "author": random_data.author,
+            "files": [],
+            "kind": kind,
+            "license": "CC BY",
+            "license_description": None,
+            "copyright_holder": random_data.copyright_holder,
+            "questions": [],
+            "extra_fields": "{}",
+            "role": "learner",
+            "tags": tags or [],
+        }
+        if kind != "topic":
+            node_data["files"] = [
+                {
+                    "size": self.fileobj.file_size,
+                    "preset": "video",
+                    "filename": self.fileobj.filename(),
+                    "original_filename": self.fileobj.original_filename,
+                    "language": None,
+                    "source_url": self.fileobj.source_url,
+                }
+            ]
+        if children is not None:
+            node_data["children"] = children
+        return node_data
+
+    def test_creates_subtree(self):
+        leaves = [self._make_node_data(tags=["a", "b"]) for _ in range(3)]
+        subtopic = self._make_node_data(kind="topic", children=leaves[1:])
+        topic = self._make_node_data(kind="topic", children=[leaves[0], subtopic])
+        sibling = self._make_node_data(tags=["b"])
+
+        response = self.admin_client().post(
+            reverse_lazy("api_add_nodes_to_tree"),
+            data={"root_id": self.root_node.id, "content_data": [topic, sibling]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            set(response.data["root_ids"].keys()), {topic["node_id"], sibling["node_id"]}
+        )
+
+        topic_node = ContentNode.objects.get(node_id=topic["node_id"])
+        subtopic_node = ContentNode.objects.get(node_id=subtopic["node_id"])
+        self.assertEqual(topic_node.parent_id, self.root_node.id)
+        self.assertEqual(subtopic_node.parent_id, topic_node.id)
+        self.assertEqual(
+            list(subtopic_node.get_children().values_list("node_id", flat=True)),
+            [leaf["node_id"] for leaf in leaves[1:]],
+        )
+        for leaf in leaves:
+            leaf_node = ContentNode.objects.get(node_id=leaf["node_id"])
+            self.assertEqual(leaf_node.files.count(), 1)
+            self.assertEqual(set(leaf_node.tags.values_list("tag_name", flat=True)), {"a", "b"})
+
+        # The mptt fields built in memory must leave the whole tree consistent
+        self.root_node.refresh_from_db()
+        self.assertEqual(self.root_node.rght, 2 * self.root_node.get_descendants(include_self=True).count())
+        self.assertEqual(topic_node.get_descendants().count(), 4)
+        self.assertEqual(subtopic_node.level, self.root_node.level + 2)
+        self.assertEqual(ContentTag.objects.filter(channel=self.channel, tag_name="b").count(), 1)
+
+
 class ApiAddExerciseNodesToTreeTestCase(StudioTestCase):
     """
     Tests for contentcuration.views.internal.api_add_nodes_to_tree function for nodes
@@ -2,11 +2,16 @@ from __future__ import absolute_import
 
 import uuid
 
+import mock
+from django.core.cache import cache
+from django.db import connection
 from django.urls import reverse
 
 from contentcuration import models
 from contentcuration.tests import testdata
 from contentcuration.tests.base import StudioAPITestCase
+from contentcuration.utils.nodes import ResourceSizeHelper
+from contentcuration.viewsets.channel import ChannelViewSet
 from contentcuration.viewsets.sync.constants import CHANNEL
 from contentcuration.viewsets.sync.utils import generate_create_event
 from contentcuration.viewsets.sync.utils import generate_delete_event
@@ -80,6 +85,36 @@ class SyncTestCase(StudioAPITestCase):
         self.assertEqual(response.status_code, 200, response.content)
         self.assertEqual(models.Channel.objects.get(id=channel.id).name, new_name)
 
+    def test_update_channels_database_error(self):
+        user = testdata.user()
+        failing_channel = models.Channel.objects.create(**self.channel_metadata)
+        failing_channel.editors.add(user)
+        channel = models.Channel.objects.create(**self.channel_metadata)
+        channel.editors.add(user)
+        new_name = "This is not the old name"
+        perform_update = ChannelViewSet.perform_update
+
+        def fail_on_first_channel(viewset, serializer):
+            if serializer.instance.id == failing_channel.id:
+                # a database error aborts the transaction until it is rolled back
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1 / 0")
+            perform_update(viewset, serializer)
+
+        self.client.force_authenticate(user=user)
+        with mock.patch.object(ChannelViewSet, "perform_update", fail_on_first_channel):
+            response = self.client.post(
+                self.sync_url,
+                [
+                    generate_update_event(failing_channel.id, CHANNEL, {"name": new_name}),
+                    generate_update_event(channel.id, CHANNEL, {"name": new_name}),
+                ],
+                format="json",
+            )
+        self.assertEqual(response.status_code, 207, response.content)
+        self.assertEqual([error["key"] for error in response.data["errors"]], [failing_channel.id])
+        self.assertEqual(models.Channel.objects.get(id=channel.id).name, new_name)
+
     def test_update_channel_thumbnail_encoding(self):
         user = testdata.user()
         channel = models.Channel.objects.create(**self.channel_metadata)
@@ -453,6 +488,22 @@ class CRUDTestCase(StudioAPITestCase):
         )
         self.assertEqual(response.status_code, 200, response.content)
 
+    def test_fetch_admin_channel_size_of_complete_resources(self):
+        cache.clear()
+        channel = testdata.channel()
+        node = channel.main_tree.get_descendants().filter(files__isnull=False).first()
+        models.ContentNode.objects.filter(pk=node.pk).update(complete=False)
+        user = testdata.user()
+        user.is_admin = True
+        user.is_staff = True
+        user.save()
+        self.client.force_authenticate(user=user)
+        response = self.client.get(
+            reverse("admin-channels-detail", kwargs={"pk": channel.id}), format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["size"], ResourceSizeHelper(channel.main_tree).get_size() or 0)
+
     def test_fetch_admin_channels_invalid_filter(self):
         models.Channel.objects.create(**self.channel_metadata)
         user = testdata.user()
@@ -465,6 +516,23 @@ class CRUDTestCase(StudioAPITestCase):
         )
         self.assertEqual(response.status_code, 200, response.content)
 
+    @mock.patch("contentcuration.tasks.refresh_channel_summaries_task.apply_async")
+    def test_fetch_channel_queues_summary_refresh(self, apply_async):
+        cache.clear()
+        channel = testdata.channel()
+        user = testdata.user()
+        channel.editors.add(user)
+        self.client.force_authenticate(user=user)
+        url = reverse("channel-detail", kwargs={"pk": channel.id})
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertFalse(models.ChannelSummary.objects.filter(channel=channel).exists())
+        apply_async.assert_called_once_with(([channel.id],), countdown=mock.ANY)
+        # a refresh is already queued for the channel
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        apply_async.assert_called_once()
+
     def test_create_channel(self):
         user = testdata.user()
         self.client.force_authenticate(user=user)
@@ -506,3 +574,49 @@ class CRUDTestCase(StudioAPITestCase):
             self.fail("Channel was not deleted")
         except models.Channel.DoesNotExist:
             pass
+
+
+class CatalogCursorPaginationTestCase(StudioAPITestCase):
+    def setUp(self):
+        super(CatalogCursorPaginationTestCase, self).setUp()
+        # The catalog is cached by url
+        cache.clear()
+        for name in ("b", "a", "c", "a", "d"):
+            models.Channel.objects.create(name=name, public=True)
+        self.expected_ids = list(
+            models.Channel.objects.filter(public=True, deleted=False).order_by("name", "pk").values_list("id", flat=True)
+        )
+
+    def _get(self, cursor="", **params):
+        params.update({"cursor": cursor, "page_size": 2})
+        response = self.client.get(reverse("catalog-list"), params, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def test_pages_forward(self):
+        ids = []
+        data = self._get()
+        self.assertIsNone(data["previous"])
+        ids.extend(item["id"] for item in data["results"])
+        while data["next"]:
+            data = self._get(data["next"])
+            ids.extend(item["id"] for item in data["results"])
+        self.assertEqual(ids, self.expected_ids)
+
+    def test_pages_backward(self):
+        first = self._get()
+        second = self._get(first["next"])
+        previous = self._get(second["previous"])
+        self.assertEqual(
+            [item["id"] for item in previous["results"]],
+            [item["id"] for item in first["results"]],
+        )
+        self.assertIsNotNone(previous["next"])
+
+    def test_count_optional(self):
+        self.assertNotIn("count", self._get())
+        self.assertEqual(self._get(count="true")["count"], len(self.expected_ids))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("catalog-list"), {"cursor": "not a cursor"}, format="json")
+        self.assertEqual(response.status_code, 404, response.content)
@@ -542,6 +542,41 @@ class SyncTestCase(StudioAPITestCase):
             models.ContentNode.objects.get(id=contentnode.id).title, new_title
         )
 
+    def test_update_contentnode_successive_updates(self):
+        user = testdata.user()
+        contentnode = models.ContentNode.objects.create(**self.contentnode_db_metadata)
+
+        self.client.force_authenticate(user=user)
+        response = self.client.post(
+            self.sync_url,
+            [
+                generate_update_event(contentnode.id, CONTENTNODE, {"title": "T"}),
+                generate_update_event(contentnode.id, CONTENTNODE, {"title": "Ti", "description": "D"}),
+                generate_update_event(contentnode.id, CONTENTNODE, {"title": "Title"}),
+            ],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        contentnode = models.ContentNode.objects.get(id=contentnode.id)
+        self.assertEqual(contentnode.title, "Title")
+        self.assertEqual(contentnode.description, "D")
+
+    def test_create_and_delete_contentnode(self):
+        user = testdata.user()
+        contentnode = self.contentnode_metadata
+
+        self.client.force_authenticate(user=user)
+        response = self.client.post(
+            self.sync_url,
+            [
+                generate_create_event(contentnode["id"], CONTENTNODE, contentnode),
+                generate_delete_event(contentnode["id"], CONTENTNODE),
+            ],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertFalse(models.ContentNode.objects.filter(id=contentnode["id"]).exists())
+
     def test_cannot_update_contentnode(self):
         user = testdata.user()
         channel = testdata.channel()
@@ -565,6 +600,22 @@ class SyncTestCase(StudioAPITestCase):
             models.ContentNode.objects.get(id=contentnode.id).title, new_title
         )
 
+    def test_cannot_update_contentnode_successive_updates(self):
+        user = testdata.user()
+        channel = testdata.channel()
+        contentnode = create_and_get_contentnode(channel.main_tree_id)
+        changes = [
+            dict(generate_update_event(contentnode.id, CONTENTNODE, {"title": "T"}), rev=1),
+            dict(generate_update_event(contentnode.id, CONTENTNODE, {"title": "Title"}), rev=2),
+        ]
+
+        self.client.force_authenticate(user=user)
+        with self.settings(TEST_ENV=False):
+            response = self.client.post(self.sync_url, changes, format="json")
+
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(sorted(error["rev"] for error in response.data["errors"]), [1, 2])
+
     def test_update_contentnode_extra_fields(self):
         user = testdata.user()
         contentnode = models.ContentNode.objects.create(**self.contentnode_db_metadata)
@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+
+from contentcuration.viewsets.sync.constants import ASSESSMENTITEM
+from contentcuration.viewsets.sync.constants import CONTENTNODE
+from contentcuration.viewsets.sync.endpoint import coalesce_changes
+from contentcuration.viewsets.sync.endpoint import get_merge_key
+from contentcuration.viewsets.sync.utils import generate_create_event
+from contentcuration.viewsets.sync.utils import generate_delete_event
+from contentcuration.viewsets.sync.utils import generate_move_event
+from contentcuration.viewsets.sync.utils import generate_update_event
+
+
+class CoalesceChangesTestCase(SimpleTestCase):
+    def test_merges_successive_updates(self):
+        changes = [
+            generate_update_event("a", CONTENTNODE, {"title": "t"}),
+            generate_update_event("a", CONTENTNODE, {"title": "ti", "description": "d"}),
+            generate_update_event("b", CONTENTNODE, {"title": "other"}),
+            generate_update_event("a", CONTENTNODE, {"title": "tit"}),
+        ]
+        coalesced, merged = coalesce_changes(changes)
+        self.assertEqual(len(coalesced), 2)
+        self.assertEqual(coalesced[0]["mods"], {"title": "tit", "description": "d"})
+        self.assertEqual(coalesced[1], changes[2])
+        self.assertEqual(merged[get_merge_key(coalesced[0])], [changes[0], changes[1], changes[3]])
+
+    def test_does_not_merge_updates_across_other_changes(self):
+        changes = [
+            generate_update_event("a", CONTENTNODE, {"title": "t"}),
+            generate_move_event("a", CONTENTNODE, "b", "last-child"),
+            generate_update_event("a", CONTENTNODE, {"title": "ti"}),
+        ]
+        coalesced, merged = coalesce_changes(changes)
+        self.assertEqual(coalesced, changes)
+        self.assertEqual(merged, {})
+
+    def test_does_not_merge_nested_update_after_whole_field(self):
+        changes = [
+            generate_update_event("a", CONTENTNODE, {"extra_fields": {"m": 1, "n": 2}}),
+            generate_update_event("a", CONTENTNODE, {"extra_fields.m": 3}),
+        ]
+        coalesced, _ = coalesce_changes(changes)
+        self.assertEqual(coalesced, changes)
+
+    def test_whole_field_update_replaces_nested_updates(self):
+        changes = [
+            generate_update_event("a", CONTENTNODE, {"extra_fields.m": 3}),
+            generate_update_event("a", CONTENTNODE, {"extra_fields": {"m": 1}}),
+        ]
+        coalesced, _ = coalesce_changes(changes)
+        self.assertEqual(coalesced[0]["mods"], {"extra_fields": {"m": 1}})
+
+    def test_drops_created_then_deleted(self):
+        changes = [
+            generate_create_event("a", CONTENTNODE, {"title": "t"}),
+            generate_update_event("a", CONTENTNODE, {"title": "ti"}),
+            generate_delete_event("a", CONTENTNODE),
+            generate_update_event("b", CONTENTNODE, {"title": "other"}),
+        ]
+        coalesced, _ = coalesce_changes(changes)
+        self.assertEqual(coalesced, [changes[3]])
+
+    def test_keeps_created_then_deleted_when_referenced(self):
+        changes = [
+            generate_create_event("a", CONTENTNODE, {"title": "t"}),
+            generate_create_event(["a", "y"], ASSESSMENTITEM, {"question": "q"}),
+            generate_delete_event("a", CONTENTNODE),
+        ]
+        coalesced, _ = coalesce_changes(changes)
+        self.assertEqual(coalesced, changes)
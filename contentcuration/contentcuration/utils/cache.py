@@ -1,4 +1,5 @@
 import functools
+import json
 import math
 import random
 import time
@@ -6,6 +7,7 @@ from datetime import datetime
 
 from dateutil.parser import isoparse
 from django.core.cache import cache as django_cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django_redis.client import DefaultClient
 from django_redis.client.default import _main_exceptions
 
@@ -219,3 +221,72 @@ class ResourceSizeCache:
         current_modified = self.get_modified()
         if current_modified and current_modified > modified:
             return self.set_modified(modified)
+
+
+# Number of events kept for each user, the oldest events are dropped past this
+USER_EVENTS_MAX_LENGTH = 1000
+# Number of events handed to a user by each read
+USER_EVENTS_READ_SIZE = 500
+
+
+class UserEventsCache:
+    """
+    Helper class for managing the events waiting to be sent to a user by the sync endpoint.
+
+    If the django_cache is Redis, then we use the lower level Redis client to keep the events
+    in a list, so that they can be appended and read atomically with RPUSH, LRANGE and LTRIM,
+    without rewriting every pending event on each change.
+    """
+    def __init__(self, key, cache=None):
+        self.key = key
+        self.cache = cache or django_cache
+
+    @property
+    def redis_client(self):
+        """
+        Gets the lower level Redis client, if the cache is a Redis cache
+
+        :rtype: redis.client.StrictRedis
+        """
+        redis_client = None
+        cache_client = getattr(self.cache, 'client', None)
+        if isinstance(cache_client, DefaultClient):
+            redis_client = cache_client.get_client(write=True)
+        return redis_client
+
+    @redis_retry
+    def add_events(self, events):
+        events = [json.dumps(event, cls=DjangoJSONEncoder) for event in events]
+        if not events:
+            return
+        if self.redis_client is not None:
+            # See: https://redis.io/commands/rpush
+            # See: https://redis.io/commands/ltrim
+            pipeline = self.redis_client.pipeline()
+            pipeline.rpush(self.key, *events)
+            pipeline.ltrim(self.key, -USER_EVENTS_MAX_LENGTH, -1)
+            pipeline.execute()
+            return
+        pending = self.cache.get(self.key) or []
+        self.cache.set(self.key, (pending + events)[-USER_EVENTS_MAX_LENGTH:], None)
+
+    @redis_retry
+    def read_events(self, count=USER_EVENTS_READ_SIZE):
+        """
+        Removes and returns up to `count` of the oldest events, leaving the rest for the next read
+        """
+        if self.redis_client is not None:
+            # The pipeline runs as a transaction, so no event can be dropped in between
+            # See: https://redis.io/commands/lrange
+            pipeline = self.redis_client.pipeline()
+            pipeline.lrange(self.key, 0, count - 1)
+            pipeline.ltrim(self.key, count, -1)
+            events, _ = pipeline.execute()
+        else:
+            pending = self.cache.get(self.key) or []
+            events = pending[:count]
+            if len(pending) > count:
+                self.cache.set(self.key, pending[count:], None)
+            else:
+                self.cache.delete(self.key)
+        return [json.loads(event) for event in events]
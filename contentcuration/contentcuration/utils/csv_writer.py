@@ -7,7 +7,7 @@ import re
 import sys
 import time
 from builtins import next
-from time import sleep
+from collections import defaultdict
 
 import progressbar
 from django.conf import settings
@@ -15,18 +15,42 @@ from django.contrib.sites.models import Site
 from django.db.models import OuterRef
 from django.db.models import Q
 from django.db.models import Subquery
-from django.db.models import Sum
 from django.utils.translation import gettext as _
 from le_utils.constants import content_kinds
 from le_utils.constants import exercises
 
+from contentcuration.models import AssessmentItem
 from contentcuration.models import Channel
+from contentcuration.models import ContentNode
+from contentcuration.models import File
 from contentcuration.models import generate_storage_url
 
 if not os.path.exists(settings.CSV_ROOT):
     os.makedirs(settings.CSV_ROOT)
 
 
+# Number of resources whose files, tags and questions are read together
+CSV_BATCH_SIZE = 500
+
+CHANNEL_CSV_HEADER = ['Path', 'Title', 'Kind', 'Description', 'URL', 'Author', 'Language', 'License',
+                      'License Description', 'Copyright Holder', 'File Size', 'Tags', 'Questions (if exercise)']
+
+channel_csv_node_values = (
+    'id',
+    'node_id',
+    'title',
+    'kind_id',
+    'description',
+    'author',
+    'license_description',
+    'copyright_holder',
+    'language__readable_name',
+    'license__license_name',
+    'lft',
+    'rght',
+)
+
+
 def write_channel_csv_file(channel, force=False, site=None, show_progress=False):
     csv_path = _generate_csv_filename(channel)
 
@@ -37,47 +61,105 @@ def write_channel_csv_file(channel, force=False, site=None, show_progress=False)
         with io.open(csv_path, mode, encoding='utf-8') as csvfile:
             writer = csv.writer(csvfile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
             site = site or Site.objects.get(pk=1).domain
-            writer.writerow(['Path', 'Title', 'Kind', 'Description', 'URL', 'Author', 'Language', 'License',
-                             'License Description', 'Copyright Holder', 'File Size', 'Tags', 'Questions (if exercise)'])
+            writer.writerow(CHANNEL_CSV_HEADER)
 
-            nodes = channel.main_tree.get_descendants()\
-                .exclude(kind_id=content_kinds.TOPIC)\
-                .select_related('license', 'language', 'parent')\
-                .prefetch_related('files', 'assessment_items', 'tags')
+            rows = iter_channel_csv_rows(channel, site)
             if show_progress:
-                bar = progressbar.ProgressBar(max_value=nodes.count())
-
-            index = 0
-            for node in nodes:
-                _write_content_csv(writer, node, site)
-                if show_progress:
-                    index += 1
-                    bar.update(index)
-                    sleep(0.01)
+                bar = progressbar.ProgressBar(
+                    max_value=channel.main_tree.get_descendants().exclude(kind_id=content_kinds.TOPIC).count()
+                )
+                rows = bar(rows)
+            writer.writerows(rows)
 
     return csv_path
 
 
+class _Echo(object):
+    """ File-like object that returns what is written to it, so csv rows can be streamed """
+    def write(self, value):
+        return value
+
+
+def stream_channel_csv(channel, site=None):
+    """
+    Generates the channel CSV line by line, for use with a StreamingHttpResponse
+    """
+    writer = csv.writer(_Echo(), delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    site = site or Site.objects.get(pk=1).domain
+    yield writer.writerow(CHANNEL_CSV_HEADER)
+    for row in iter_channel_csv_rows(channel, site):
+        yield writer.writerow(row)
+
+
+def iter_channel_csv_rows(channel, site):
+    """
+    Generates the CSV rows of the resources of a channel, in tree order.
+
+    The main tree is read once in lft order, keeping the titles of the topics above the
+    current node on a stack for the paths, and the files, tags and questions of the
+    resources are read for a batch of resources at a time.
+    """
+    root = channel.main_tree
+    nodes = root.get_descendants().order_by('lft').values(*channel_csv_node_values)
+    # stack of (rght, title, node_id) of the ancestors of the current node
+    ancestors = [(root.rght, root.title, root.node_id)]
+    batch = []
+    for node in nodes.iterator(chunk_size=CSV_BATCH_SIZE):
+        while ancestors[-1][0] < node['lft']:
+            ancestors.pop()
+        if node['kind_id'] == content_kinds.TOPIC:
+            ancestors.append((node['rght'], node['title'], node['node_id']))
+            continue
+        node['path'] = "/".join(ancestor[1] for ancestor in ancestors)
+        node['parent_node_id'] = ancestors[-1][2]
+        batch.append(node)
+        if len(batch) >= CSV_BATCH_SIZE:
+            for row in _get_content_csv_rows(batch, channel, site):
+                yield row
+            batch = []
+    for row in _get_content_csv_rows(batch, channel, site):
+        yield row
+
+
+def _get_content_csv_rows(nodes, channel, site):
+    if not nodes:
+        return []
+    node_ids = [node['id'] for node in nodes]
+
+    file_sizes = defaultdict(int)
+    for contentnode_id, checksum, file_size in File.objects.filter(contentnode_id__in=node_ids)\
+            .values_list('contentnode_id', 'checksum', 'file_size').distinct().order_by():
+        file_sizes[contentnode_id] += file_size or 0
+
+    tags = defaultdict(list)
+    for contentnode_id, tag_name in ContentNode.tags.through.objects.filter(contentnode_id__in=node_ids)\
+            .values_list('contentnode_id', 'contenttag__tag_name'):
+        tags[contentnode_id].append(tag_name)
+
+    questions = defaultdict(list)
+    exercise_ids = [node['id'] for node in nodes if node['kind_id'] == content_kinds.EXERCISE]
+    if exercise_ids:
+        for question in AssessmentItem.objects.filter(contentnode_id__in=exercise_ids)\
+                .values('contentnode_id', 'type', 'question', 'raw_data').order_by('contentnode_id', 'order'):
+            questions[question['contentnode_id']].append(_format_question(question))
+
+    return [_get_content_csv_row(node, channel, site, file_sizes[node['id']], tags[node['id']], questions[node['id']])
+            for node in nodes]
+
+
+def _get_content_csv_row(node, channel, site, file_size, tags, questions):
+    url = "/".join([site, "channels", channel.pk, "view", node['parent_node_id'][:7], node['node_id'][:7]])
+    language = node['language__readable_name'] or "Default to topic language"
+    license = node['license__license_name'] or "No license"
+    return [node['path'], node['title'], node['kind_id'].capitalize(), node['description'], url,
+            node['author'], language, license, node['license_description'], node['copyright_holder'],
+            _format_size(file_size), ", ".join(tags), " ".join(questions)]
+
+
 def _csv_file_exists(csv_path, channel):
     last_modified = time.mktime(channel.main_tree.modified.timetuple())
     return os.path.isfile(csv_path) and _creation_date(csv_path) >= last_modified
 
-
-def _write_content_csv(writer, node, site):
-    path = "/".join(node.get_ancestors().order_by("level").values_list("title", flat=True))
-    url = "/".join([site, "channels", node.get_channel().pk, "view", node.parent.node_id[:7], node.node_id[:7]])
-    language = node.language.readable_name if node.language else "Default to topic language"
-    license = node.license.license_name if node.license else "No license"
-    file_size = _format_size(node.files.values('checksum', 'file_size')
-                             .distinct()
-                             .aggregate(size=Sum('file_size'))['size'] or 0)
-    tags = ", ".join(node.tags.values_list('tag_name', flat=True))
-    questions = ""
-    if node.kind_id == content_kinds.EXERCISE:
-        questions = " ".join([_format_question(q) for q in node.assessment_items.all().order_by("order")])
-    return writer.writerow([path, node.title, node.kind_id.capitalize(), node.description, url,
-                            node.author, language, license, node.license_description, node.copyright_holder, file_size, tags, questions])
-
 # Formatting helpers
 
 
@@ -96,15 +178,15 @@ def _format_size(num, suffix='B'):
 
 
 def _format_question(question):
-    if question.type == exercises.PERSEUS_QUESTION:
+    if question['type'] == exercises.PERSEUS_QUESTION:
         try:
-            text = re.sub(r"\[\[.*\]\]", "", json.loads(question.raw_data)['question']['content']).encode('utf-8')
+            text = re.sub(r"\[\[.*\]\]", "", json.loads(question['raw_data'])['question']['content'])
         except Exception:  # Some perseus json is malformed
             text = ""
     else:
-        text = question.question
+        text = question['question']
     text = re.sub(r"!\[[^\[]*\]\([^\)]*\)", "{Image}", text)
-    return "[{}] {}".format(question.type.replace("_", " ").upper(), text.replace("\n", " ").replace("\\_", "_"))
+    return "[{}] {}".format(question['type'].replace("_", " ").upper(), text.replace("\n", " ").replace("\\_", "_"))
 
 
 def _creation_date(path_to_file):
@@ -12,6 +12,7 @@ from contentcuration.constants import feature_flags
 from contentcuration.db.models.functions import JSONObjectKeys
 from contentcuration.models import ContentNode
 from contentcuration.models import File
+from contentcuration.models import Task
 from contentcuration.models import User
 
 
@@ -33,7 +34,7 @@ def clean_up_deleted_chefs():
 
     # don't delete files until we can ensure files are not referenced anywhere.
     for node in nodes_to_clean_up:
-        node.delete()
+        ContentNode.objects.delete_subtree(node)
 
     if ContentNode.objects.filter(parent=deleted_chefs_node).exists():
         raise AssertionError
@@ -107,3 +108,12 @@ def clean_up_feature_flags():
     for remove_flag in (set(existing_flag_keys) - set(current_flag_keys)):
         User.objects.filter(feature_flags__has_key=remove_flag) \
             .update(feature_flags=CombinedExpression(F("feature_flags"), "-", Value(remove_flag)))
+
+
+def clean_up_tasks(delete_older_than=settings.TASK_CLEAN_UP_THRESHOLD):
+    """
+    Removes Task records created before `delete_older_than`. By then they have either finished,
+    or their worker has gone away and they never will, so deleting them also releases their
+    dedup_key for new tasks.
+    """
+    Task.objects.filter(created__lt=delete_older_than).delete()
@@ -1,7 +1,11 @@
+import gzip
+import io
 import logging
+import os
+import shutil
 import tempfile
-from gzip import GzipFile
-from io import BytesIO
+import zlib
+from datetime import datetime
 
 import backoff
 from django.conf import settings
@@ -9,7 +13,6 @@ from django.core.files import File
 from django.core.files.storage import Storage
 from google.cloud.exceptions import InternalServerError
 from google.cloud.storage import Client
-from google.cloud.storage.blob import Blob
 
 OLD_STUDIO_STORAGE_PREFIX = "/contentworkshop_content/"
 
@@ -17,6 +20,114 @@ CONTENT_DATABASES_MAX_AGE = 5  # seconds
 
 MAX_RETRY_TIME = 60  # seconds
 
+# size of the chunks uploaded to GCS when streaming a database, this must be a multiple of 256KB
+DATABASE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# size of the chunks read from a file while compressing it
+COMPRESS_READ_SIZE = 1024 * 1024
+
+# bytes fetched from GCS at least per read, so small reads and seeks are served from memory
+READ_AHEAD_SIZE = 256 * 1024
+
+
+class GzipReader(io.RawIOBase):
+    """
+    Readable file object of the gzip compressed content of another file, compressed as it's read
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        # the same compression GzipFile uses, with a gzip header and trailer
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.buffer = bytearray()
+        self.finished = False
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        while not self.finished and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.fobj.read(COMPRESS_READ_SIZE)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self._position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Seekable, read-only file object for a blob, that fetches only the byte ranges that are read.
+    Wrap it in an io.BufferedReader to read ahead.
+    """
+    mode = "rb"
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.name = blob.name
+        if blob.size is None:
+            blob.reload()
+        self.size = blob.size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({}, should be 0, 1 or 2)".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        data = self._read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        return self._read(self.size - self._position)
+
+    def _read(self, length):
+        if length <= 0 or self._position >= self.size:
+            return b""
+        end = min(self._position + length, self.size) - 1
+        data = self._download(self._position, end)
+        self._position += len(data)
+        return data
+
+    @backoff.on_exception(backoff.expo, InternalServerError, max_time=MAX_RETRY_TIME)
+    def _download(self, start, end):
+        # `end` is inclusive
+        return self.blob.download_as_bytes(start=start, end=end)
+
 
 class GoogleCloudStorage(Storage):
     def __init__(self, client=None):
@@ -32,13 +143,15 @@ class GoogleCloudStorage(Storage):
     def open(self, name, mode="rb", blob_object=None):
         """
         open returns a Django File object containing the bytes of name suitable for reading.
+        The bytes are fetched from GCS in ranges as they're read, so callers can seek and read
+        parts of large files without downloading all of them.
 
         You can pass in an optional 'mode' argument, but is only there for Django Storage class
         compatibility. It would error out if given any other argument than "rb".
 
-        You can also pass in an object in the blob_object argument. This must have a method called
-        `download_to_file` that accepts as writeable file object as an argument, and writes the
-        bytes to it. (this is mainly used for mocking in tests.)
+        You can also pass in an object in the blob_object argument. This must have a `size`
+        and a method called `download_as_bytes` that accepts `start` and `end` byte positions.
+        (this is mainly used for mocking in tests.)
         """
         # We don't have any logic for returning the file object in write
         # so just raise an error if we get any mode other than rb
@@ -58,14 +171,22 @@ class GoogleCloudStorage(Storage):
         else:
             blob = blob_object
 
-        fobj = tempfile.NamedTemporaryFile()
-        blob.download_to_file(fobj)
-        # flush it to disk
-        fobj.flush()
-        fobj.seek(0)
-
-        django_file = File(fobj)
-        django_file.just_downloaded = True
+        if blob.content_encoding == "gzip":
+            # GCS decompresses gzip encoded blobs as it serves them, ignoring any range
+            # requested, so these have to be downloaded in full
+            fobj = tempfile.NamedTemporaryFile()
+            blob.download_to_file(fobj)
+            # flush it to disk
+            fobj.flush()
+            fobj.seek(0)
+
+            django_file = File(fobj, name=name)
+            django_file.just_downloaded = True
+            return django_file
+
+        fobj = io.BufferedReader(BlobReader(blob), buffer_size=READ_AHEAD_SIZE)
+        django_file = File(fobj, name=name)
+        django_file.size = fobj.raw.size
         return django_file
 
     @backoff.on_exception(backoff.expo, InternalServerError, max_time=MAX_RETRY_TIME)
@@ -84,26 +205,10 @@ class GoogleCloudStorage(Storage):
 
     def save(self, name, fobj, max_length=None, blob_object=None):
         if not blob_object:
-            blob = Blob(name, self.bucket)
+            blob = self.bucket.blob(name)
         else:
             blob = blob_object
 
-        buffer = None
-        # set a max-age of 5 if we're uploading to content/databases
-        if self.is_database_file(name):
-            blob.cache_control = "private, max-age={}, no-transform".format(
-                CONTENT_DATABASES_MAX_AGE
-            )
-
-            # Compress the database file so that users can save bandwith and download faster.
-            buffer = BytesIO()
-            compressed = GzipFile(fileobj=buffer, mode="w")
-            compressed.write(fobj.read())
-            compressed.close()
-
-            blob.content_encoding = "gzip"
-            fobj = buffer
-
         # determine the current file's mimetype based on the name
         # import determine_content_type lazily in here, so we don't get into an infinite loop with circular dependencies
         from contentcuration.utils.storage_common import determine_content_type
@@ -113,6 +218,22 @@ class GoogleCloudStorage(Storage):
         # because that's what google wants
         fobj.seek(0)
 
+        # set a max-age of 5 if we're uploading to content/databases
+        if self.is_database_file(name):
+            blob.cache_control = "private, max-age={}, no-transform".format(
+                CONTENT_DATABASES_MAX_AGE
+            )
+
+            # Compress the database file so that users can save bandwith and download faster.
+            # Databases can be several GB, so they're compressed as they're read by a resumable
+            # upload, keeping no more than a chunk of them in memory.
+            blob.content_encoding = "gzip"
+            blob.chunk_size = DATABASE_UPLOAD_CHUNK_SIZE
+            blob.upload_from_file(
+                GzipReader(fobj), content_type=content_type,
+            )
+            return name
+
         if self._is_file_empty(fobj):
             logging.warning("Stopping the upload of an empty file: {}".format(name))
             return name
@@ -121,10 +242,6 @@ class GoogleCloudStorage(Storage):
             fobj, content_type=content_type,
         )
 
-        # Close StringIO object and discard memory buffer if created
-        if buffer:
-            buffer.close()
-
         return name
 
     def url(self, name):
@@ -196,3 +313,81 @@ class GoogleCloudStorage(Storage):
             byt = fobj.read(1)
             fobj.seek(current_location)
         return len(byt) == 0
+
+
+class LocalClient(object):
+    """
+    Stand-in for the GCS client that keeps blobs in a local directory, so GoogleCloudStorage
+    can be exercised in tests and offline, e.g. `GoogleCloudStorage(client=LocalClient(root))`
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get_bucket(self, bucket_name):
+        return LocalBucket(os.path.join(self.root, bucket_name))
+
+
+class LocalBucket(object):
+    def __init__(self, root):
+        self.root = root
+        # blob metadata that GCS would store alongside the object
+        self.metadata = {}
+
+    def blob(self, name):
+        return LocalBlob(name, self)
+
+    def get_blob(self, name):
+        blob = LocalBlob(name, self)
+        return blob if os.path.exists(blob.path) else None
+
+
+class LocalBlob(object):
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        metadata = bucket.metadata.get(name, {})
+        self.cache_control = metadata.get("cache_control")
+        self.content_encoding = metadata.get("content_encoding")
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def time_created(self):
+        return datetime.fromtimestamp(os.path.getctime(self.path))
+
+    @property
+    def public_url(self):
+        return "file://{}".format(self.path)
+
+    def reload(self):
+        pass
+
+    def download_as_bytes(self, start=None, end=None):
+        with open(self.path, "rb") as f:
+            if self.content_encoding == "gzip":
+                return gzip.decompress(f.read())
+            start = start or 0
+            f.seek(start)
+            return f.read() if end is None else f.read(end - start + 1)
+
+    def download_to_file(self, fobj):
+        fobj.write(self.download_as_bytes())
+
+    def upload_from_file(self, fobj, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            shutil.copyfileobj(fobj, f)
+        self.bucket.metadata[self.name] = {
+            "cache_control": self.cache_control,
+            "content_encoding": self.content_encoding,
+        }
+
+    def delete(self):
+        os.remove(self.path)
+        self.bucket.metadata.pop(self.name, None)
@@ -12,7 +12,10 @@ import shutil
 import sqlite3
 import sys
 import tempfile
+import threading
+import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 import requests
@@ -42,6 +45,11 @@ NODE_COUNT = 0
 FILE_COUNT = 0
 TAG_COUNT = 0
 
+# Number of rows inserted by each bulk insert
+BULK_CREATE_BATCH_SIZE = 500
+# Number of files downloaded from the source Studio instance at once
+DOWNLOAD_WORKERS = 8
+
 ANSWER_FIELD_MAP = {
     exercises.SINGLE_SELECTION: 'radio 1',
     exercises.MULTIPLE_SELECTION: 'radio 1',
@@ -180,50 +188,117 @@ def write_to_thumbnail_file(raw_thumbnail):
                 os.unlink(tempf.name)
 
 
-def create_nodes(cursor, target_id, parent, indent=1, download_url=None):
-    """ create_channel: Create channel at target id
+class FileDownloader(object):
+    """
+    Downloads files from the source Studio instance into storage on a pool of threads, downloading
+    each file only once however many nodes and assessment items reference it.
+    """
+    def __init__(self, download_url=None, workers=DOWNLOAD_WORKERS):
+        self.download_url = download_url
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def submit(self, filename):
+        with self.lock:
+            if filename not in self.futures:
+                self.futures[filename] = self.executor.submit(download_to_storage, filename, self.download_url)
+            return self.futures[filename]
+
+    def get(self, filename):
+        """
+        :return: The storage path of the file
+        """
+        return self.submit(filename).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def create_nodes(cursor, target_id, root, download_url=None):
+    """ create_nodes: Bulk create the nodes of the exported tree under root, with their files, tags and
+        assessment items. The export database is read in a few passes, the MPTT fields are worked out
+        in memory, and everything is inserted in batches.
         Args:
-            cursor (sqlite3.Connection): connection to export database
+            cursor (sqlite3.Cursor): cursor for the export database
+            target_id (str): channel_id to write to
+            root (models.ContentNode): root of the new tree, which must not have any children yet
+            download_url (str): Domain to download files from
+        Returns: number of nodes created
+    """
+    downloader = FileDownloader(download_url=download_url)
+    try:
+        node_ids = create_node_tree(cursor, target_id, root)
+        create_node_tags(cursor, target_id, node_ids)
+        file_rows = read_file_rows(cursor, node_ids)
+        create_node_files(file_rows, node_ids, downloader)
+        create_node_assessment_items(file_rows, node_ids, downloader)
+    finally:
+        downloader.shutdown()
+    return len(node_ids)
+
+
+def read_licenses(cursor):
+    """ read_licenses: Map the licenses of the export database to local licenses
+        Args:
+            cursor (sqlite3.Cursor): cursor for the export database
+        Returns: dict of export license id to a tuple of (local license id, license description)
+    """
+    rows = cursor.execute(
+        'SELECT id, license_name, license_description FROM {table}'.format(table=LICENSE_TABLE)
+    ).fetchall()
+    license_ids = dict(
+        models.License.objects.filter(license_name__in=[name for _, name, _ in rows]).values_list("license_name", "id")
+    )
+    return {
+        license_id: (license_ids[name], description)
+        for license_id, name, description in rows
+        if name in license_ids
+    }
+
+
+def read_extra_fields(cursor):
+    """ read_extra_fields: Read the extra fields of every exercise in the export database
+        Args:
+            cursor (sqlite3.Cursor): cursor for the export database
+        Returns: dict of export node id to extra_fields
+    """
+    extra_fields = {}
+    query = 'SELECT contentnode_id, mastery_model, randomize FROM {table}'.format(table=ASSESSMENTMETADATA_TABLE)
+    for contentnode_id, mastery_model, randomize in cursor.execute(query):
+        fields = mastery_model or {}
+        if isinstance(fields, basestring):
+            fields = json.loads(fields)
+        fields.update({"randomize": randomize})
+        extra_fields[contentnode_id] = fields
+    return extra_fields
+
+
+def create_node_tree(cursor, target_id, root):
+    """ create_node_tree: Bulk create the nodes of the export database under root
+        Args:
+            cursor (sqlite3.Cursor): cursor for the export database
             target_id (str): channel_id to write to
-            parent (models.ContentNode): node's parent
-            indent (int): How far to indent print statements
-        Returns: newly created node
+            root (models.ContentNode): root of the new tree
+        Returns: dict of export node id to the id of the node created for it
     """
-    # Read database rows that match parent
-    parent_query = "parent_id=\'{}\'".format(parent.node_id)
-
-    sql_command = 'SELECT id, title, content_id, description, sort_order, '\
-        'license_owner, author, license_id, kind, coach_content, lang_id FROM {table} WHERE {query} ORDER BY sort_order;'\
-        .format(table=NODE_TABLE, query=parent_query)
-    query = cursor.execute(sql_command).fetchall()
-
-    # Parse through rows and create models
-    for id, title, content_id, description, sort_order, license_owner, author, license_id, kind, coach_content, lang_id in query:
-        log.info("{indent} {id} ({title} - {kind})...".format(indent="   |" * indent, id=id, title=title, kind=kind))
-
-        # Determine role
-        role = roles.LEARNER
-        if coach_content:
-            role = roles.COACH
-
-        # Determine extra_fields
-        assessment_query = "SELECT mastery_model, randomize FROM {table} WHERE contentnode_id='{node}'".format(table=ASSESSMENTMETADATA_TABLE, node=id)
-        result = cursor.execute(assessment_query).fetchone()
-        extra_fields = result[0] if result else {}
-        if isinstance(extra_fields, basestring):
-            extra_fields = json.loads(extra_fields)
-        if result:
-            extra_fields.update({"randomize": result[1]})
-
-        # Determine license
-        license = retrieve_license(cursor, license_id)
-        license_description = license[1] if license else ""
-        license = license[0] if license else None
-
-        # TODO: Determine thumbnail encoding
-
-        # Create new node model
-        node = models.ContentNode.objects.create(
+    licenses = read_licenses(cursor)
+    extra_fields = read_extra_fields(cursor)
+
+    children = {}
+    query = 'SELECT id, parent_id, title, content_id, description, sort_order, license_owner, author, '\
+        'license_id, kind, coach_content, lang_id FROM {table} ORDER BY sort_order;'.format(table=NODE_TABLE)
+    for row in cursor.execute(query):
+        children.setdefault(row[1], []).append(row)
+
+    node_ids = {}
+    batch = []
+
+    def build_node(row, parent_id, lft, level):
+        id, _, title, content_id, description, sort_order, license_owner, author, license_id, kind, coach_content, lang_id = row
+        license_id, license_description = licenses.get(license_id, (None, ""))
+        node = models.ContentNode(
+            id=uuid.uuid4().hex,
             node_id=id,
             original_source_node_id=id,
             source_node_id=id,
@@ -233,207 +308,272 @@ def create_nodes(cursor, target_id, parent, indent=1, download_url=None):
             sort_order=sort_order,
             copyright_holder=license_owner,
             author=author,
-            license=license,
+            license_id=license_id,
             license_description=license_description,
             language_id=lang_id,
-            role_visibility=role,
-            extra_fields=extra_fields,
+            role_visibility=roles.COACH if coach_content else roles.LEARNER,
+            extra_fields=extra_fields.get(id, {}),
             kind_id=kind,
-            parent=parent,
+            parent_id=parent_id,
             original_channel_id=target_id,
             source_channel_id=target_id,
+            tree_id=root.tree_id,
+            lft=lft,
+            level=level,
         )
-
-        # Handle foreign key references (children, files, tags)
-        if kind == content_kinds.TOPIC:
-            create_nodes(cursor, target_id, node, indent=indent + 1, download_url=download_url)
-        elif kind == content_kinds.EXERCISE:
-            create_assessment_items(cursor, node, indent=indent + 1, download_url=download_url)
-        create_files(cursor, node, indent=indent + 1, download_url=download_url)
-        create_tags(cursor, node, target_id, indent=indent + 1)
-
-    return node
+        node_ids[id] = node.id
+        return node
+
+    with models.ContentNode.objects.lock_mptt(root.tree_id):
+        # Walk the tree depth first, numbering the nodes as they're entered and left. Nodes are
+        # complete once they're left, so they're inserted then, never holding more than a batch
+        counter = root.lft + 1
+        stack = [(None, iter(children.get(root.node_id, [])))]
+        while stack:
+            node, node_children = stack[-1]
+            row = next(node_children, None)
+            if row is None:
+                stack.pop()
+                if node is not None:
+                    node.rght = counter
+                    counter += 1
+                    batch.append(node)
+                    if len(batch) >= BULK_CREATE_BATCH_SIZE:
+                        models.ContentNode.objects.bulk_create(batch)
+                        batch = []
+                continue
+            child = build_node(row, node.id if node else root.id, counter, root.level + len(stack))
+            counter += 1
+            # Only topics have children
+            stack.append((child, iter(children.get(row[0], []) if row[9] == content_kinds.TOPIC else [])))
+
+        models.ContentNode.objects.bulk_create(batch)
+        models.ContentNode.objects.filter(pk=root.pk).update(rght=counter)
+        root.rght = counter
+
+    log.info("\tCreated {} nodes".format(len(node_ids)))
+    return node_ids
+
+
+def create_node_tags(cursor, target_id, node_ids):
+    """ create_node_tags: Bulk create the tags of the export database and tag the nodes created
+        Args:
+            cursor (sqlite3.Cursor): cursor for the export database
+            target_id (str): channel_id to write to
+            node_ids (dict): export node id to the id of the node created for it
+        Returns: None
+    """
+    query = 'SELECT cnt.contentnode_id, ct.id, ct.tag_name FROM {cnttable} cnt '\
+        'JOIN {cttable} ct ON cnt.contenttag_id = ct.id'.format(cnttable=NODE_TAG_TABLE, cttable=TAG_TABLE)
+    rows = [row for row in cursor.execute(query) if row[0] in node_ids]
+
+    tags = {tag_id: tag_name for _, tag_id, tag_name in rows}
+    # Tags already in the channel are reused, whether they came from an earlier import or not
+    tag_ids = dict(
+        models.ContentTag.objects.filter(tag_name__in=set(tags.values()), channel_id=target_id).values_list("tag_name", "id")
+    )
+    # Export ids already taken, e.g. by a tag of the channel the export came from, get a fresh id instead
+    taken_ids = set(models.ContentTag.objects.filter(pk__in=list(tags)).values_list("id", flat=True))
+    new_tags = []
+    for tag_id, tag_name in tags.items():
+        if tag_name in tag_ids:
+            continue
+        if tag_id in taken_ids:
+            tag_id = uuid.uuid4().hex
+        new_tags.append(models.ContentTag(id=tag_id, tag_name=tag_name, channel_id=target_id))
+        tag_ids[tag_name] = tag_id
+        taken_ids.add(tag_id)
+    models.ContentTag.objects.bulk_create(new_tags, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    # Export tags sharing a name resolve to the same tag, so dedupe on the resolved ids
+    through_model = models.ContentNode.tags.through
+    through_model.objects.bulk_create(
+        [
+            through_model(contentnode_id=contentnode_id, contenttag_id=contenttag_id)
+            for contentnode_id, contenttag_id in {
+                (node_ids[contentnode_id], tag_ids[tag_name]) for contentnode_id, _, tag_name in rows
+            }
+        ],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+    log.info("\tCreated {} tags".format(len(new_tags)))
 
 
-def retrieve_license(cursor, license_id):
-    """ retrieve_license_name: Get license based on id from exported db
+def read_file_rows(cursor, node_ids):
+    """ read_file_rows: Read the files of the nodes created from the export database
         Args:
-            cursor (sqlite3.Connection): connection to export database
-            license_id (str): id of license on exported db
-        Returns: license model matching the name and the associated license description
+            cursor (sqlite3.Cursor): cursor for the export database
+            node_ids (dict): export node id to the id of the node created for it
+        Returns: list of tuples of (checksum, extension, file_size, contentnode_id, lang_id, preset)
     """
-    # Handle no license being assigned
-    if license_id is None or license_id == "":
-        return None
+    query = 'SELECT checksum, extension, file_size, contentnode_id, lang_id, preset FROM {table}'.format(table=FILE_TABLE)
+    return [row for row in cursor.execute(query) if row[3] in node_ids]
 
-    # Return license that matches name
-    name, description = cursor.execute(
-        'SELECT license_name, license_description FROM {table} WHERE id={id}'.format(table=LICENSE_TABLE, id=license_id)
-    ).fetchone()
-    return models.License.objects.get(license_name=name), description
 
-
-def download_file(filename, download_url=None, contentnode=None, assessment_item=None, preset=None, file_size=None, lang_id=None):
+def build_file(filename, filepath, file_size=None, preset=None, lang_id=None, contentnode_id=None, assessment_item=None):
     checksum, extension = os.path.splitext(filename)
-    extension = extension.lstrip('.')
-    filepath = models.generate_object_storage_name(checksum, filename)
-
-    # Download file if it hasn't already been downloaded
-    if download_url and not default_storage.exists(filepath):
-        buffer = BytesIO()
-        response = requests.get('{}/content/storage/{}/{}/{}'.format(download_url, filename[0], filename[1], filename))
-        for chunk in response:
-            buffer.write(chunk)
-
-        checksum, _, filepath = write_raw_content_to_storage(buffer.getvalue(), ext=extension)
-        buffer.close()
-
-    # Save values to new file object
     file_obj = models.File(
-        file_format_id=extension,
+        checksum=checksum,
+        file_format_id=extension.lstrip('.'),
         file_size=file_size or default_storage.size(filepath),
-        contentnode=contentnode,
+        contentnode_id=contentnode_id,
         assessment_item=assessment_item,
         language_id=lang_id,
         preset_id=preset or "",
     )
     file_obj.file_on_disk.name = filepath
-    file_obj.save()
+    return file_obj
 
 
-def create_files(cursor, contentnode, indent=0, download_url=None):
-    """ create_files: Get license
+def create_node_files(file_rows, node_ids, downloader):
+    """ create_node_files: Download the files of the nodes created, and bulk create their file objects
         Args:
-            cursor (sqlite3.Connection): connection to export database
-            contentnode (models.ContentNode): node file references
-            indent (int): How far to indent print statements
+            file_rows (list): files from the export database, see read_file_rows
+            node_ids (dict): export node id to the id of the node created for it
+            downloader (FileDownloader): downloader for the source Studio instance
         Returns: None
     """
-    # Parse database for files referencing content node and make file models
-    sql_command = 'SELECT checksum, extension, file_size, contentnode_id, '\
-        'lang_id, preset FROM {table} WHERE contentnode_id=\'{id}\';'\
-        .format(table=FILE_TABLE, id=contentnode.node_id)
+    # Queue every download first, so they all run concurrently
+    for checksum, extension, _, _, _, _ in file_rows:
+        downloader.submit("{}.{}".format(checksum, extension))
 
-    query = cursor.execute(sql_command).fetchall()
-    for checksum, extension, file_size, contentnode_id, lang_id, preset in query:
+    files = []
+    for checksum, extension, file_size, contentnode_id, lang_id, preset in file_rows:
         filename = "{}.{}".format(checksum, extension)
-        log.info("{indent} * FILE {filename}...".format(indent="   |" * indent, filename=filename))
-
         try:
-            download_file(filename, download_url=download_url, contentnode=contentnode, preset=preset, file_size=file_size, lang_id=lang_id)
-
+            filepath = downloader.get(filename)
+            files.append(
+                build_file(
+                    filename,
+                    filepath,
+                    file_size=file_size,
+                    preset=preset,
+                    lang_id=lang_id,
+                    contentnode_id=node_ids[contentnode_id],
+                )
+            )
         except IOError as e:
             log.warning("\b FAILED (check logs for more details)")
-            sys.stderr.write("Restoration Process Error: Failed to save file object {}: {}".format(filename, os.strerror(e.errno)))
-            continue
+            sys.stderr.write("Restoration Process Error: Failed to save file object {}: {}".format(filename, e))
 
-
-def create_tags(cursor, contentnode, target_id, indent=0):
-    """ create_tags: Create tags associated with node
-        Args:
-            cursor (sqlite3.Connection): connection to export database
-            contentnode (models.ContentNode): node file references
-            target_id (str): channel_id to write to
-            indent (int): How far to indent print statements
-        Returns: None
-    """
-    # Parse database for files referencing content node and make file models
-    sql_command = 'SELECT ct.id, ct.tag_name FROM {cnttable} cnt '\
-        'JOIN {cttable} ct ON cnt.contenttag_id = ct.id ' \
-        'WHERE cnt.contentnode_id=\'{id}\';'\
-        .format(
-            cnttable=NODE_TAG_TABLE,
-            cttable=TAG_TABLE,
-            id=contentnode.node_id,
-        )
-    query = cursor.execute(sql_command).fetchall()
-
-    # Build up list of tags
-    tag_list = []
-    for id, tag_name in query:
-        log.info("{indent} ** TAG {tag}...".format(indent="   |" * indent, tag=tag_name))
-        # Save values to new or existing tag object
-        tag_obj, is_new = models.ContentTag.objects.get_or_create(
-            pk=id,
-            tag_name=tag_name,
-            channel_id=target_id,
-        )
-        tag_list.append(tag_obj)
-
-    # Save tags to node
-    contentnode.tags = tag_list
-    contentnode.save()
+    models.File.objects.bulk_create(files, batch_size=BULK_CREATE_BATCH_SIZE)
+    log.info("\tCreated {} files".format(len(files)))
 
 
-def create_assessment_items(cursor, contentnode, indent=0, download_url=None):
-    """ create_assessment_items: Generate assessment items based on perseus zip
+def create_node_assessment_items(file_rows, node_ids, downloader):
+    """ create_node_assessment_items: Generate the assessment items of the exercises created from their perseus zips
         Args:
-            cursor (sqlite3.Connection): connection to export database
-            contentnode (models.ContentNode): node assessment items reference
-            indent (int): How far to indent print statements
-            download_url (str): Domain to download files from
+            file_rows (list): files from the export database, see read_file_rows
+            node_ids (dict): export node id to the id of the node created for it
+            downloader (FileDownloader): downloader for the source Studio instance
         Returns: None
     """
-
-    # Parse database for files referencing content node and make file models
-    sql_command = 'SELECT checksum, extension '\
-        'preset FROM {table} WHERE contentnode_id=\'{id}\' AND preset=\'exercise\';'\
-        .format(table=FILE_TABLE, id=contentnode.node_id)
-
-    query = cursor.execute(sql_command).fetchall()
-    for checksum, extension in query:
-        filename = "{}.{}".format(checksum, extension)
-        log.info("{indent} * EXERCISE {filename}...".format(indent="   |" * indent, filename=filename))
-
+    exercises = [
+        (node_ids[contentnode_id], "{}.{}".format(checksum, extension))
+        for checksum, extension, _, contentnode_id, _, preset in file_rows
+        if preset == format_presets.EXERCISE
+    ]
+
+    def extract(exercise):
+        contentnode_id, filename = exercise
         try:
-            # Store the downloaded zip into temporary storage
-            tempf = tempfile.NamedTemporaryFile(suffix='.{}'.format(extension), delete=False)
-            response = requests.get('{}/content/storage/{}/{}/{}'.format(download_url, filename[0], filename[1], filename))
-            for chunk in response:
-                tempf.write(chunk)
-            tempf.close()
-            extract_assessment_items(tempf.name, contentnode, download_url=download_url)
+            return contentnode_id, extract_assessment_items(downloader.get(filename), downloader=downloader)
         except IOError as e:
             log.warning("\b FAILED (check logs for more details)")
-            sys.stderr.write("Restoration Process Error: Failed to save file object {}: {}".format(filename, os.strerror(e.errno)))
-            continue
-        finally:
-            os.unlink(tempf.name)
-
-
-def extract_assessment_items(filepath, contentnode, download_url=None):
-    """ extract_assessment_items: Create and save assessment items to content node
+            sys.stderr.write("Restoration Process Error: Failed to save file object {}: {}".format(filename, e))
+            return contentnode_id, []
+
+    assessment_items = []
+    files = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        for contentnode_id, items in executor.map(extract, exercises):
+            for assessment_item, item_files in items:
+                assessment_item.contentnode_id = contentnode_id
+                assessment_items.append(assessment_item)
+                files.extend(item_files)
+
+    models.AssessmentItem.objects.bulk_create(assessment_items, batch_size=BULK_CREATE_BATCH_SIZE)
+    for file_obj in files:
+        file_obj.assessment_item_id = file_obj.assessment_item.id
+    models.File.objects.bulk_create(files, batch_size=BULK_CREATE_BATCH_SIZE)
+    log.info("\tCreated {} assessment items".format(len(assessment_items)))
+
+
+def extract_assessment_items(filepath, downloader=None):
+    """ extract_assessment_items: Generate unsaved assessment items from a perseus zip
         Args:
             filepath (str): Where perseus zip is stored
-            contentnode (models.ContentNode): node assessment items reference
+            downloader (FileDownloader): downloader for the images of the assessment items
+        Returns: list of tuples of assessment item and its unsaved files
+    """
+    assessment_items = []
+    with default_storage.open(filepath) as fobj, zipfile.ZipFile(fobj, 'r') as zipf:
+        data = json.loads(zipf.read('exercise.json'))
+
+        for index, assessment_id in enumerate(data['all_assessment_items']):
+            files = []
+            assessment_item = generate_assessment_item(
+                assessment_id,
+                index,
+                data['assessment_mapping'][assessment_id],
+                json.loads(zipf.read('{}.json'.format(assessment_id))),
+                downloader=downloader,
+                files=files,
+            )
+            assessment_items.append((assessment_item, files))
+    return assessment_items
+
+
+def download_to_storage(filename, download_url=None):
+    """ download_to_storage: Download a file from the source Studio instance, unless it's already in storage
+        Args:
+            filename (str): name of the file, as checksum.extension
             download_url (str): Domain to download files from
-        Returns: None
+        Returns: storage path of the file
     """
+    checksum, extension = os.path.splitext(filename)
+    filepath = models.generate_object_storage_name(checksum, filename)
 
-    try:
-        tempdir = tempfile.mkdtemp()
-        with zipfile.ZipFile(filepath, 'r') as zipf:
-            zipf.extractall(tempdir)
-        os.chdir(tempdir)
+    # Download file if it hasn't already been downloaded
+    if download_url and not default_storage.exists(filepath):
+        buffer = BytesIO()
+        response = requests.get('{}/content/storage/{}/{}/{}'.format(download_url, filename[0], filename[1], filename))
+        for chunk in response:
+            buffer.write(chunk)
 
-        with open('exercise.json', 'rb') as fobj:
-            data = json.load(fobj)
+        _, _, filepath = write_raw_content_to_storage(buffer.getvalue(), ext=extension.lstrip('.'))
+        buffer.close()
+    return filepath
 
-        for index, assessment_id in enumerate(data['all_assessment_items']):
-            with open('{}.json'.format(assessment_id), 'rb') as fobj:
-                assessment_item = generate_assessment_item(
-                    assessment_id,
-                    index,
-                    data['assessment_mapping'][assessment_id],
-                    json.load(fobj),
-                    download_url=download_url
-                )
-                contentnode.assessment_items.add(assessment_item)
-    finally:
-        shutil.rmtree(tempdir)
 
+def download_file(filename, download_url=None, contentnode=None, assessment_item=None, preset=None, file_size=None, lang_id=None,
+                  downloader=None, files=None):
+    """ download_file: Download a file and create its file object
+        Args:
+            filename (str): name of the file, as checksum.extension
+            download_url (str): Domain to download files from
+            downloader (FileDownloader): downloader to use instead of download_url
+            files (list): list to add the file object to unsaved, instead of saving it
+        Returns: models.File
+    """
+    filepath = downloader.get(filename) if downloader else download_to_storage(filename, download_url=download_url)
+    file_obj = build_file(
+        filename,
+        filepath,
+        file_size=file_size,
+        preset=preset,
+        lang_id=lang_id,
+        contentnode_id=contentnode.id if contentnode else None,
+        assessment_item=assessment_item,
+    )
+    if files is None:
+        file_obj.save()
+    else:
+        files.append(file_obj)
+    return file_obj
 
-def generate_assessment_item(assessment_id, order, assessment_type, assessment_data, download_url=None):
+
+def generate_assessment_item(assessment_id, order, assessment_type, assessment_data, download_url=None, downloader=None, files=None):
     """ generate_assessment_item: Generates a new assessment item
         Args:
             assessment_id (str): AssessmentItem.assessment_id value
@@ -441,19 +581,24 @@ def generate_assessment_item(assessment_id, order, assessment_type, assessment_d
             assessment_type (str): AssessmentItem.type value
             assessment_data (dict): Extracted data from perseus file
             download_url (str): Domain to download files from
+            downloader (FileDownloader): downloader to use instead of download_url
+            files (list): if given, the assessment item is left unsaved and its files are added to this list unsaved
         Returns: models.AssessmentItem
     """
-    assessment_item = models.AssessmentItem.objects.create(
+    assessment_item = models.AssessmentItem(
         assessment_id=assessment_id,
         type=assessment_type,
         order=order
     )
+    if files is None:
+        assessment_item.save()
+    content_kwargs = {"download_url": download_url, "downloader": downloader, "files": files}
     if assessment_type == exercises.PERSEUS_QUESTION:
         assessment_item.raw_data = json.dumps(assessment_data)
     else:
         # Parse questions
         assessment_data['question']['content'] = '\n\n'.join(assessment_data['question']['content'].split('\n\n')[:-1])
-        assessment_item.question = process_content(assessment_data['question'], assessment_item, download_url=download_url)
+        assessment_item.question = process_content(assessment_data['question'], assessment_item, **content_kwargs)
 
         # Parse answers
         answer_data = assessment_data['question']['widgets'][ANSWER_FIELD_MAP[assessment_type]]['options']
@@ -463,27 +608,30 @@ def generate_assessment_item(assessment_id, order, assessment_type, assessment_d
             ])
         else:
             assessment_item.answers = json.dumps([
-                {'answer': process_content(answer, assessment_item, download_url=download_url), 'correct': answer['correct']}
+                {'answer': process_content(answer, assessment_item, **content_kwargs), 'correct': answer['correct']}
                 for answer in answer_data['choices']
             ])
             assessment_item.randomize = answer_data['randomize']
 
         # Parse hints
         assessment_item.hints = json.dumps([
-            {'hint': process_content(hint, assessment_item, download_url=download_url)}
+            {'hint': process_content(hint, assessment_item, **content_kwargs)}
             for hint in assessment_data['hints']
         ])
 
-    assessment_item.save()
+    if files is None:
+        assessment_item.save()
     return assessment_item
 
 
-def process_content(data, assessment_item, download_url=None):
+def process_content(data, assessment_item, download_url=None, downloader=None, files=None):
     """ process_content: Parses perseus text for special formatting (e.g. formulas, images)
         Args:
             data (dict): Perseus data to parse (e.g. parsing 'question' field)
             download_url (str): Domain to download files from
             assessment_item (models.AssessmentItem): assessment item to save images to
+            downloader (FileDownloader): downloader to use instead of download_url
+            files (list): list to add the image files to unsaved, instead of saving them
         Returns: models.AssessmentItem
     """
     data['content'] = data['content'].replace(' ', '')  # Remove unrecognized non unicode characters
@@ -500,6 +648,13 @@ def process_content(data, assessment_item, download_url=None):
             data['content'] = data['content'].replace(match.group(3), '{} ={}x{}'.format(match.group(3), image_data['width'], image_data['height']))
 
         # Save files to db
-        download_file(match.group(3), assessment_item=assessment_item, preset=format_presets.EXERCISE, download_url=download_url)
+        download_file(
+            match.group(3),
+            assessment_item=assessment_item,
+            preset=format_presets.EXERCISE,
+            download_url=download_url,
+            downloader=downloader,
+            files=files,
+        )
 
     return data['content']
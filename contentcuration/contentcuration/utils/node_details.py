@@ -0,0 +1,311 @@
+"""
+Details of nodes for the channel look-inside previews, stored in ContentNodeDetails.
+
+The details of each topic are built from partial aggregates of its children, so that when part of a
+tree changes only the topics above it, which the triggers have marked stale, are recomputed.
+"""
+import hashlib
+import json
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils.translation import gettext as _
+from django_bulk_update.helper import bulk_update
+from le_utils.constants import content_kinds
+from le_utils.constants import format_presets
+from le_utils.constants import roles
+
+from contentcuration.models import Channel
+from contentcuration.models import ContentNode
+from contentcuration.models import ContentNodeDetails
+from contentcuration.models import File
+from contentcuration.models import TreeResourceSize
+
+# Number of topics whose details are recomputed together
+DETAILS_BATCH_SIZE = 500
+
+COUNT_FIELDS = ("resource_count", "coach_content", "exercises")
+# distinct values of the descendants, kept as sorted lists
+LIST_FIELDS = (
+    "copyright_holders",
+    "authors",
+    "aggregators",
+    "providers",
+    "languages",
+    "accessible_languages",
+    "licenses",
+)
+# counts of the descendants by value
+DICT_FIELDS = ("kind_count", "tags", "original_channels")
+
+RESOURCE_SIZE_SQL = """
+SELECT topic_id, COALESCE(SUM(file_size), 0) FROM (
+    SELECT DISTINCT t.id AS topic_id, f.checksum, f.file_size
+    FROM contentcuration_contentnode t
+    INNER JOIN contentcuration_contentnode n ON n.tree_id = t.tree_id AND n.lft > t.lft AND n.rght < t.rght
+    INNER JOIN contentcuration_file f ON f.contentnode_id = n.id
+    WHERE t.id IN %s AND n.kind_id <> %s AND n.complete
+) AS topic_files GROUP BY topic_id
+"""
+
+
+def _sort_key(value):
+    return (value is None, value or "")
+
+
+def _empty_aggregates():
+    aggregates = {field: 0 for field in COUNT_FIELDS}
+    aggregates.update({field: set() for field in LIST_FIELDS})
+    aggregates.update({field: {} for field in DICT_FIELDS})
+    aggregates["deepest"] = None
+    aggregates["resource_size"] = 0
+    return aggregates
+
+
+def _increment(counts, key, count=1):
+    if key is not None:
+        counts[key] = counts.get(key, 0) + count
+
+
+def _update_deepest(aggregates, deepest):
+    # children are merged in tree order, so the first of the deepest resources is kept
+    if deepest and (aggregates["deepest"] is None or deepest["level"] > aggregates["deepest"]["level"]):
+        aggregates["deepest"] = deepest
+
+
+def _merge_aggregates(aggregates, child_aggregates):
+    for field in COUNT_FIELDS:
+        aggregates[field] += child_aggregates.get(field, 0)
+    for field in LIST_FIELDS:
+        aggregates[field].update(child_aggregates.get(field, []))
+    for field in DICT_FIELDS:
+        for key, count in child_aggregates.get(field, {}).items():
+            _increment(aggregates[field], key, count)
+    _update_deepest(aggregates, child_aggregates.get("deepest"))
+
+
+def _add_resource(aggregates, resource):
+    aggregates["resource_count"] += 1
+    aggregates["coach_content"] += resource["role_visibility"] == roles.COACH
+    aggregates["exercises"] += resource["kind_id"] == content_kinds.EXERCISE
+    aggregates["copyright_holders"].add(resource["copyright_holder"])
+    aggregates["authors"].add(resource["author"])
+    aggregates["aggregators"].add(resource["aggregator"])
+    aggregates["providers"].add(resource["provider"])
+    if resource["license__license_name"] is not None:
+        aggregates["licenses"].add(resource["license__license_name"])
+    _increment(aggregates["kind_count"], resource["kind_id"])
+    _increment(aggregates["original_channels"], resource["original_channel_id"])
+    _update_deepest(aggregates, {"level": resource["level"], "id": resource["id"]})
+
+
+def _serialize_aggregates(aggregates):
+    serialized = dict(aggregates)
+    for field in LIST_FIELDS:
+        serialized[field] = sorted(aggregates[field], key=_sort_key)
+    return serialized
+
+
+def _get_resource_sizes(tree_id, topic_ids, level):
+    # like TreeResourceSize, which keeps the size of whole trees up to date, only complete resources count
+    if level == 0:
+        return {topic_id: TreeResourceSize.get_size(tree_id) for topic_id in topic_ids}
+    with connection.cursor() as cursor:
+        cursor.execute(RESOURCE_SIZE_SQL, [tuple(topic_ids), content_kinds.TOPIC])
+        return dict(cursor.fetchall())
+
+
+def _refresh_topics(tree_id, topic_ids, level):
+    """
+    Recomputes the aggregates of topics at the same level, from their children and the aggregates
+    of their child topics, which must be up to date already
+    """
+    with transaction.atomic():
+        ContentNodeDetails.objects.bulk_create(
+            [ContentNodeDetails(contentnode_id=topic_id, tree_id=tree_id) for topic_id in topic_ids],
+            ignore_conflicts=True,
+        )
+        # Clear the flag before reading the children, so that any edit made while reading marks them stale again
+        ContentNodeDetails.objects.filter(contentnode_id__in=topic_ids).update(stale=False)
+
+        children = list(
+            ContentNode.objects.filter(parent_id__in=topic_ids)
+            .values(
+                "id",
+                "parent_id",
+                "kind_id",
+                "level",
+                "copyright_holder",
+                "author",
+                "aggregator",
+                "provider",
+                "license__license_name",
+                "language__native_name",
+                "role_visibility",
+                "original_channel_id",
+            )
+            .order_by("lft")
+        )
+        child_topic_aggregates = dict(
+            ContentNodeDetails.objects.filter(
+                contentnode_id__in=[child["id"] for child in children if child["kind_id"] == content_kinds.TOPIC]
+            ).values_list("contentnode_id", "aggregates")
+        )
+        child_tags = ContentNode.tags.through.objects.filter(
+            contentnode__parent_id__in=topic_ids
+        ).values_list("contentnode__parent_id", "contenttag__tag_name")
+        child_subtitle_languages = (
+            File.objects.filter(contentnode__parent_id__in=topic_ids, preset_id=format_presets.VIDEO_SUBTITLE)
+            .exclude(contentnode__kind_id=content_kinds.TOPIC)
+            .values_list("contentnode__parent_id", "language__native_name")
+            .distinct()
+        )
+        resource_sizes = _get_resource_sizes(tree_id, topic_ids, level)
+
+        topic_aggregates = {topic_id: _empty_aggregates() for topic_id in topic_ids}
+        for child in children:
+            aggregates = topic_aggregates[child["parent_id"]]
+            if child["language__native_name"] is not None:
+                aggregates["languages"].add(child["language__native_name"])
+            if child["kind_id"] == content_kinds.TOPIC:
+                _merge_aggregates(aggregates, child_topic_aggregates.get(child["id"], {}))
+            else:
+                _add_resource(aggregates, child)
+        for topic_id, tag_name in child_tags:
+            _increment(topic_aggregates[topic_id]["tags"], tag_name)
+        for topic_id, language_name in child_subtitle_languages:
+            topic_aggregates[topic_id]["accessible_languages"].add(language_name)
+
+        details = []
+        for topic_id, aggregates in topic_aggregates.items():
+            aggregates["resource_size"] = resource_sizes.get(topic_id) or 0
+            details.append(
+                ContentNodeDetails(
+                    contentnode_id=topic_id,
+                    aggregates=_serialize_aggregates(aggregates),
+                    data=None,
+                    etag=None,
+                )
+            )
+        bulk_update(details, update_fields=["aggregates", "data", "etag"])
+
+
+def _list_or_none(values):
+    return list(values) or None
+
+
+def serialize_node_details(node, aggregates, channel_id=None):
+    """
+    Builds the details of a node shown in previews, from the aggregates of its subtree
+    """
+    deepest_node = None
+    if aggregates.get("deepest"):
+        deepest_node = ContentNode.objects.filter(pk=aggregates["deepest"]["id"]).first()
+    pathway = (
+        list(
+            deepest_node.get_ancestors()
+            .exclude(parent=None)
+            .values("title", "node_id", "kind_id")
+            .order_by()
+        )
+        if deepest_node
+        else []
+    )
+    sample_nodes = (
+        [
+            {
+                "node_id": n.node_id,
+                "title": n.title,
+                "description": n.description,
+                "thumbnail": n.get_thumbnail(),
+                "kind": n.kind_id,
+            }
+            for n in deepest_node.get_siblings(include_self=True)[0:4]
+        ]
+        if deepest_node
+        else []
+    )
+
+    # Get list of channels nodes were originally imported from (omitting the current channel)
+    if not channel_id:
+        channel = node.get_channel()
+        channel_id = channel and channel.id
+    originals = aggregates.get("original_channels", {})
+    original_channels = [
+        {
+            "id": c.id,
+            "name": "{}{}".format(c.name, _(" (Original)") if channel_id == c.id else ""),
+            "thumbnail": c.get_thumbnail(),
+            "count": originals[c.id],
+        }
+        for c in Channel.objects.exclude(pk=channel_id).filter(pk__in=originals.keys(), deleted=False).order_by()
+    ]
+
+    return {
+        "last_update": pytz.utc.localize(datetime.now()).strftime(settings.DATE_TIME_FORMAT),
+        "created": node.created.strftime(settings.DATE_TIME_FORMAT),
+        "resource_count": aggregates.get("resource_count", 0),
+        "resource_size": aggregates.get("resource_size", 0),
+        "includes": {
+            "coach_content": aggregates.get("coach_content", 0),
+            "exercises": aggregates.get("exercises", 0),
+        },
+        "kind_count": [
+            {"kind_id": kind_id, "count": count}
+            for kind_id, count in sorted(aggregates.get("kind_count", {}).items())
+        ],
+        "languages": _list_or_none(aggregates.get("languages", [])),
+        "accessible_languages": _list_or_none(aggregates.get("accessible_languages", [])),
+        "licenses": _list_or_none(aggregates.get("licenses", [])),
+        "tags": [
+            {"tag_name": tag_name, "count": count}
+            for tag_name, count in sorted(aggregates.get("tags", {}).items())
+        ],
+        "copyright_holders": _list_or_none(aggregates.get("copyright_holders", [])),
+        "authors": _list_or_none(aggregates.get("authors", [])),
+        "aggregators": _list_or_none(aggregates.get("aggregators", [])),
+        "providers": _list_or_none(aggregates.get("providers", [])),
+        "sample_pathway": pathway,
+        "original_channels": original_channels,
+        "sample_nodes": sample_nodes,
+    }
+
+
+def refresh_node_details(node, channel_id=None):
+    """
+    Recomputes the stale or missing aggregates of the topics under the node, deepest first, and
+    the serialized details of the node if they have changed.
+
+    :return: A tuple of the serialized details of the node as a JSON string, and their etag
+    """
+    topics_by_level = {}
+    for topic_id, level in (
+        node.get_descendants(include_self=True)
+        .filter(Q(kind_id=content_kinds.TOPIC) | Q(pk=node.pk))
+        .filter(Q(details__isnull=True) | Q(details__stale=True))
+        .values_list("id", "level")
+        .order_by()
+    ):
+        topics_by_level.setdefault(level, []).append(topic_id)
+
+    for level in sorted(topics_by_level, reverse=True):
+        topic_ids = topics_by_level[level]
+        for i in range(0, len(topic_ids), DETAILS_BATCH_SIZE):
+            _refresh_topics(node.tree_id, topic_ids[i:i + DETAILS_BATCH_SIZE], level)
+
+    aggregates, data, etag = ContentNodeDetails.objects.filter(contentnode_id=node.pk).values_list(
+        "aggregates", "data", "etag"
+    )[0]
+    if data is None:
+        details = serialize_node_details(node, aggregates, channel_id=channel_id)
+        # the etag identifies the contents, which don't change with the time they were serialized at
+        etag = hashlib.md5(
+            json.dumps(dict(details, last_update=None), sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        data = json.dumps(details)
+        ContentNodeDetails.objects.filter(contentnode_id=node.pk).update(data=data, etag=etag)
+    return data, etag
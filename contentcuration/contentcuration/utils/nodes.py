@@ -12,7 +12,7 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import ValidationError
 from django.core.files.storage import default_storage
-from django.db.models import Count
+from django.db import connection
 from django.db.models import Sum
 from django.utils import timezone
 from le_utils.constants import content_kinds
@@ -24,6 +24,7 @@ from contentcuration.models import File
 from contentcuration.models import FormatPreset
 from contentcuration.models import generate_object_storage_name
 from contentcuration.models import Language
+from contentcuration.models import TreeResourceSize
 from contentcuration.models import User
 from contentcuration.utils.cache import ResourceSizeCache
 from contentcuration.utils.files import get_thumbnail_encoding
@@ -192,35 +193,117 @@ def get_diff(updated, original):
     return None
 
 
-def generate_diff(updated_id, original_id):
-    updated = ContentNode.objects.filter(pk=updated_id).first()
-    original = ContentNode.objects.filter(pk=original_id).first()
-
-    main_descendants = original.get_descendants() if original else None
-    updated_descendants = updated.get_descendants() if updated else None
-
-    original_stats = main_descendants.values('kind_id').annotate(count=Count('kind_id')).order_by() if original else {}
-    updated_stats = updated_descendants.values('kind_id').annotate(count=Count('kind_id')).order_by() if updated else {}
+TREE_STATS_SQL = """
+SELECT n.kind_id, COUNT(*), COALESCE(SUM(f.file_size), 0), COALESCE(SUM(f.subtitle_count), 0),
+    COALESCE(SUM(a.question_count), 0), COALESCE(SUM(a.file_size), 0)
+FROM contentcuration_contentnode n
+LEFT JOIN LATERAL (
+    SELECT SUM(file_size) AS file_size, COUNT(*) FILTER (WHERE preset_id = %s) AS subtitle_count
+    FROM contentcuration_file WHERE contentnode_id = n.id
+) f ON true
+LEFT JOIN LATERAL (
+    SELECT COUNT(DISTINCT ai.id) AS question_count, SUM(af.file_size) AS file_size
+    FROM contentcuration_assessmentitem ai
+    LEFT JOIN contentcuration_file af ON af.assessment_item_id = ai.id
+    WHERE ai.contentnode_id = n.id AND NOT ai.deleted
+) a ON true
+WHERE n.tree_id = %s AND n.lft > %s AND n.rght < %s
+GROUP BY n.kind_id
+"""
+
+TREE_NODES_SQL = """
+SELECT n.node_id, n.kind_id, n.title, n.content_id, n.description, n.license_id, n.language_id, p.node_id,
+    (SELECT string_agg(f.checksum, ',' ORDER BY f.checksum) FROM contentcuration_file f
+        WHERE f.contentnode_id = n.id),
+    (SELECT md5(string_agg(ai.assessment_id || ai.question || ai.answers || ai.hints, ',' ORDER BY ai."order"))
+        FROM contentcuration_assessmentitem ai WHERE ai.contentnode_id = n.id AND NOT ai.deleted)
+FROM contentcuration_contentnode n
+LEFT JOIN contentcuration_contentnode p ON p.id = n.parent_id
+WHERE n.tree_id = %s AND n.lft > %s AND n.rght < %s
+"""
+
+# Fields compared between the versions of a node in both trees, after its node_id, kind and title
+DIFF_NODE_FIELDS = ("content_id", "description", "license", "language", "parent", "files", "questions")
+
+
+def _get_tree_stats(node):
+    """
+    Counts the descendants of the node by kind, along with their file sizes, questions and subtitles,
+    in a single query grouped by kind
+    """
+    stats = {"kind_counts": {}, "file_size": 0, "question_count": 0, "subtitle_count": 0}
+    if not node:
+        return stats
+    with connection.cursor() as cursor:
+        cursor.execute(TREE_STATS_SQL, [format_presets.VIDEO_SUBTITLE, node.tree_id, node.lft, node.rght])
+        for kind_id, count, file_size, subtitle_count, question_count, assessment_size in cursor.fetchall():
+            stats["kind_counts"][kind_id] = count
+            stats["file_size"] += file_size + assessment_size
+            stats["question_count"] += question_count
+            stats["subtitle_count"] += subtitle_count
+    return stats
+
+
+def _get_tree_nodes(node):
+    if not node:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(TREE_NODES_SQL, [node.tree_id, node.lft, node.rght])
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def _generate_node_diff(updated, original):
+    """
+    Compares the descendants of both nodes by node_id
 
-    original_file_sizes = main_descendants.aggregate(
-        resource_size=Sum('files__file_size'),
-        assessment_size=Sum('assessment_items__files__file_size'),
-        assessment_count=Count('assessment_items'),
-    ) if original else {}
+    :return: A dict of the nodes added to, removed from and changed in the updated tree, each keyed by node_id
+    """
+    updated_nodes = _get_tree_nodes(updated)
+    original_nodes = _get_tree_nodes(original)
+    diff = {"added": {}, "removed": {}, "changed": {}}
+    fields = ("kind", "title") + DIFF_NODE_FIELDS
+
+    for node_id, values in original_nodes.items():
+        if node_id not in updated_nodes:
+            diff["removed"][node_id] = {"kind": values[0], "title": values[1]}
+    for node_id, values in updated_nodes.items():
+        original_values = original_nodes.get(node_id)
+        if original_values is None:
+            diff["added"][node_id] = {"kind": values[0], "title": values[1]}
+        elif original_values != values:
+            diff["changed"][node_id] = {
+                "kind": values[0],
+                "title": values[1],
+                "fields": [field for field, new, old in zip(fields, values, original_values) if new != old],
+            }
+    return diff
+
+
+def _get_stat(field, original, changed, **extra):
+    stat = {"field": field, "original": original, "changed": changed, "difference": changed - original}
+    stat.update(extra)
+    return stat
+
+
+def generate_diff(updated_id, original_id, include_nodes=False):
+    """
+    Compares the descendants of the updated node, usually the root of a staging tree, with those of the
+    original one, and saves the diff so it can be fetched with `get_diff`
 
-    updated_file_sizes = updated_descendants.aggregate(
-        resource_size=Sum('files__file_size'),
-        assessment_size=Sum('assessment_items__files__file_size'),
-        assessment_count=Count('assessment_items')
-    ) if updated else {}
+    :param include_nodes: Whether to also report the nodes that were added, removed or changed, by node_id
+    """
+    updated = ContentNode.objects.filter(pk=updated_id).first()
+    original = ContentNode.objects.filter(pk=original_id).first()
 
-    original_file_size = (original_file_sizes.get('resource_size') or 0) + (original_file_sizes.get('assessment_size') or 0)
-    updated_file_size = (updated_file_sizes.get('resource_size') or 0) + (updated_file_sizes.get('assessment_size') or 0)
-    original_question_count = original_file_sizes.get('assessment_count') or 0
-    updated_question_count = updated_file_sizes.get('assessment_count') or 0
+    original_stats = _get_tree_stats(original)
+    updated_stats = _get_tree_stats(updated)
 
-    original_resource_count = original.get_descendants().exclude(kind_id='topic').count() if original else 0
-    updated_resource_count = updated.get_descendants().exclude(kind_id='topic').count() if updated else 0
+    original_resource_count = sum(
+        count for kind, count in original_stats["kind_counts"].items() if kind != content_kinds.TOPIC
+    )
+    updated_resource_count = sum(
+        count for kind, count in updated_stats["kind_counts"].items() if kind != content_kinds.TOPIC
+    )
 
     stats = [
         {
@@ -233,43 +316,19 @@ def generate_diff(updated_id, original_id):
             "original": original.extra_fields.get('ricecooker_version') if original and original.extra_fields else "",
             "changed": updated.extra_fields.get('ricecooker_version') if updated and updated.extra_fields else "",
         },
-        {
-            "field": "file_size_in_bytes",
-            "original": original_file_size,
-            "changed": updated_file_size,
-            "difference": updated_file_size - original_file_size,
-            "format_size": True,
-        },
-        {
-            "field": "count_resources",
-            "original": original_resource_count,
-            "changed": updated_resource_count,
-            "difference": updated_resource_count - original_resource_count,
-        }
+        _get_stat("file_size_in_bytes", original_stats["file_size"], updated_stats["file_size"], format_size=True),
+        _get_stat("count_resources", original_resource_count, updated_resource_count),
     ]
 
     for kind, name in content_kinds.choices:
-        original_kind = original_stats.get(kind_id=kind)['count'] if original and original_stats.filter(kind_id=kind).exists() else 0
-        updated_kind = updated_stats.get(kind_id=kind)['count'] if updated and updated_stats.filter(kind_id=kind).exists() else 0
-        stats.append({"field": "count_{}s".format(kind), "original": original_kind, "changed": updated_kind, "difference": updated_kind - original_kind})
-
-    # Add number of questions
-    stats.append({
-        "field": "count_questions",
-        "original": original_question_count,
-        "changed": updated_question_count,
-        "difference": updated_question_count - original_question_count,
-    })
-
-    # Add number of subtitles
-    original_subtitle_count = main_descendants.filter(files__preset_id=format_presets.VIDEO_SUBTITLE).count() if original else 0
-    updated_subtitle_count = updated_descendants.filter(files__preset_id=format_presets.VIDEO_SUBTITLE).count() if updated else 0
-    stats.append({
-        "field": "count_subtitles",
-        "original": original_subtitle_count,
-        "changed": updated_subtitle_count,
-        "difference": updated_subtitle_count - original_subtitle_count,
-    })
+        stats.append(_get_stat(
+            "count_{}s".format(kind),
+            original_stats["kind_counts"].get(kind, 0),
+            updated_stats["kind_counts"].get(kind, 0),
+        ))
+
+    stats.append(_get_stat("count_questions", original_stats["question_count"], updated_stats["question_count"]))
+    stats.append(_get_stat("count_subtitles", original_stats["subtitle_count"], updated_stats["subtitle_count"]))
 
     # Do one more check before we write the json file in case multiple tasks were triggered
     # and we need to ensure that we don't overwrite the latest version of the changed diff
@@ -281,6 +340,8 @@ def generate_diff(updated_id, original_id):
             'generated': creation_time,
             'stats': stats
         }
+        if include_nodes:
+            jsondata['nodes'] = _generate_node_diff(updated, original)
         jsonpath = _get_diff_filepath(updated_id, original_id)
         default_storage.save(jsonpath, BytesIO(json.dumps(jsondata).encode('utf-8')))
 
@@ -390,6 +451,13 @@ def calculate_resource_size(node, force=False):
     :return: A tuple of (size, stale)
     :rtype: (int, bool)
     """
+    if node.is_root_node():
+        # the size of whole trees is maintained as files change, so it's never stale, and forcing
+        # the calculation recounts it from scratch
+        if force:
+            return TreeResourceSize.rebuild(node.tree_id), False
+        return TreeResourceSize.get_size(node.tree_id), False
+
     cache = ResourceSizeCache(node)
     db = ResourceSizeHelper(node)
 
@@ -1,17 +1,50 @@
+import base64
+import binascii
 import hashlib
+import json
+from datetime import datetime
 
 from django.core.cache import cache
 from django.core.exceptions import EmptyResultSet
 from django.core.paginator import InvalidPage
 from django.core.paginator import Page
 from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
 from django.db.models import QuerySet
+from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
+from rest_framework.pagination import BasePagination
 from rest_framework.pagination import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import _positive_int
 from rest_framework.response import Response
 
 
+def get_cached_count(queryset):
+    """
+    The count is implemented with this 'double cache' so as to cache the empty results
+    as well. Because the cache key is dependent on the query string, and that cannot be
+    generated in the instance that the query_string produces an EmptyResultSet exception.
+    """
+    try:
+        query_string = str(queryset.query).encode("utf8")
+        cache_key = (
+            "query-count:"
+            + hashlib.md5(query_string).hexdigest()
+        )
+        value = cache.get(cache_key)
+        if value is None:
+            value = queryset.count()
+            cache.set(cache_key, value, 300)  # save the count for 5 minutes
+    except EmptyResultSet:
+        # If the query is an empty result set, then this error will be raised by
+        # Django - this happens, for example when doing a pk__in=[] query
+        # In this case, we know the value is just 0!
+        value = 0
+    return value
+
+
 class ValuesPage(Page):
     def __init__(self, object_list, number, paginator):
         self.queryset = object_list
@@ -36,27 +69,7 @@ class ValuesViewsetPaginator(Paginator):
 class CachedValuesViewsetPaginator(ValuesViewsetPaginator):
     @cached_property
     def count(self):
-        """
-        The count is implemented with this 'double cache' so as to cache the empty results
-        as well. Because the cache key is dependent on the query string, and that cannot be
-        generated in the instance that the query_string produces an EmptyResultSet exception.
-        """
-        try:
-            query_string = str(self.object_list.query).encode("utf8")
-            cache_key = (
-                "query-count:"
-                + hashlib.md5(query_string).hexdigest()
-            )
-            value = cache.get(cache_key)
-            if value is None:
-                value = super(CachedValuesViewsetPaginator, self).count
-                cache.set(cache_key, value, 300)  # save the count for 5 minutes
-        except EmptyResultSet:
-            # If the query is an empty result set, then this error will be raised by
-            # Django - this happens, for example when doing a pk__in=[] query
-            # In this case, we know the value is just 0!
-            value = 0
-        return value
+        return get_cached_count(self.object_list)
 
 
 class ValuesViewsetPageNumberPagination(PageNumberPagination):
@@ -129,3 +142,134 @@ class ValuesViewsetPageNumberPagination(PageNumberPagination):
 
 class CachedListPagination(ValuesViewsetPageNumberPagination):
     django_paginator_class = CachedValuesViewsetPaginator
+
+
+class ValuesViewsetCursorPagination(BasePagination):
+    """
+    Keyset pagination for values viewsets. Rather than counting rows with an OFFSET, each page
+    carries on from the position of the last row of the page before, as given by an opaque cursor,
+    so every page costs the same to fetch, however deep it is. The total count is only computed
+    when asked for with the `count` query param, and is cached like in CachedListPagination.
+    """
+    cursor_query_param = "cursor"
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    count_query_param = "count"
+    # The field to order by, prefixed with "-" to order descending. It must not be nullable, and it
+    # should be indexed, rows with the same value are ordered by their pk.
+    ordering = "pk"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def encode_cursor(self, position, reverse):
+        value, pk = position
+        # Datetimes are encoded in full, as DjangoJSONEncoder would truncate them to milliseconds and
+        # rows in between the truncated and the actual value would be skipped
+        is_datetime = isinstance(value, datetime)
+        if is_datetime:
+            value = value.isoformat()
+        data = json.dumps([value, pk, reverse, is_datetime], cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode("utf8")).decode("ascii")
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk, reverse, is_datetime = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")).decode("utf8"))
+            if is_datetime:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError("Invalid datetime")
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk, bool(reverse)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        Returns the queryset of the page, rather than a list, so that it can be further annotated
+        for serialization, as in ValuesViewsetPageNumberPagination
+        """
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        self.request = request
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor[2]
+
+        keys = queryset.order_by()
+        if cursor is not None:
+            value, pk, _ = cursor
+            # Rows after the cursor position, or before it when paging backwards
+            lookup = "lt" if descending != reverse else "gt"
+            keys = keys.filter(
+                Q(**{"{}__{}".format(field, lookup): value})
+                | Q(**{field: value, "pk__{}".format(lookup): pk})
+            )
+        key_order = ("-" if descending != reverse else "") + field, ("-" if descending != reverse else "") + "pk"
+        positions = list(keys.order_by(*key_order).values_list(field, "pk").distinct()[:page_size + 1])
+
+        has_more = len(positions) > page_size
+        positions = positions[:page_size]
+        if reverse:
+            positions.reverse()
+        has_next = has_more if not reverse else True
+        has_previous = has_more if reverse else cursor is not None
+
+        self.next_cursor = self.encode_cursor(positions[-1], False) if positions and has_next else None
+        self.previous_cursor = self.encode_cursor(positions[0], True) if positions and has_previous else None
+        self.page_pks = [pk for _, pk in positions]
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ("true", "1"):
+            self.count = get_cached_count(queryset.values_list("pk", flat=True).distinct())
+
+        return queryset.filter(pk__in=self.page_pks)
+
+    def get_paginated_response(self, data):
+        # Annotations may have reset the ordering of the page queryset, so put the results back in
+        # the order of the keys
+        order = {pk: index for index, pk in enumerate(self.page_pks)}
+        data = sorted(data, key=lambda item: order.get(item.get("id"), len(order)))
+        response = {
+            "next": self.next_cursor,
+            "previous": self.previous_cursor,
+            "results": data,
+        }
+        if self.count is not None:
+            response["count"] = self.count
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'previous': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'count': {
+                    'type': 'integer',
+                    'example': 123,
+                },
+                'results': schema,
+            },
+        }
@@ -1,25 +1,35 @@
 from __future__ import division
 
 import collections
+import hashlib
 import itertools
 import json
 import logging as logmodule
 import os
 import re
+import shutil
 import tempfile
+import threading
 import time
 import traceback
 import uuid
 import zipfile
 from builtins import str
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files import File
 from django.core.files.storage import default_storage as storage
 from django.core.management import call_command
+from django.db import connections
+from django.db import DatabaseError
 from django.db import transaction
+from django.db.migrations.executor import MigrationExecutor
 from django.db.models import Count
+from django.db.models import Prefetch
 from django.db.models import Q
 from django.db.models import Sum
 from django.db.utils import IntegrityError
@@ -53,6 +63,19 @@ PERSEUS_IMG_DIR = exercises.IMG_PLACEHOLDER + "/images"
 THUMBNAIL_DIMENSION = 128
 MIN_SCHEMA_VERSION = "1"
 BLOCKING_TASK_TYPES = ["duplicate-nodes", "move-nodes", "sync-channel"]
+# Number of nodes to read from Studio and write to the export
+# database at once when using the bulk publish mode
+PUBLISH_BATCH_SIZE = 1000
+# Number of threads used to build perseus exercise zips in parallel
+PERSEUS_WORKERS = 8
+# Share of the publish progress spent building exercises in the bulk and incremental modes
+EXERCISES_PERCENT = 30.0
+# Part of the key of cached perseus zips, bump it whenever the perseus templates or the way
+# the zips are written change so that every exercise gets regenerated on its next publish
+PERSEUS_TEMPLATE_VERSION = 1
+# Number of nodes without a language of their own to look up in a previous export,
+# to tell whether it was made with a different default language
+DEFAULT_LANGUAGE_SAMPLE_SIZE = 100
 
 
 def send_emails(channel, user_id, version_notes=''):
@@ -71,14 +94,23 @@ def send_emails(channel, user_id, version_notes=''):
             user.email_user(subject, message, settings.DEFAULT_FROM_EMAIL, )
 
 
-def create_content_database(channel, force, user_id, force_exercises, progress_tracker=None):
+def create_content_database(channel, force, user_id, force_exercises, progress_tracker=None, bulk=False, incremental=False):
     """
     :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+    :param bulk: Map the tree with the set-based `map_content_nodes_bulk` instead of node by node
+    :param incremental: Update the previously exported database when it can be reused,
+        otherwise fall back to building a new one
     """
     # increment the channel version
     if not force:
         raise_if_nodes_are_all_unchanged(channel)
-    fh, tempdb = tempfile.mkstemp(suffix=".sqlite3")
+
+    tempdb = None
+    if incremental and not force_exercises:
+        tempdb = get_previous_content_database(channel)
+    if tempdb is None:
+        fh, tempdb = tempfile.mkstemp(suffix=".sqlite3")
+        incremental = False
 
     with using_content_database(tempdb):
         channel.main_tree.publishing = True
@@ -90,15 +122,28 @@ def create_content_database(channel, force, user_id, force_exercises, progress_t
                      no_input=True)
         if progress_tracker:
             progress_tracker.track(10)
-        map_content_nodes(
-            channel.main_tree,
-            channel.language,
-            channel.id,
-            channel.name,
-            user_id=user_id,
-            force_exercises=force_exercises,
-            progress_tracker=progress_tracker,
-        )
+        if incremental:
+            map_content_nodes_incremental(
+                channel.main_tree,
+                channel.language,
+                channel.id,
+                channel.name,
+                channel.last_published,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+            )
+        else:
+            map_nodes = map_content_nodes_bulk if bulk else map_content_nodes
+            map_nodes(
+                channel.main_tree,
+                channel.language,
+                channel.id,
+                channel.name,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+            )
         map_channel_to_kolibri_channel(channel)
         # It should be at this percent already, but just in case.
         if progress_tracker:
@@ -183,6 +228,518 @@ def map_content_nodes(  # noqa: C901
                     progress_tracker.increment(increment=percent_per_node)
 
 
+def get_publishable_tree_structure(root_node):  # noqa: C901
+    """
+    Reads the structure of the tree under `root_node` in a single query and works out
+    which nodes will be published, mirroring the rules applied by `map_content_nodes`:
+    a node is published when it is complete, has at least one non-topic node in its
+    family, and its parent is published.
+
+    Returns a list of dicts for the nodes to publish in breadth first order (the order in
+    which `map_content_nodes` visits them), each annotated with the `lft`, `rght`, `level`
+    and `tree_id` values the node will have in the exported database.
+    """
+    nodes = list(
+        ccmodels.ContentNode.objects.filter(
+            tree_id=root_node.tree_id,
+            lft__gte=root_node.lft,
+            rght__lte=root_node.rght,
+        )
+        .values("id", "node_id", "parent_id", "kind_id", "complete", "lft", "rght", "level")
+        .order_by("lft")
+    )
+
+    # Mark every node that has a non-topic node in its family with one pass over lft/rght,
+    # keeping a stack of the ancestors of the current node.
+    has_resources = {}
+    ancestors = []
+    for node in nodes:
+        while ancestors and ancestors[-1]["rght"] < node["lft"]:
+            ancestors.pop()
+        has_resources[node["id"]] = False
+        if node["kind_id"] != content_kinds.TOPIC:
+            has_resources[node["id"]] = True
+            # Once an ancestor is marked, all of its own ancestors already are.
+            for ancestor in reversed(ancestors):
+                if has_resources[ancestor["id"]]:
+                    break
+                has_resources[ancestor["id"]] = True
+        ancestors.append(node)
+
+    # Parents always precede their children in lft order, so one more pass is enough
+    # to propagate the exclusion of incomplete or empty topics down the tree.
+    published = []
+    published_ids = set()
+    for node in nodes:
+        if (
+            node["complete"]
+            and has_resources[node["id"]]
+            and (node["id"] == root_node.id or node["parent_id"] in published_ids)
+        ):
+            published_ids.add(node["id"])
+            published.append(node)
+
+    # Number the published nodes depth first, as the export database tree is rebuilt
+    # from scratch in the same order as the source tree.
+    counter = 1
+    ancestors = []
+    for node in published:
+        while ancestors and ancestors[-1]["rght"] < node["lft"]:
+            ancestors.pop()["export_rght"] = counter
+            counter += 1
+        node["export_lft"] = counter
+        node["export_level"] = len(ancestors)
+        node["export_tree_id"] = 1
+        counter += 1
+        ancestors.append(node)
+    while ancestors:
+        ancestors.pop()["export_rght"] = counter
+        counter += 1
+
+    # Breadth first order is equivalent to ordering by level, then lft
+    return sorted(published, key=lambda n: (n["level"], n["lft"]))
+
+
+def map_content_nodes_bulk(
+    root_node,
+    default_language,
+    channel_id,
+    channel_name,
+    user_id=None,
+    force_exercises=False,
+    progress_tracker=None,
+    batch_size=None,
+):
+    """
+    Set-based version of `map_content_nodes` that writes the same export database.
+
+    Instead of querying the descendants, files, tags and assessment items of each node one at
+    a time, the tree is read in a single query and the remaining data is fetched and written
+    with `bulk_create` for `batch_size` nodes at a time.
+
+    :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+    """
+    if not root_node.complete:
+        raise ValueError("Attempted to publish a channel with an incomplete root node")
+
+    structure = get_publishable_tree_structure(root_node)
+
+    with transaction.atomic(), transaction.atomic(using=get_active_content_database()):
+        with ccmodels.ContentNode.objects.delay_mptt_updates():
+            create_perseus_exercises(
+                root_node,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+                progress_percent=EXERCISES_PERCENT,
+                structure=structure,
+            )
+            _bulk_write_nodes(
+                root_node,
+                structure,
+                structure,
+                default_language,
+                channel_id,
+                channel_name,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+                batch_size=batch_size,
+                generate_exercises=False,
+                progress_percent=80.0 - EXERCISES_PERCENT,
+            )
+
+
+def _bulk_write_nodes(  # noqa: C901
+    root_node,
+    structure,
+    nodes_to_write,
+    default_language,
+    channel_id,
+    channel_name,
+    user_id=None,
+    force_exercises=False,
+    progress_tracker=None,
+    batch_size=None,
+    generate_exercises=True,
+    progress_percent=80.0,
+):
+    """
+    Writes the export database rows for `nodes_to_write`, a subset of the `structure`
+    returned by `get_publishable_tree_structure`, `batch_size` nodes at a time.
+
+    :param generate_exercises: Whether to create the perseus files of the exercises while
+        writing them, rather than them having been created by `create_perseus_exercises`
+    """
+    batch_size = batch_size or PUBLISH_BATCH_SIZE
+
+    percent_per_node = old_div(progress_percent, max(len(nodes_to_write), 1))
+
+    export_node_ids = {n["id"]: n["node_id"] for n in structure}
+    licenses = {}
+    # Anything already in the export database must not be inserted twice
+    languages = set(kolibrimodels.Language.objects.values_list("id", flat=True))
+    local_files = set(kolibrimodels.LocalFile.objects.values_list("id", flat=True))
+    tags = set(kolibrimodels.ContentTag.objects.values_list("id", flat=True))
+
+    for i in range(0, len(nodes_to_write), batch_size):
+        batch = nodes_to_write[i:i + batch_size]
+        node_ids = [n["id"] for n in batch]
+        ccnodes = ccmodels.ContentNode.objects.select_related("license", "language").in_bulk(node_ids)
+        ccnodes = [ccnodes[node_id] for node_id in node_ids]
+
+        kolibrinodes = []
+        for data, ccnode in zip(batch, ccnodes):
+            kolibri_license = None
+            if ccnode.license is not None:
+                license_key = (
+                    ccnode.license.license_name,
+                    ccnode.license.license_description if not ccnode.license.is_custom else ccnode.license_description,
+                )
+                if license_key not in licenses:
+                    licenses[license_key] = create_kolibri_license_object(ccnode)[0]
+                kolibri_license = licenses[license_key]
+
+            language = ccnode.language or default_language
+            if language and language.pk not in languages:
+                get_or_create_language(language)
+                languages.add(language.pk)
+
+            options = {}
+            if ccnode.extra_fields and 'options' in ccnode.extra_fields:
+                options = ccnode.extra_fields['options']
+
+            kolibrinodes.append(kolibrimodels.ContentNode(
+                id=ccnode.node_id,
+                parent_id=export_node_ids.get(data["parent_id"]) if ccnode.pk != root_node.pk else None,
+                kind=ccnode.kind_id,
+                title=ccnode.title if ccnode.parent_id else channel_name,
+                content_id=ccnode.content_id,
+                channel_id=channel_id,
+                author=ccnode.author or "",
+                description=ccnode.description,
+                sort_order=ccnode.sort_order,
+                license_owner=ccnode.copyright_holder or "",
+                license=kolibri_license,
+                available=True,  # Only nodes with resources in their family get published
+                stemmed_metaphone="",
+                lang_id=language and language.pk,
+                license_name=kolibri_license.license_name if kolibri_license is not None else None,
+                license_description=kolibri_license.license_description if kolibri_license is not None else None,
+                coach_content=ccnode.role_visibility == roles.COACH,
+                options=json.dumps(options),
+                lft=data["export_lft"],
+                rght=data["export_rght"],
+                level=data["export_level"],
+                tree_id=data["export_tree_id"],
+            ))
+        kolibrimodels.ContentNode.objects.bulk_create(kolibrinodes, batch_size=batch_size)
+
+        _bulk_map_exercises_and_slideshows(
+            ccnodes, kolibrinodes, user_id, force_exercises, batch_size, generate_exercises=generate_exercises
+        )
+        _bulk_map_files(ccnodes, languages, local_files, batch_size)
+        _bulk_map_tags(node_ids, tags, batch_size)
+
+        if progress_tracker:
+            progress_tracker.increment(increment=percent_per_node * len(batch))
+
+
+def _bulk_map_exercises_and_slideshows(ccnodes, kolibrinodes, user_id, force_exercises, batch_size, generate_exercises=True):
+    exercise_ids = [n.id for n in ccnodes if n.kind_id == content_kinds.EXERCISE]
+    assessment_items = collections.defaultdict(list)
+    has_exercise_file = set()
+    if exercise_ids:
+        for item in ccmodels.AssessmentItem.objects.filter(contentnode_id__in=exercise_ids).order_by("order"):
+            assessment_items[item.contentnode_id].append(item)
+    if exercise_ids and generate_exercises:
+        has_exercise_file = set(
+            ccmodels.File.objects.filter(contentnode_id__in=exercise_ids, preset_id=format_presets.EXERCISE)
+            .values_list("contentnode_id", flat=True)
+        )
+    metadata = []
+    for ccnode, kolibrinode in zip(ccnodes, kolibrinodes):
+        if ccnode.kind_id == content_kinds.EXERCISE:
+            exercise_data, assessment_metadata = get_assessment_metadata(ccnode, assessment_items[ccnode.id])
+            metadata.append(kolibrimodels.AssessmentMetaData(contentnode=kolibrinode, **assessment_metadata))
+            if generate_exercises and (force_exercises or ccnode.changed or ccnode.id not in has_exercise_file):
+                create_perseus_exercise(ccnode, kolibrinode, exercise_data, user_id=user_id)
+        elif ccnode.kind_id == content_kinds.SLIDESHOW:
+            create_slideshow_manifest(ccnode, kolibrinode, user_id=user_id)
+    kolibrimodels.AssessmentMetaData.objects.bulk_create(metadata, batch_size=batch_size)
+
+
+def _bulk_map_files(ccnodes, languages, local_files, batch_size):
+    ccnodes_by_id = {n.id: n for n in ccnodes}
+    files = (
+        ccmodels.File.objects.filter(contentnode_id__in=list(ccnodes_by_id.keys()))
+        .exclude(Q(preset_id=format_presets.EXERCISE_IMAGE) | Q(preset_id=format_presets.EXERCISE_GRAPHIE))
+        .select_related("preset", "file_format", "language", "uploaded_by")
+    )
+    files_by_node = collections.defaultdict(list)
+    for ccfilemodel in files:
+        files_by_node[ccfilemodel.contentnode_id].append(ccfilemodel)
+
+    kolibri_local_files = []
+    kolibri_files = []
+    for ccnode in ccnodes:
+        for ccfilemodel in files_by_node[ccnode.id]:
+            preset = ccfilemodel.preset
+            fformat = ccfilemodel.file_format
+            if ccfilemodel.language and ccfilemodel.language.pk not in languages:
+                get_or_create_language(ccfilemodel.language)
+                languages.add(ccfilemodel.language.pk)
+
+            if preset.thumbnail:
+                ccfilemodel = create_associated_thumbnail(ccnode, ccfilemodel) or ccfilemodel
+
+            if ccfilemodel.checksum not in local_files:
+                local_files.add(ccfilemodel.checksum)
+                kolibri_local_files.append(kolibrimodels.LocalFile(
+                    id=ccfilemodel.checksum,
+                    extension=fformat.extension,
+                    file_size=ccfilemodel.file_size,
+                ))
+
+            kolibri_files.append(kolibrimodels.File(
+                id=ccfilemodel.pk,
+                checksum=ccfilemodel.checksum,
+                extension=fformat.extension,
+                available=True,  # TODO: Set this to False, once we have availability stamping implemented in Kolibri
+                file_size=ccfilemodel.file_size,
+                contentnode_id=ccnode.node_id,
+                preset=preset.pk,
+                supplementary=preset.supplementary,
+                lang_id=ccfilemodel.language and ccfilemodel.language.pk,
+                thumbnail=preset.thumbnail,
+                priority=preset.order,
+                local_file_id=ccfilemodel.checksum,
+            ))
+    kolibrimodels.LocalFile.objects.bulk_create(kolibri_local_files, batch_size=batch_size)
+    kolibrimodels.File.objects.bulk_create(kolibri_files, batch_size=batch_size)
+
+
+def _bulk_map_tags(node_ids, tags, batch_size):
+    tag_mappings = ccmodels.ContentNode.tags.through.objects.filter(contentnode_id__in=node_ids)\
+        .values_list("contentnode__node_id", "contenttag_id", "contenttag__tag_name")
+    kolibri_tags = []
+    kolibri_tag_mappings = []
+    for node_id, tag_id, tag_name in tag_mappings:
+        if tag_id not in tags:
+            tags.add(tag_id)
+            kolibri_tags.append(kolibrimodels.ContentTag(id=tag_id, tag_name=tag_name))
+        kolibri_tag_mappings.append(kolibrimodels.ContentNode.tags.through(contentnode_id=node_id, contenttag_id=tag_id))
+    kolibrimodels.ContentTag.objects.bulk_create(kolibri_tags, batch_size=batch_size)
+    kolibrimodels.ContentNode.tags.through.objects.bulk_create(kolibri_tag_mappings, batch_size=batch_size)
+
+
+def map_content_nodes_incremental(
+    root_node,
+    default_language,
+    channel_id,
+    channel_name,
+    last_published,
+    user_id=None,
+    force_exercises=False,
+    progress_tracker=None,
+    batch_size=None,
+):
+    """
+    Updates the previously exported database of the channel in place, rather than mapping the
+    whole tree again. Only the nodes that changed since `last_published`, or whose availability
+    changed, are rewritten, along with the root when the channel was renamed, and nodes that are
+    no longer published are deleted. The mptt values of the nodes that are kept are updated to
+    match the new tree.
+
+    :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+    """
+    if not root_node.complete:
+        raise ValueError("Attempted to publish a channel with an incomplete root node")
+
+    batch_size = batch_size or PUBLISH_BATCH_SIZE
+    export_db = get_active_content_database()
+    structure = get_publishable_tree_structure(root_node)
+    published = {n["node_id"]: n for n in structure}
+
+    changed = set(
+        root_node.get_descendants(include_self=True)
+        .filter(Q(changed=True) | Q(modified__gt=last_published))
+        .values_list("node_id", flat=True)
+    )
+    # The root is exported with the channel name as its title, which can change without touching the root
+    exported_root_title = kolibrimodels.ContentNode.objects.filter(id=root_node.node_id).values_list("title", flat=True).first()
+    if exported_root_title != channel_name:
+        changed.add(root_node.node_id)
+    existing = {
+        n[0]: n[1:]
+        for n in kolibrimodels.ContentNode.objects.values_list("id", "parent_id", "lft", "rght", "level", "tree_id")
+    }
+    nodes_to_delete = [
+        node_id for node_id in existing if node_id not in published or node_id in changed
+    ]
+    nodes_to_write = [
+        n for n in structure if n["node_id"] not in existing or n["node_id"] in changed
+    ]
+
+    export_node_ids = {n["id"]: n["node_id"] for n in structure}
+    mptt_updates = []
+    for node_id, values in existing.items():
+        node = published.get(node_id)
+        if node is None or node_id in changed:
+            continue
+        new_values = (
+            export_node_ids.get(node["parent_id"]) if node["id"] != root_node.id else None,
+            node["export_lft"],
+            node["export_rght"],
+            node["export_level"],
+            node["export_tree_id"],
+        )
+        if new_values != values:
+            mptt_updates.append(new_values + (node_id,))
+
+    logging.info("Incremental publish: writing {} nodes, deleting {} nodes, moving {} nodes".format(
+        len(nodes_to_write), len(nodes_to_delete), len(mptt_updates)
+    ))
+
+    with transaction.atomic(), transaction.atomic(using=export_db):
+        with ccmodels.ContentNode.objects.delay_mptt_updates():
+            # Channel metadata and prerequisites are mapped again from scratch after the nodes
+            kolibrimodels.ChannelMetadata.objects.all().delete()
+            kolibrimodels.ContentNode.has_prerequisite.through.objects.all().delete()
+
+            _delete_export_nodes(nodes_to_delete, export_db, batch_size)
+
+            with connections[export_db].cursor() as cursor:
+                cursor.executemany(
+                    "UPDATE {} SET parent_id = %s, lft = %s, rght = %s, level = %s, tree_id = %s WHERE id = %s".format(
+                        kolibrimodels.ContentNode._meta.db_table
+                    ),
+                    mptt_updates,
+                )
+
+            create_perseus_exercises(
+                root_node,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+                progress_percent=EXERCISES_PERCENT,
+                structure=structure,
+            )
+            _bulk_write_nodes(
+                root_node,
+                structure,
+                nodes_to_write,
+                default_language,
+                channel_id,
+                channel_name,
+                user_id=user_id,
+                force_exercises=force_exercises,
+                progress_tracker=progress_tracker,
+                batch_size=batch_size,
+                generate_exercises=False,
+                progress_percent=80.0 - EXERCISES_PERCENT,
+            )
+
+            # Clean up anything that is no longer referenced by the remaining nodes
+            kolibrimodels.LocalFile.objects.delete_orphan_file_objects()
+            kolibrimodels.ContentTag.objects.filter(tagged_content__isnull=True).delete()
+            kolibrimodels.License.objects.filter(contentnode__isnull=True).delete()
+            kolibrimodels.Language.objects.filter(contentnode__isnull=True, file__isnull=True).delete()
+
+
+def _delete_export_nodes(node_ids, export_db, batch_size):
+    """
+    Deletes the rows of the given nodes from the export database, without cascading
+    to their descendants, which may be kept or rewritten separately.
+    """
+    # Keep well below SQLite's limit on the number of query parameters
+    batch_size = min(batch_size, 500)
+    node_table = kolibrimodels.ContentNode._meta.db_table
+    related_tables = [
+        (kolibrimodels.File._meta.db_table, "contentnode_id"),
+        (kolibrimodels.AssessmentMetaData._meta.db_table, "contentnode_id"),
+        (kolibrimodels.ContentNode.tags.through._meta.db_table, "contentnode_id"),
+        (kolibrimodels.ContentNode.related.through._meta.db_table, "from_contentnode_id"),
+        (kolibrimodels.ContentNode.related.through._meta.db_table, "to_contentnode_id"),
+        (node_table, "id"),
+    ]
+    with connections[export_db].cursor() as cursor:
+        for i in range(0, len(node_ids), batch_size):
+            batch = node_ids[i:i + batch_size]
+            placeholders = ", ".join(["%s"] * len(batch))
+            for table, column in related_tables:
+                cursor.execute(
+                    "DELETE FROM {} WHERE {} IN ({})".format(table, column, placeholders),
+                    batch,
+                )
+
+
+def get_previous_content_database(channel):
+    """
+    Downloads the database exported by the last publish of `channel` to a temporary file,
+    so that it can be updated incrementally.
+
+    Returns the path of the temporary file, or None when there is no previous export or it
+    cannot be reused, because it was created for a different schema, channel version or
+    default language.
+    """
+    if not channel.last_published:
+        return None
+
+    export_db_location = os.path.join(settings.DB_ROOT, "{id}.sqlite3".format(id=channel.pk))
+    if not storage.exists(export_db_location):
+        return None
+
+    fh, tempdb = tempfile.mkstemp(suffix=".sqlite3")
+    with os.fdopen(fh, "wb") as tempf, storage.open(export_db_location, "rb") as exported:
+        shutil.copyfileobj(exported, tempf)
+
+    try:
+        reusable = is_content_database_reusable(tempdb, channel)
+    finally:
+        if tempdb in connections.databases:
+            connections[tempdb].close()
+            del connections.databases[tempdb]
+
+    if not reusable:
+        logging.info("Previous content database for {} cannot be reused".format(channel.pk))
+        os.remove(tempdb)
+        return None
+    return tempdb
+
+
+def is_content_database_reusable(alias, channel):
+    with using_content_database(alias):
+        try:
+            executor = MigrationExecutor(connections[get_active_content_database()])
+            if executor.migration_plan(executor.loader.graph.leaf_nodes("content")):
+                return False
+            metadata = kolibrimodels.ChannelMetadata.objects.filter(id=channel.pk).first()
+        except DatabaseError:
+            return False
+        return (
+            metadata is not None
+            and metadata.min_schema_version == MIN_SCHEMA_VERSION
+            and metadata.version == channel.version
+            and not default_language_changed(channel)
+        )
+
+
+def default_language_changed(channel):
+    """
+    Whether the default language of the channel changed since the active content database was
+    exported. Nodes without a language of their own are exported with the default language, so
+    this compares the exported language of some of them with the current default.
+    """
+    node_ids = list(
+        channel.main_tree.get_descendants(include_self=True)
+        .filter(language__isnull=True)
+        .values_list("node_id", flat=True)[:DEFAULT_LANGUAGE_SAMPLE_SIZE]
+    )
+    exported_languages = set(kolibrimodels.ContentNode.objects.filter(id__in=node_ids).values_list("lang_id", flat=True))
+    return bool(exported_languages - {channel.language_id})
+
+
 def create_slideshow_manifest(ccnode, kolibrinode, user_id=None):
     print("Creating slideshow manifest...")
 
@@ -350,34 +907,242 @@ def create_associated_file_objects(kolibrinode, ccnode):
 
 def create_perseus_exercise(ccnode, kolibrinode, exercise_data, user_id=None):
     logging.debug("Creating Perseus Exercise for Node {}".format(ccnode.title))
-    filename = "{0}.{ext}".format(ccnode.title, ext=file_formats.PERSEUS)
+    assessment_items = list(ccnode.assessment_items.prefetch_related('files').order_by('order'))
+    cache_key = get_perseus_cache_key(exercise_data, assessment_items)
+    if reuse_cached_perseus_file(ccnode, cache_key, user_id=user_id):
+        return
+
     temppath = None
     try:
-        with tempfile.NamedTemporaryFile(suffix="zip", delete=False) as tempf:
-            temppath = tempf.name
-            create_perseus_zip(ccnode, exercise_data, tempf)
-            file_size = tempf.tell()
-            tempf.flush()
+        temppath = create_perseus_zip_file(ccnode, exercise_data, assessment_items=assessment_items)
+        save_perseus_exercise_file(ccnode, temppath, user_id=user_id, cache_key=cache_key)
+    finally:
+        temppath and os.unlink(temppath)
 
-            ccnode.files.filter(preset_id=format_presets.EXERCISE).delete()
 
-            assessment_file_obj = ccmodels.File.objects.create(
-                file_on_disk=File(open(temppath, 'rb'), name=filename),
-                contentnode=ccnode,
-                file_format_id=file_formats.PERSEUS,
-                preset_id=format_presets.EXERCISE,
-                original_filename=filename,
-                file_size=file_size,
-                uploaded_by_id=user_id,
-            )
-            logging.debug("Created exercise for {0} with checksum {1}".format(ccnode.title, assessment_file_obj.checksum))
+def get_perseus_cache_key(exercise_data, assessment_items):
+    """
+    Returns a key that only changes when the contents of the perseus zip for an exercise would,
+    based on its exercise data, its ordered assessment items, their files and the templates.
+    """
+    payload = {
+        "template_version": PERSEUS_TEMPLATE_VERSION,
+        "exercise": exercise_data,
+        "assessment_items": [
+            {
+                "assessment_id": item.assessment_id,
+                "type": item.type,
+                "question": item.question,
+                "answers": item.answers,
+                "hints": item.hints,
+                "raw_data": item.raw_data,
+                "randomize": item.randomize,
+                "files": sorted(
+                    (f.checksum, f.file_format_id or "", f.preset_id or "", f.original_filename)
+                    for f in item.files.all()
+                ),
+            }
+            for item in assessment_items
+        ],
+    }
+    digest = hashlib.md5(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+    return "perseus_zip_{}".format(digest)
+
+
+def reuse_cached_perseus_file(ccnode, cache_key, user_id=None):
+    """
+    Points the exercise file of `ccnode` at a perseus zip previously generated with the same
+    `cache_key`, if that zip is still in storage. Returns whether it could be reused.
+    """
+    checksum = cache.get(cache_key)
+    if not checksum:
+        return False
+
+    exercise_files = ccnode.files.filter(preset_id=format_presets.EXERCISE)
+    if [f.checksum for f in exercise_files] == [checksum]:
+        return True
+
+    filename = "{0}.{ext}".format(ccnode.title, ext=file_formats.PERSEUS)
+    storage_name = ccmodels.generate_object_storage_name(checksum, filename)
+    if not storage.exists(storage_name):
+        return False
+
+    exercise_files.delete()
+    file_obj = ccmodels.File(
+        checksum=checksum,
+        contentnode=ccnode,
+        file_format_id=file_formats.PERSEUS,
+        preset_id=format_presets.EXERCISE,
+        original_filename=filename,
+        file_size=storage.size(storage_name),
+        uploaded_by_id=user_id,
+    )
+    file_obj.file_on_disk.name = storage_name
+    file_obj.save(set_by_file_on_disk=False)
+    logging.debug("Reused exercise for {0} with checksum {1}".format(ccnode.title, checksum))
+    return True
+
+
+def create_perseus_zip_file(ccnode, exercise_data, assessment_items=None, image_cache=None):
+    """
+    Writes the perseus zip for `ccnode` to a new temporary file and returns its path.
+    This does not touch the database when `assessment_items` are passed in with their
+    files already fetched, so it can safely be run in a worker thread.
+    """
+    with tempfile.NamedTemporaryFile(suffix="zip", delete=False) as tempf:
+        try:
+            create_perseus_zip(ccnode, exercise_data, tempf, assessment_items=assessment_items, image_cache=image_cache)
+        except Exception:
+            os.unlink(tempf.name)
+            raise
+        return tempf.name
+
+
+def save_perseus_exercise_file(ccnode, temppath, user_id=None, cache_key=None):
+    filename = "{0}.{ext}".format(ccnode.title, ext=file_formats.PERSEUS)
+    ccnode.files.filter(preset_id=format_presets.EXERCISE).delete()
+
+    with open(temppath, 'rb') as zipf:
+        assessment_file_obj = ccmodels.File.objects.create(
+            file_on_disk=File(zipf, name=filename),
+            contentnode=ccnode,
+            file_format_id=file_formats.PERSEUS,
+            preset_id=format_presets.EXERCISE,
+            original_filename=filename,
+            file_size=os.path.getsize(temppath),
+            uploaded_by_id=user_id,
+        )
+    logging.debug("Created exercise for {0} with checksum {1}".format(ccnode.title, assessment_file_obj.checksum))
+    if cache_key:
+        cache.set(cache_key, assessment_file_obj.checksum, None)
+    return assessment_file_obj
+
+
+class PerseusImageCache(object):
+    """
+    Makes sure each exercise image is only read from storage once while publishing a channel,
+    however many exercises or worker threads use it, by keeping a local copy of it.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="perseus_images_")
+        self._lock = threading.Lock()
+        self._file_locks = {}
+
+    def read(self, storage_name):
+        filename = os.path.basename(storage_name)
+        with self._lock:
+            file_lock = self._file_locks.setdefault(filename, threading.Lock())
+
+        path = os.path.join(self.directory, filename)
+        with file_lock:
+            if not os.path.exists(path):
+                with storage.open(storage_name, 'rb') as content, open(path, 'wb') as localf:
+                    shutil.copyfileobj(content, localf)
+        with open(path, 'rb') as localf:
+            return localf.read()
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class _StorageReader(object):
+    """
+    Reads exercise images straight from storage, for when no PerseusImageCache is given.
+    """
+
+    def read(self, storage_name):
+        with storage.open(storage_name, 'rb') as content:
+            return content.read()
+
+
+def create_perseus_exercises(  # noqa: C901
+    root_node,
+    user_id=None,
+    force_exercises=False,
+    progress_tracker=None,
+    progress_percent=0.0,
+    structure=None,
+    workers=None,
+):
+    """
+    Builds the perseus zips of all the exercises of the channel that will be published and
+    need (re)generating, in a pool of worker threads. Images are read from storage once per
+    channel, and the new exercise files are saved from the calling thread, so all database
+    writes stay in the publish transaction.
+
+    :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+    :param progress_percent: The percentage of the publish progress to report for this step
+    :param structure: The result of `get_publishable_tree_structure`, if already available
+    """
+    if structure is None:
+        structure = get_publishable_tree_structure(root_node)
+
+    exercise_ids = [n["id"] for n in structure if n["kind_id"] == content_kinds.EXERCISE]
+    exercise_nodes = ccmodels.ContentNode.objects.filter(id__in=exercise_ids)
+    if not force_exercises:
+        exercise_nodes = exercise_nodes.filter(
+            Q(changed=True) | ~Q(id__in=ccmodels.File.objects.filter(
+                contentnode_id__in=exercise_ids, preset_id=format_presets.EXERCISE
+            ).values_list("contentnode_id", flat=True))
+        )
+    exercise_ids = list(exercise_nodes.values_list("id", flat=True))
+    if not exercise_ids:
+        if progress_tracker:
+            progress_tracker.increment(increment=progress_percent)
+        return
+
+    percent_per_exercise = old_div(progress_percent, len(exercise_ids))
+    assessment_items = Prefetch(
+        "assessment_items",
+        queryset=ccmodels.AssessmentItem.objects.order_by("order").prefetch_related("files"),
+    )
+
+    image_cache = PerseusImageCache()
+    try:
+        with ThreadPoolExecutor(max_workers=workers or PERSEUS_WORKERS) as executor:
+            for i in range(0, len(exercise_ids), PUBLISH_BATCH_SIZE):
+                nodes = ccmodels.ContentNode.objects.filter(id__in=exercise_ids[i:i + PUBLISH_BATCH_SIZE])\
+                    .prefetch_related(assessment_items)
+                futures = {}
+                for ccnode in nodes:
+                    items = list(ccnode.assessment_items.all())
+                    exercise_data, _metadata = get_assessment_metadata(ccnode, items)
+                    cache_key = get_perseus_cache_key(exercise_data, items)
+                    if reuse_cached_perseus_file(ccnode, cache_key, user_id=user_id):
+                        if progress_tracker:
+                            progress_tracker.increment(increment=percent_per_exercise)
+                        continue
+                    future = executor.submit(create_perseus_zip_file, ccnode, exercise_data, items, image_cache)
+                    futures[future] = (ccnode, cache_key)
+
+                for future in as_completed(futures):
+                    ccnode, cache_key = futures[future]
+                    temppath = future.result()
+                    try:
+                        save_perseus_exercise_file(ccnode, temppath, user_id=user_id, cache_key=cache_key)
+                    finally:
+                        os.unlink(temppath)
+                    if progress_tracker:
+                        progress_tracker.increment(increment=percent_per_exercise)
     finally:
-        temppath and os.unlink(temppath)
+        image_cache.cleanup()
 
 
 def process_assessment_metadata(ccnode, kolibrinode):
-    # Get mastery model information, set to default if none provided
     assessment_items = ccnode.assessment_items.all().order_by('order')
+    exercise_data, assessment_metadata = get_assessment_metadata(ccnode, assessment_items)
+    kolibrimodels.AssessmentMetaData.objects.create(contentnode=kolibrinode, **assessment_metadata)
+    return exercise_data
+
+
+def get_assessment_metadata(ccnode, assessment_items):
+    """
+    Returns the exercise data used to build the perseus file and the fields of the
+    AssessmentMetaData for `ccnode`, given its ordered assessment items.
+    """
+    # Get mastery model information, set to default if none provided
+    assessment_items = list(assessment_items)
     exercise_data = ccnode.extra_fields if ccnode.extra_fields else {}
     if isinstance(exercise_data, basestring):
         exercise_data = json.loads(exercise_data)
@@ -386,10 +1151,10 @@ def process_assessment_metadata(ccnode, kolibrinode):
 
     mastery_model = {'type': exercise_data.get('mastery_model') or exercises.M_OF_N}
     if mastery_model['type'] == exercises.M_OF_N:
-        mastery_model.update({'n': exercise_data.get('n') or min(5, assessment_items.count()) or 1})
-        mastery_model.update({'m': exercise_data.get('m') or min(5, assessment_items.count()) or 1})
+        mastery_model.update({'n': exercise_data.get('n') or min(5, len(assessment_items)) or 1})
+        mastery_model.update({'m': exercise_data.get('m') or min(5, len(assessment_items)) or 1})
     elif mastery_model['type'] == exercises.DO_ALL:
-        mastery_model.update({'n': assessment_items.count() or 1, 'm': assessment_items.count() or 1})
+        mastery_model.update({'n': len(assessment_items) or 1, 'm': len(assessment_items) or 1})
     elif mastery_model['type'] == exercises.NUM_CORRECT_IN_A_ROW_2:
         mastery_model.update({'n': 2, 'm': 2})
     elif mastery_model['type'] == exercises.NUM_CORRECT_IN_A_ROW_3:
@@ -409,47 +1174,57 @@ def process_assessment_metadata(ccnode, kolibrinode):
         'assessment_mapping': {a.assessment_id: a.type if a.type != 'true_false' else exercises.SINGLE_SELECTION for a in assessment_items},
     })
 
-    kolibrimodels.AssessmentMetaData.objects.create(
-        id=uuid.uuid4(),
-        contentnode=kolibrinode,
-        assessment_item_ids=json.dumps(assessment_item_ids),
-        number_of_assessments=assessment_items.count(),
-        mastery_model=json.dumps(mastery_model),
-        randomize=randomize,
-        is_manipulable=ccnode.kind_id == content_kinds.EXERCISE,
-    )
+    assessment_metadata = {
+        'id': uuid.uuid4(),
+        'assessment_item_ids': json.dumps(assessment_item_ids),
+        'number_of_assessments': len(assessment_items),
+        'mastery_model': json.dumps(mastery_model),
+        'randomize': randomize,
+        'is_manipulable': ccnode.kind_id == content_kinds.EXERCISE,
+    }
 
-    return exercise_data
+    return exercise_data, assessment_metadata
 
 
-def create_perseus_zip(ccnode, exercise_data, write_to_path):
+def create_perseus_zip(ccnode, exercise_data, write_to_path, assessment_items=None, image_cache=None):  # noqa: C901
+    if assessment_items is None:
+        assessment_items = ccnode.assessment_items.prefetch_related('files').all().order_by('order')
+    image_cache = image_cache or _StorageReader()
+    # Track the zip members as we go, instead of scanning namelist() for every image
+    written = set()
+
     with zipfile.ZipFile(write_to_path, "w") as zf:
         try:
             exercise_context = {
                 'exercise': json.dumps(exercise_data, sort_keys=True, indent=4)
             }
             exercise_result = render_to_string('perseus/exercise.json', exercise_context)
-            write_to_zipfile("exercise.json", exercise_result, zf)
+            write_to_zipfile("exercise.json", exercise_result, zf, written)
 
-            for question in ccnode.assessment_items.prefetch_related('files').all().order_by('order'):
+            for question in assessment_items:
                 try:
-                    for image in question.files.filter(preset_id=format_presets.EXERCISE_IMAGE).order_by('checksum'):
+                    question_files = sorted(question.files.all(), key=lambda f: f.checksum)
+                    for image in question_files:
+                        if image.preset_id != format_presets.EXERCISE_IMAGE:
+                            continue
                         image_name = "images/{}.{}".format(image.checksum, image.file_format_id)
-                        if image_name not in zf.namelist():
-                            with storage.open(ccmodels.generate_object_storage_name(image.checksum, str(image)), 'rb') as content:
-                                write_to_zipfile(image_name, content.read(), zf)
+                        if image_name not in written:
+                            storage_name = ccmodels.generate_object_storage_name(image.checksum, image_name)
+                            write_to_zipfile(image_name, image_cache.read(storage_name), zf, written)
 
-                    for image in question.files.filter(preset_id=format_presets.EXERCISE_GRAPHIE).order_by('checksum'):
+                    for image in question_files:
+                        if image.preset_id != format_presets.EXERCISE_GRAPHIE:
+                            continue
                         svg_name = "images/{0}.svg".format(image.original_filename)
                         json_name = "images/{0}-data.json".format(image.original_filename)
-                        if svg_name not in zf.namelist() or json_name not in zf.namelist():
-                            with storage.open(ccmodels.generate_object_storage_name(image.checksum, str(image)), 'rb') as content:
-                                content = content.read()
-                                # in Python 3, delimiter needs to be in bytes format
-                                content = content.split(exercises.GRAPHIE_DELIMITER.encode('ascii'))
-                                write_to_zipfile(svg_name, content[0], zf)
-                                write_to_zipfile(json_name, content[1], zf)
-                    write_assessment_item(question, zf)
+                        if svg_name not in written or json_name not in written:
+                            filename = "{}.{}".format(image.checksum, image.file_format_id)
+                            content = image_cache.read(ccmodels.generate_object_storage_name(image.checksum, filename))
+                            # in Python 3, delimiter needs to be in bytes format
+                            content = content.split(exercises.GRAPHIE_DELIMITER.encode('ascii'))
+                            write_to_zipfile(svg_name, content[0], zf, written)
+                            write_to_zipfile(json_name, content[1], zf, written)
+                    write_assessment_item(question, zf, written, image_cache)
                 except Exception as e:
                     logging.error("Publishing error: {}".format(str(e)))
                     logging.error(traceback.format_exc())
@@ -463,15 +1238,17 @@ def create_perseus_zip(ccnode, exercise_data, write_to_path):
             zf.close()
 
 
-def write_to_zipfile(filename, content, zf):
+def write_to_zipfile(filename, content, zf, written=None):
     info = zipfile.ZipInfo(filename, date_time=(2013, 3, 14, 1, 59, 26))
     info.comment = "Perseus file generated during export process".encode()
     info.compress_type = zipfile.ZIP_STORED
     info.create_system = 0
     zf.writestr(info, content)
+    if written is not None:
+        written.add(filename)
 
 
-def write_assessment_item(assessment_item, zf):  # noqa C901
+def write_assessment_item(assessment_item, zf, written, image_cache):  # noqa C901
     if assessment_item.type == exercises.MULTIPLE_SELECTION:
         template = 'perseus/multiple_selection.json'
     elif assessment_item.type == exercises.SINGLE_SELECTION or assessment_item.type == 'true_false':
@@ -484,7 +1261,7 @@ def write_assessment_item(assessment_item, zf):  # noqa C901
         raise TypeError("Unrecognized question type on item {}".format(assessment_item.assessment_id))
 
     question = process_formulas(assessment_item.question)
-    question, question_images = process_image_strings(question, zf)
+    question, question_images = process_image_strings(question, zf, written, image_cache)
 
     answer_data = json.loads(assessment_item.answers)
     for answer in answer_data:
@@ -494,14 +1271,14 @@ def write_assessment_item(assessment_item, zf):  # noqa C901
             answer['answer'] = answer['answer'].replace(exercises.CONTENT_STORAGE_PLACEHOLDER, PERSEUS_IMG_DIR)
             answer['answer'] = process_formulas(answer['answer'])
             # In case perseus doesn't support =wxh syntax, use below code
-            answer['answer'], answer_images = process_image_strings(answer['answer'], zf)
+            answer['answer'], answer_images = process_image_strings(answer['answer'], zf, written, image_cache)
             answer.update({'images': answer_images})
 
     answer_data = [a for a in answer_data if a['answer'] or a['answer'] == 0]  # Filter out empty answers, but not 0
     hint_data = json.loads(assessment_item.hints)
     for hint in hint_data:
         hint['hint'] = process_formulas(hint['hint'])
-        hint['hint'], hint_images = process_image_strings(hint['hint'], zf)
+        hint['hint'], hint_images = process_image_strings(hint['hint'], zf, written, image_cache)
         hint.update({'images': hint_images})
 
     answers_sorted = answer_data
@@ -527,7 +1304,7 @@ def write_assessment_item(assessment_item, zf):  # noqa C901
     }
 
     result = render_to_string(template, context).encode('utf-8', "ignore")
-    write_to_zipfile("{0}.json".format(assessment_item.assessment_id), result, zf)
+    write_to_zipfile("{0}.json".format(assessment_item.assessment_id), result, zf, written)
 
 
 def process_formulas(content):
@@ -536,7 +1313,7 @@ def process_formulas(content):
     return content
 
 
-def process_image_strings(content, zf):
+def process_image_strings(content, zf, written, image_cache):
     image_list = []
     content = content.replace(exercises.CONTENT_STORAGE_PLACEHOLDER, PERSEUS_IMG_DIR)
     for match in re.finditer(r'!\[(?:[^\]]*)]\(([^\)]+)\)', content):
@@ -546,9 +1323,9 @@ def process_image_strings(content, zf):
             filename = img_match.group(1).split('/')[-1]
             checksum, ext = os.path.splitext(filename)
             image_name = "images/{}.{}".format(checksum, ext[1:])
-            if image_name not in zf.namelist():
-                with storage.open(ccmodels.generate_object_storage_name(checksum, filename), 'rb') as imgfile:
-                    write_to_zipfile(image_name, imgfile.read(), zf)
+            if image_name not in written:
+                storage_name = ccmodels.generate_object_storage_name(checksum, filename)
+                write_to_zipfile(image_name, image_cache.read(storage_name), zf, written)
 
             # Add resizing data
             if img_match.group(2) and img_match.group(3):
@@ -726,9 +1503,13 @@ def publish_channel(
     force_exercises=False,
     send_email=False,
     progress_tracker=None,
+    bulk=False,
+    incremental=False,
 ):
     """
     :type progress_tracker: contentcuration.utils.celery.ProgressTracker|None
+    :param bulk: Use the set-based bulk publish mode, see `map_content_nodes_bulk`
+    :param incremental: Update the last exported database, see `map_content_nodes_incremental`
     """
     channel = ccmodels.Channel.objects.get(pk=channel_id)
     kolibri_temp_db = None
@@ -736,7 +1517,9 @@ def publish_channel(
     try:
         set_channel_icon_encoding(channel)
         wait_for_async_tasks(channel)
-        kolibri_temp_db = create_content_database(channel, force, user_id, force_exercises, progress_tracker=progress_tracker)
+        kolibri_temp_db = create_content_database(
+            channel, force, user_id, force_exercises, progress_tracker=progress_tracker, bulk=bulk, incremental=incremental
+        )
         increment_channel_version(channel)
         mark_all_nodes_as_published(channel)
         add_tokens_to_channel(channel)
@@ -747,6 +1530,7 @@ def publish_channel(
         channel.main_tree.changed = False
         channel.main_tree.published = True
         channel.main_tree.save()
+        ccmodels.ChannelSummary.refresh([channel.id])
 
         if send_email:
             send_emails(channel, user_id, version_notes=version_notes)
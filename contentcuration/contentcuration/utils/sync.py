@@ -2,16 +2,44 @@ from __future__ import division
 
 import copy
 import logging
+import uuid
 
 from django.db.models import Q
+from django.utils import timezone
 from django_bulk_update.helper import bulk_update
 from le_utils.constants import content_kinds
 from le_utils.constants import format_presets
 
 from contentcuration.models import AssessmentItem
+from contentcuration.models import Channel
+from contentcuration.models import ContentNode
 from contentcuration.models import ContentTag
 from contentcuration.models import File
 
+# Number of imported nodes whose originals are read and diffed together
+SYNC_BATCH_SIZE = 500
+
+node_data_fields = (
+    "title",
+    "description",
+    "license_id",
+    "copyright_holder",
+    "author",
+    "extra_fields",
+)
+
+assessment_item_fields = (
+    "type",
+    "question",
+    "hints",
+    "answers",
+    "order",
+    "raw_data",
+    "source_url",
+    "randomize",
+    "deleted",
+)
+
 
 def sync_channel(
     channel,
@@ -28,24 +56,24 @@ def sync_channel(
         Q(original_node__isnull=False)
         | Q(original_channel_id__isnull=False, original_source_node_id__isnull=False)
     )
-    sync_node_count = nodes_to_sync.count()
+    node_ids = list(nodes_to_sync.values_list("id", flat=True))
+    sync_node_count = len(node_ids)
     if not sync_node_count:
         raise ValueError("Tried to sync a channel that has no imported content")
     if progress_tracker:
         progress_tracker.set_total(sync_node_count)
 
-    for node in nodes_to_sync:
-        node = sync_node(
-            node,
+    for i in range(0, sync_node_count, SYNC_BATCH_SIZE):
+        batch_ids = node_ids[i:i + SYNC_BATCH_SIZE]
+        sync_nodes(
+            list(ContentNode.objects.filter(id__in=batch_ids)),
             sync_attributes=sync_attributes,
             sync_tags=sync_tags,
             sync_files=sync_files,
             sync_assessment_items=sync_assessment_items,
         )
         if progress_tracker:
-            progress_tracker.increment()
-        if node.changed:
-            node.save()
+            progress_tracker.increment(len(batch_ids))
 
 
 def sync_node(
@@ -55,26 +83,121 @@ def sync_node(
     sync_files=False,
     sync_assessment_items=False,
 ):
-    original_node = node.get_original_node()
-    if original_node.node_id != node.node_id:  # Only update if node is not original
-        logging.info(
-            "----- Syncing: {} from {}".format(
-                node.title, original_node.get_channel().name
-            )
-        )
-        if sync_attributes:  # Sync node metadata
-            sync_node_data(node, original_node)
-        if sync_tags:  # Sync node tags
-            sync_node_tags(node, original_node)
-        if sync_files:  # Sync node files
-            sync_node_files(node, original_node)
-        if (
-            sync_assessment_items and node.kind_id == content_kinds.EXERCISE
-        ):  # Sync node exercises
-            sync_node_assessment_items(node, original_node)
+    sync_nodes(
+        [node],
+        sync_attributes=sync_attributes,
+        sync_tags=sync_tags,
+        sync_files=sync_files,
+        sync_assessment_items=sync_assessment_items,
+    )
     return node
 
 
+def sync_nodes(
+    nodes,
+    sync_attributes=False,
+    sync_tags=False,
+    sync_files=False,
+    sync_assessment_items=False,
+):
+    """
+    Syncs a batch of imported nodes from their original nodes, with a fixed number of queries
+    for the whole batch, and saves the nodes that have changed.
+    """
+    original_nodes = get_original_nodes(nodes)
+    # Only update if node is not original
+    pairs = [
+        (node, original_nodes[node.id])
+        for node in nodes
+        if original_nodes[node.id].node_id != node.node_id
+    ]
+    if not pairs:
+        return
+    logging.info("----- Syncing {} nodes".format(len(pairs)))
+
+    update_fields = ["changed", "modified"]
+    if sync_attributes:  # Sync node metadata
+        for node, original in pairs:
+            sync_node_data(node, original)
+        update_fields.extend(node_data_fields)
+    if sync_tags:  # Sync node tags
+        sync_nodes_tags(pairs)
+    if sync_files:  # Sync node files
+        sync_nodes_files(pairs)
+    if sync_assessment_items:  # Sync node exercises
+        sync_nodes_assessment_items(
+            [(node, original) for node, original in pairs if node.kind_id == content_kinds.EXERCISE]
+        )
+        if "extra_fields" not in update_fields:
+            update_fields.append("extra_fields")
+
+    changed_nodes = [node for node, _ in pairs if node.changed]
+    if changed_nodes:
+        now = timezone.now()
+        for node in changed_nodes:
+            node.modified = now
+        bulk_update(changed_nodes, update_fields=update_fields)
+
+
+def get_original_nodes(nodes):
+    """
+    Finds the node each imported node was copied from, like `ContentNode.get_original_node`,
+    but for a whole batch at once.
+
+    :return: A dict mapping the id of each node to its original node, or to itself if not found
+    """
+    original_nodes = {}
+
+    source_nodes = [
+        node for node in nodes
+        if node.original_channel_id and node.original_source_node_id
+    ]
+    tree_ids = dict(
+        Channel.objects.filter(
+            pk__in=set(node.original_channel_id for node in source_nodes)
+        ).values_list("id", "main_tree__tree_id")
+    )
+    source_nodes = [node for node in source_nodes if tree_ids.get(node.original_channel_id)]
+
+    if source_nodes:
+        by_node_id = {}
+        for original in ContentNode.objects.filter(
+            tree_id__in=set(tree_ids.values()),
+            node_id__in=set(node.original_source_node_id for node in source_nodes),
+        ).order_by("tree_id", "lft"):
+            by_node_id.setdefault((original.tree_id, original.node_id), original)
+
+        for node in source_nodes:
+            original = by_node_id.get((tree_ids[node.original_channel_id], node.original_source_node_id))
+            if original is not None:
+                original_nodes[node.id] = original
+
+        # fall back to nodes with the same content in the original channel
+        missing_nodes = [node for node in source_nodes if node.id not in original_nodes]
+        if missing_nodes:
+            by_content_id = {}
+            for original in ContentNode.objects.filter(
+                tree_id__in=set(tree_ids[node.original_channel_id] for node in missing_nodes),
+                content_id__in=set(node.content_id for node in missing_nodes),
+            ).order_by("tree_id", "lft"):
+                by_content_id.setdefault((original.tree_id, original.content_id), original)
+
+            for node in missing_nodes:
+                # the node itself if there's no match, so it won't be synced
+                original_nodes[node.id] = by_content_id.get(
+                    (tree_ids[node.original_channel_id], node.content_id), node
+                )
+
+    remaining_nodes = [node for node in nodes if node.id not in original_nodes]
+    by_id = ContentNode.objects.in_bulk(
+        set(node.original_node_id for node in remaining_nodes if node.original_node_id)
+    )
+    for node in remaining_nodes:
+        original_nodes[node.id] = by_id.get(node.original_node_id, node)
+
+    return original_nodes
+
+
 def sync_node_data(node, original):
     node.title = original.title
     node.description = original.description
@@ -86,59 +209,91 @@ def sync_node_data(node, original):
     node.on_update()
 
 
-def sync_node_tags(node, original):
-    # Remove tags that aren't in original
-    for tag in node.tags.exclude(
-        tag_name__in=original.tags.values_list("tag_name", flat=True)
-    ):
-        node.tags.remove(tag)
-        node.changed = True
-    # Add tags that are in original
-    for tag in original.tags.exclude(
-        tag_name__in=node.tags.values_list("tag_name", flat=True)
-    ):
-        new_tag, _ = ContentTag.objects.get_or_create(
-            tag_name=tag.tag_name, channel_id=None,
+def sync_nodes_tags(pairs):
+    """
+    Sync the tags of each node in ``pairs`` of (node, original) from the tags of its original node.
+    """
+    through_model = ContentNode.tags.through
+    node_tags = {}
+    for through_id, contentnode_id, tag_name in through_model.objects.filter(
+        contentnode_id__in=_pair_ids(pairs)
+    ).values_list("id", "contentnode_id", "contenttag__tag_name"):
+        node_tags.setdefault(contentnode_id, {})[tag_name] = through_id
+
+    through_to_delete = []
+    tags_to_add = []
+    for node, original in pairs:
+        tags = node_tags.get(node.id, {})
+        original_tags = node_tags.get(original.id, {})
+        # Remove tags that aren't in original
+        for tag_name, through_id in tags.items():
+            if tag_name not in original_tags:
+                through_to_delete.append(through_id)
+                node.changed = True
+        # Add tags that are in original
+        for tag_name in original_tags:
+            if tag_name not in tags:
+                tags_to_add.append((node.id, tag_name))
+                node.changed = True
+
+    if through_to_delete:
+        through_model.objects.filter(id__in=through_to_delete).delete()
+
+    if tags_to_add:
+        tag_names = set(tag_name for _, tag_name in tags_to_add)
+        tag_ids = {}
+        for tag_id, tag_name in ContentTag.objects.filter(
+            tag_name__in=tag_names, channel_id=None
+        ).values_list("id", "tag_name"):
+            tag_ids.setdefault(tag_name, tag_id)
+        new_tags = ContentTag.objects.bulk_create(
+            [ContentTag(tag_name=tag_name, channel_id=None) for tag_name in tag_names if tag_name not in tag_ids]
+        )
+        tag_ids.update((tag.tag_name, tag.id) for tag in new_tags)
+        through_model.objects.bulk_create(
+            [through_model(contentnode_id=node_id, contenttag_id=tag_ids[tag_name]) for node_id, tag_name in tags_to_add]
         )
-        node.tags.add(new_tag)
-        node.changed = True
 
 
-def sync_node_files(node, original):
-    """
-    Sync all files in ``node`` from the files in ``original`` node.
-    """
-    node_files = {}
+def _file_key(file):
+    if file.preset_id == format_presets.VIDEO_SUBTITLE:
+        return "{}:{}".format(file.preset_id, file.language_id)
+    return file.preset_id
+
 
-    for file in node.files.all():
-        if file.preset_id == format_presets.VIDEO_SUBTITLE:
-            file_key = "{}:{}".format(file.preset_id, file.language_id)
-        else:
-            file_key = file.preset_id
-        node_files[file_key] = file
+def _pair_ids(pairs):
+    return set(node.id for node, _ in pairs) | set(original.id for _, original in pairs)
 
-    source_files = {}
 
-    for file in original.files.all():
-        if file.preset_id == format_presets.VIDEO_SUBTITLE:
-            file_key = "{}:{}".format(file.preset_id, file.language_id)
-        else:
-            file_key = file.preset_id
-        source_files[file_key] = file
+def _copy_file(file, **kwargs):
+    new_file = copy.copy(file)
+    new_file.id = uuid.uuid4().hex
+    for field, value in kwargs.items():
+        setattr(new_file, field, value)
+    return new_file
+
+
+def sync_nodes_files(pairs):
+    """
+    Sync all files of each node in ``pairs`` of (node, original) from the files of its original node.
+    """
+    node_files = {}
+    for file in File.objects.filter(contentnode_id__in=_pair_ids(pairs)):
+        node_files.setdefault(file.contentnode_id, {})[_file_key(file)] = file
 
     files_to_delete = []
     files_to_create = []
-    # B. Add all files that are in original
-    for file_key, source_file in source_files.items():
-        # 1. Look for old file with matching preset (and language if subs file)
-        node_file = node_files.get(file_key)
-        if not node_file or node_file.checksum != source_file.checksum:
-            if node_file:
-                files_to_delete.append(node_file.id)
-            source_file.id = None
-            source_file.contentnode_id = node.id
-            files_to_create.append(source_file)
-            node.changed = True
+    for node, original in pairs:
+        files = node_files.get(node.id, {})
+        # Add all files that are in original
+        for file_key, source_file in node_files.get(original.id, {}).items():
+            # Look for old file with matching preset (and language if subs file)
+            node_file = files.get(file_key)
+            if not node_file or node_file.checksum != source_file.checksum:
+                if node_file:
+                    files_to_delete.append(node_file.id)
+                files_to_create.append(_copy_file(source_file, contentnode_id=node.id))
+                node.changed = True
 
     if files_to_delete:
         File.objects.filter(id__in=files_to_delete).delete()
@@ -147,72 +302,83 @@ def sync_node_files(node, original):
         File.objects.bulk_create(files_to_create)
 
 
-assessment_item_fields = (
-    "type",
-    "question",
-    "hints",
-    "answers",
-    "order",
-    "raw_data",
-    "source_url",
-    "randomize",
-    "deleted",
-)
-
+def sync_nodes_assessment_items(pairs):  # noqa C901
+    """
+    Sync the assessment items, and their files, of each exercise in ``pairs`` of (node, original)
+    from the assessment items of its original node.
+    """
+    if not pairs:
+        return
 
-def sync_node_assessment_items(node, original):  # noqa C901
     node_assessment_items = {}
+    for ai in AssessmentItem.objects.filter(contentnode_id__in=_pair_ids(pairs)):
+        node_assessment_items.setdefault(ai.contentnode_id, []).append(ai)
 
-    for ai in node.assessment_items.all():
-        node_assessment_items[ai.assessment_id] = ai
+    ai_files = {}
+    for file in File.objects.filter(
+        assessment_item__contentnode_id__in=_pair_ids(pairs)
+    ):
+        ai_files.setdefault(file.assessment_item_id, []).append(file)
 
-    node.extra_fields = original.extra_fields
+    ai_to_create = []
+    ai_to_update = []
+    ai_to_delete = []
     files_to_delete = []
     files_to_create = []
 
-    ai_to_update = []
+    for node, original in pairs:
+        node.extra_fields = original.extra_fields
+        assessment_items = {
+            ai.assessment_id: ai for ai in node_assessment_items.get(node.id, [])
+        }
+
+        for source_ai in node_assessment_items.get(original.id, []):
+            node_ai = assessment_items.pop(source_ai.assessment_id, None)
+            if not node_ai:
+                node_ai = copy.copy(source_ai)
+                node_ai.id = None
+                node_ai.contentnode_id = node.id
+                # files are copied once the new assessment item has an id
+                ai_to_create.append((node_ai, source_ai))
+                node.changed = True
+                continue
 
-    for source_ai in original.assessment_items.all():
-        ai_id = source_ai.assessment_id
-        node_ai = node_assessment_items.get(ai_id)
-        if not node_ai:
-            node_ai = copy.copy(source_ai)
-            node_ai.id = None
-            node_ai.contentnode_id = node.id
-            node_ai.save()
-            node.changed = True
-        else:
             for field in assessment_item_fields:
                 setattr(node_ai, field, getattr(source_ai, field))
             if node_ai.has_changes():
                 ai_to_update.append(node_ai)
-            node_assessment_items.pop(ai_id)
-        node_ai_files = {}
-        if node_ai.id is not None:
-            for file in node_ai.files.all():
-                node_ai_files[file.checksum] = file
-        for file in source_ai.files.all():
-            if file.checksum not in node_ai_files:
-                file.id = None
-                file.assessment_item_id = node_ai.id
-                files_to_create.append(file)
-            else:
-                node_ai_files.pop(file.checksum)
-        files_to_delete.extend([f.id for f in node_ai_files.values()])
-
-    ai_to_delete = [a.id for a in node_assessment_items.values()]
+                node.changed = True
+
+            node_ai_files = {file.checksum: file for file in ai_files.get(node_ai.id, [])}
+            for file in ai_files.get(source_ai.id, []):
+                if file.checksum not in node_ai_files:
+                    files_to_create.append(_copy_file(file, assessment_item_id=node_ai.id))
+                    node.changed = True
+                else:
+                    node_ai_files.pop(file.checksum)
+            if node_ai_files:
+                files_to_delete.extend([f.id for f in node_ai_files.values()])
+                node.changed = True
+
+        if assessment_items:
+            ai_to_delete.extend([a.id for a in assessment_items.values()])
+            node.changed = True
+
     if ai_to_delete:
         AssessmentItem.objects.filter(id__in=ai_to_delete).delete()
-        node.changed = True
 
     if ai_to_update:
         bulk_update(ai_to_update, update_fields=assessment_item_fields)
-        node.changed = True
+
+    if ai_to_create:
+        AssessmentItem.objects.bulk_create([node_ai for node_ai, _ in ai_to_create])
+        for node_ai, source_ai in ai_to_create:
+            files_to_create.extend(
+                _copy_file(file, assessment_item_id=node_ai.id) for file in ai_files.get(source_ai.id, [])
+            )
 
     if files_to_delete:
         File.objects.filter(id__in=files_to_delete).delete()
-        node.changed = True
 
     if files_to_create:
         File.objects.bulk_create(files_to_create)
-        node.changed = True
@@ -1,5 +1,7 @@
 import json
 import logging
+import os
+import uuid
 from builtins import str
 from collections import namedtuple
 from distutils.version import LooseVersion
@@ -7,6 +9,7 @@ from distutils.version import LooseVersion
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import PermissionDenied
 from django.core.exceptions import SuspiciousOperation
+from django.core.files.storage import default_storage
 from django.core.management import call_command
 from django.db import transaction
 from django.http import HttpResponseBadRequest
@@ -34,22 +37,29 @@ from contentcuration.models import AssessmentItem
 from contentcuration.models import Channel
 from contentcuration.models import ContentNode
 from contentcuration.models import ContentTag
+from contentcuration.models import File
+from contentcuration.models import FormatPreset
+from contentcuration.models import generate_object_storage_name
+from contentcuration.models import Language
 from contentcuration.models import License
 from contentcuration.models import SlideshowSlide
 from contentcuration.models import StagedFile
 from contentcuration.serializers import GetTreeDataSerializer
 from contentcuration.tasks import create_async_task
 from contentcuration.utils.files import get_file_diff
+from contentcuration.utils.files import get_thumbnail_encoding
 from contentcuration.utils.garbage_collect import get_deleted_chefs_root
-from contentcuration.utils.nodes import map_files_to_assessment_item
+from contentcuration.utils.nodes import filter_out_nones
 from contentcuration.utils.nodes import map_files_to_node
-from contentcuration.utils.nodes import map_files_to_slideshow_slide_item
 from contentcuration.utils.tracing import trace
 from contentcuration.viewsets.sync.constants import CHANNEL
 from contentcuration.viewsets.sync.utils import add_event_for_user
 from contentcuration.viewsets.sync.utils import generate_update_event
 
 
+# Number of rows to insert at once when adding nodes from ricecooker
+BULK_CREATE_BATCH_SIZE = 500
+
 VersionStatus = namedtuple("VersionStatus", ["version", "status", "message"])
 VERSION_OK = VersionStatus(
     version=rc.VERSION_OK, status=0, message=rc.VERSION_OK_MESSAGE
@@ -232,8 +242,8 @@ def api_commit_channel(request):
                 old_staging.save()
 
         # Send event (new staging tree or new main tree) to all channel editors
-        for editor in obj.editors.all():
-            add_event_for_user(editor.id, event)
+        for editor_id in obj.editors.values_list("id", flat=True):
+            add_event_for_user(editor_id, event)
 
         _, task = create_async_task(
             "get-node-diff",
@@ -266,6 +276,9 @@ def api_add_nodes_to_tree(request):
     whose pk is specified in `root_id`. The list `content_data` conatins json
     dicts obtained from the to_dict serializarion of the ricecooker node class.
 
+    Each of the dicts may also list the dicts of its own children under `children`,
+    so that a whole subtree is created at once.
+
     NOTE: It's important that calls made to this API proceed through the tree
     in a linear fashion, from first to last topic, recursively iterating through
     children. This ensures that MPTT updates take the least amount of time
@@ -363,7 +376,6 @@ def check_user_is_editor(request):
 def get_tree_data(request):
     """
     Get the tree data for the `tree` tree of channel `channel_id`.
-    WARNING: this endpoint timesouts for large channels.
     Returns { success: true, tree:[ nodes in channel_id ] }
     """
     serializer = GetTreeDataSerializer(data=request.data)
@@ -534,153 +546,164 @@ def create_channel(channel_data, user):
 
 @trace
 def convert_data_to_nodes(user, content_data, parent_node):
-    """ Parse dict and create nodes accordingly """
+    """
+    Parse dict and create nodes accordingly
+
+    Each node dict may hold the dicts of its own children under `children`, so that whole
+    subtrees can be added in one request. All the rows are built in memory first, including
+    the mptt fields of the nodes, and then inserted with `bulk_create`.
+    """
     try:
         root_mapping = {}
         parent_node = ContentNode.objects.get(pk=parent_node)
         sort_order = parent_node.children.count() + 1
-        existing_node_ids = ContentNode.objects.filter(
+        existing_node_ids = set(ContentNode.objects.filter(
             parent_id=parent_node.pk
-        ).values_list("node_id", flat=True)
+        ).values_list("node_id", flat=True))
+        builder = NodeTreeBuilder(user, parent_node.get_channel())
+        trees = []
+        for node_data in content_data:
+            # Check if node id is already in the tree to avoid duplicates
+            if node_data["node_id"] not in existing_node_ids:
+                trees.append(builder.build(node_data, parent_node.pk, sort_order))
+                sort_order += 1
+
         with transaction.atomic():
-            for node_data in content_data:
-                # Check if node id is already in the tree to avoid duplicates
-                if node_data["node_id"] not in existing_node_ids:
-                    # Create the node
-                    new_node = create_node(node_data, parent_node, sort_order)
-
-                    # Create files associated with node
-                    map_files_to_node(user, new_node, node_data["files"])
-
-                    # Create questions associated exercise nodes
-                    create_exercises(user, new_node, node_data["questions"])
-                    sort_order += 1
-
-                    # Create Slideshow slides (if slideshow kind)
-                    if node_data["kind"] == "slideshow":
-                        extra_fields_unicode = node_data["extra_fields"]
-
-                        # Extra Fields comes as type<unicode> - convert it to a dict and get slideshow_data
-                        extra_fields_json = extra_fields_unicode.encode(
-                            "ascii", "ignore"
-                        )
-                        extra_fields = json.loads(extra_fields_json)
-
-                        slides = create_slides(
-                            user, new_node, extra_fields.get("slideshow_data")
-                        )
-                        map_files_to_slideshow_slide_item(
-                            user, new_node, slides, node_data["files"]
-                        )
-
-                    # Track mapping between newly created node and node id
-                    root_mapping.update({node_data["node_id"]: new_node.pk})
-            return root_mapping
+            with ContentNode.objects.lock_mptt(parent_node.tree_id):
+                nodes = []
+                for tree in trees:
+                    # Each tree opens up space after the previous one, so refresh the parent
+                    ContentNode.objects._mptt_refresh(parent_node)
+                    nodes.extend(ContentNode.objects.build_tree_nodes(tree, target=parent_node))
+                ContentNode.objects.bulk_create(nodes, batch_size=BULK_CREATE_BATCH_SIZE)
+            if nodes:
+                ContentNode.objects.filter(pk=parent_node.pk).update(changed=True)
+            builder.create_related_objects()
+
+        # Track mapping between newly created node and node id
+        for tree in trees:
+            root_mapping.update({tree["node_id"]: tree["id"]})
+        return root_mapping
 
     except KeyError as e:
         raise ObjectDoesNotExist("Error creating node: {0}".format(e))
 
 
-def create_node(node_data, parent_node, sort_order):  # noqa: C901
-    """ Generate node based on node dict """
-    # Make sure license is valid
-    license = None
-    license_name = node_data["license"]
-    if license_name is not None:
-        try:
-            license = License.objects.get(license_name__iexact=license_name)
-        except ObjectDoesNotExist:
-            raise ObjectDoesNotExist("Invalid license found")
-
-    extra_fields = node_data["extra_fields"] or {}
-    if isinstance(extra_fields, basestring):
-        extra_fields = json.loads(extra_fields)
-
-    # Validate title and license fields
-    is_complete = True
-    title = node_data.get('title', "")
-    license_description = node_data.get('license_description', "")
-    copyright_holder = node_data.get('copyright_holder', "")
-    is_complete &= title != ""
-    if node_data['kind'] != content_kinds.TOPIC:
-        if license.is_custom:
-            is_complete &= license_description != ""
-        if license.copyright_holder_required:
-            is_complete &= copyright_holder != ""
-
-    node = ContentNode.objects.create(
-        title=title,
-        tree_id=parent_node.tree_id,
-        kind_id=node_data["kind"],
-        node_id=node_data["node_id"],
-        content_id=node_data["content_id"],
-        description=node_data["description"],
-        author=node_data["author"],
-        aggregator=node_data.get("aggregator") or "",
-        provider=node_data.get("provider") or "",
-        license=license,
-        license_description=license_description,
-        copyright_holder=copyright_holder,
-        parent=parent_node,
-        extra_fields=extra_fields,
-        sort_order=sort_order,
-        source_id=node_data.get("source_id"),
-        source_domain=node_data.get("source_domain"),
-        language_id=node_data.get("language"),
-        freeze_authoring_data=True,
-        role_visibility=node_data.get('role') or roles.LEARNER,
-        complete=is_complete,
-    )
-    tags = []
-    channel = node.get_channel()
-    if "tags" in node_data:
-        tag_data = node_data["tags"]
-        if tag_data is not None:
-            for tag in tag_data:
-                tags.append(
-                    ContentTag.objects.get_or_create(tag_name=tag, channel=channel)[0]
-                )
-
-    if len(tags) > 0:
-        node.tags = tags
-        node.save()
-
-    return node
+class NodeTreeBuilder(object):
+    """
+    Builds the rows for the nodes sent by ricecooker, along with their tags, files,
+    questions and slides, so they can all be inserted with a handful of queries.
+    Licenses, tags, languages and presets are looked up once per request.
+    """
 
+    def __init__(self, user, channel):
+        self.user = user
+        self.channel = channel
+        self.licenses = {license.license_name.lower(): license for license in License.objects.all()}
+        self.languages = {}
+        self.presets = {}
+        self.existing_paths = set()
+        self.tag_names = {}
+        self.files = []
+        self.assessment_items = []
+        self.slides = []
+
+    def build(self, node_data, parent_id, sort_order):
+        """
+        Returns the data for `node_data` and its children in the nested format of `build_tree_nodes`
+        """
+        node = build_node(node_data, parent_id, sort_order, self.licenses)
+        if node_data.get("tags"):
+            self.tag_names[node["id"]] = set(node_data["tags"])
+        self.build_files(node, node_data["files"])
+        self.build_exercises(node, node_data["questions"])
+        if node_data["kind"] == content_kinds.SLIDESHOW:
+            self.build_slides(node, node["extra_fields"].get("slideshow_data"), node_data["files"])
+
+        children = [
+            self.build(child_data, node["id"], child_sort_order)
+            for child_sort_order, child_data in enumerate(node_data.get("children") or [], start=1)
+        ]
+        if children:
+            node["children"] = children
+        return node
+
+    def get_language(self, language_id):
+        if language_id not in self.languages:
+            self.languages[language_id] = Language.objects.filter(pk=language_id).exists()
+        return self.languages[language_id]
+
+    def get_preset(self, preset_name, filename):
+        ext = os.path.splitext(filename)[1]
+        if (preset_name, ext) not in self.presets:
+            self.presets[(preset_name, ext)] = FormatPreset.get_preset(preset_name) or FormatPreset.guess_format_preset(filename)
+        return self.presets[(preset_name, ext)]
+
+    def check_file_exists(self, checksum, filename):
+        file_path = generate_object_storage_name(checksum, filename)
+        if file_path not in self.existing_paths:
+            if not default_storage.exists(file_path):
+                raise IOError('{} not found'.format(file_path))
+            self.existing_paths.add(file_path)
+        return file_path
+
+    def build_file(self, checksum, ext, filename, file_data, **kwargs):
+        file_obj = File(
+            checksum=checksum,
+            file_format_id=ext,
+            original_filename=file_data.get("original_filename") or "file",
+            source_url=file_data.get("source_url"),
+            file_size=file_data["size"],
+            uploaded_by=self.user,
+            **kwargs
+        )
+        file_obj.file_on_disk.name = self.check_file_exists(checksum, filename)
+        self.files.append(file_obj)
+        return file_obj
+
+    def build_files(self, node, files_data):
+        for file_data in filter_out_nones(files_data):
+            filename = file_data["filename"]
+            checksum, ext = os.path.splitext(filename)
+            ext = ext.lstrip(".")
+            language_id = file_data.get("language")
+            if language_id and not self.get_language(language_id):
+                logging.warning("file_data with language {} does not exist.".format(language_id))
+                return
+            preset = self.get_preset(file_data["preset"], filename)
+            self.build_file(
+                checksum, ext, filename, file_data, contentnode_id=node["id"], preset=preset, language_id=language_id
+            )
 
-def create_exercises(user, node, data):
-    """ Generate exercise from data """
-    with transaction.atomic():
-        order = 0
+            # Handle thumbnail
+            if preset and preset.thumbnail:
+                node["thumbnail_encoding"] = json.dumps({
+                    'base64': get_thumbnail_encoding("{}.{}".format(checksum, ext)),
+                    'points': [],
+                    'zoom': 0
+                })
 
-        for question in data:
+    def build_exercises(self, node, questions_data):
+        for order, question in enumerate(questions_data):
             question_obj = AssessmentItem(
                 type=question.get("type"),
                 question=question.get("question"),
                 hints=question.get("hints"),
                 answers=question.get("answers"),
                 order=order,
-                contentnode=node,
+                contentnode_id=node["id"],
                 assessment_id=question.get("assessment_id"),
                 raw_data=question.get("raw_data"),
                 source_url=question.get("source_url"),
                 randomize=question.get("randomize") or False,
             )
-            order += 1
-            question_obj.save()
-            map_files_to_assessment_item(user, question_obj, question["files"])
-
-
-def create_slides(user, node, slideshow_data):
-    """ Generate SlideshowSlides from data """
-    """ Returns a collection of SlideshowSlide objects """
-
-    slides = []
+            self.assessment_items.append((question_obj, question["files"]))
 
-    with transaction.atomic():
+    def build_slides(self, node, slideshow_data, files_data):
+        slides = []
         for slide in slideshow_data:
-            slide_obj = SlideshowSlide(
-                contentnode=node,
+            slides.append(SlideshowSlide(
+                contentnode_id=node["id"],
                 sort_order=slide.get("sort_order"),
                 metadata={
                     "caption": slide.get("caption"),
@@ -688,8 +711,106 @@ def create_slides(user, node, slideshow_data):
                     "checksum": slide.get("checksum"),
                     "extension": slide.get("extension"),
                 },
-            )
-            slide_obj.save()
-            slides.append(slide_obj)
+            ))
+        self.slides.extend(slides)
+
+        for file_data in files_data:
+            filename = file_data["filename"]
+            checksum, ext = filename.split(".")
+            matching_slide = next((slide for slide in slides if slide.metadata["checksum"] == checksum), None)
+            self.build_file(checksum, ext, filename, file_data, slideshow_slide=matching_slide, preset_id=file_data["preset"])
+
+    def create_tags(self):
+        if not self.tag_names:
+            return
+        all_tag_names = set().union(*self.tag_names.values())
+        tags = {
+            tag.tag_name: tag
+            for tag in ContentTag.objects.filter(channel=self.channel, tag_name__in=all_tag_names)
+        }
+        new_tags = [ContentTag(tag_name=tag_name, channel=self.channel) for tag_name in all_tag_names if tag_name not in tags]
+        ContentTag.objects.bulk_create(new_tags, batch_size=BULK_CREATE_BATCH_SIZE)
+        tags.update({tag.tag_name: tag for tag in new_tags})
+
+        ContentNode.tags.through.objects.bulk_create([
+            ContentNode.tags.through(contentnode_id=node_id, contenttag_id=tags[tag_name].id)
+            for node_id, tag_names in self.tag_names.items()
+            for tag_name in tag_names
+        ], batch_size=BULK_CREATE_BATCH_SIZE)
+
+    def create_related_objects(self):
+        """
+        Inserts the tags, questions, slides and files of the nodes, which must have been created already
+        """
+        self.create_tags()
+
+        AssessmentItem.objects.bulk_create(
+            [question_obj for question_obj, _ in self.assessment_items], batch_size=BULK_CREATE_BATCH_SIZE
+        )
+        for question_obj, files_data in self.assessment_items:
+            for file_data in filter_out_nones(files_data):
+                filename = file_data["filename"]
+                checksum, ext = filename.split(".")
+                # assessment_item-files always have a preset
+                self.build_file(checksum, ext, filename, file_data, assessment_item=question_obj, preset_id=file_data["preset"])
+
+        SlideshowSlide.objects.bulk_create(self.slides, batch_size=BULK_CREATE_BATCH_SIZE)
+        # Now that the questions and slides have their ids, make sure the files pick them up
+        for file_obj in self.files:
+            if file_obj.assessment_item is not None:
+                file_obj.assessment_item_id = file_obj.assessment_item.id
+            if file_obj.slideshow_slide is not None:
+                file_obj.slideshow_slide_id = file_obj.slideshow_slide.id
+        File.objects.bulk_create(self.files, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def build_node(node_data, parent_id, sort_order, licenses):  # noqa: C901
+    """ Generate node data based on node dict """
+    # Make sure license is valid
+    license = None
+    license_name = node_data["license"]
+    if license_name is not None:
+        license = licenses.get(license_name.lower())
+        if license is None:
+            raise ObjectDoesNotExist("Invalid license found")
+
+    extra_fields = node_data["extra_fields"] or {}
+    if isinstance(extra_fields, basestring):
+        extra_fields = json.loads(extra_fields)
+
+    # Validate title and license fields
+    is_complete = True
+    title = node_data.get('title', "")
+    license_description = node_data.get('license_description', "")
+    copyright_holder = node_data.get('copyright_holder', "")
+    is_complete &= title != ""
+    if node_data['kind'] != content_kinds.TOPIC:
+        if license.is_custom:
+            is_complete &= license_description != ""
+        if license.copyright_holder_required:
+            is_complete &= copyright_holder != ""
 
-    return slides
+    return {
+        "id": uuid.uuid4().hex,
+        "title": title,
+        "kind_id": node_data["kind"],
+        "node_id": node_data["node_id"],
+        "content_id": node_data["content_id"],
+        "description": node_data["description"],
+        "author": node_data["author"],
+        "aggregator": node_data.get("aggregator") or "",
+        "provider": node_data.get("provider") or "",
+        "license": license,
+        "license_description": license_description,
+        "copyright_holder": copyright_holder,
+        "parent_id": parent_id,
+        "extra_fields": extra_fields,
+        "sort_order": sort_order,
+        "source_id": node_data.get("source_id"),
+        "source_domain": node_data.get("source_domain"),
+        "language_id": node_data.get("language"),
+        "freeze_authoring_data": True,
+        "role_visibility": node_data.get('role') or roles.LEARNER,
+        "complete": is_complete,
+        "changed": True,
+    }
@@ -1,14 +1,9 @@
-import json
-from datetime import datetime
-
-from django.conf import settings
-from django.core.cache import cache
-from django.db.models import Max
-from django.db.models import Q
 from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseNotFound
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import TokenAuthentication
@@ -21,9 +16,11 @@ from rest_framework.response import Response
 
 from contentcuration.models import Channel
 from contentcuration.models import ContentNode
+from contentcuration.models import ContentNodeDetails
 from contentcuration.models import Task
-from contentcuration.tasks import create_async_task
+from contentcuration.tasks import get_or_create_async_task
 from contentcuration.tasks import getnodedetails_task
+from contentcuration.utils.node_details import refresh_node_details
 from contentcuration.utils.nodes import get_diff
 
 
@@ -38,8 +35,7 @@ def get_channel_details(request, channel_id):
     channel = get_object_or_404(Channel.filter_view_queryset(Channel.objects.all(), request.user), id=channel_id)
     if not channel.main_tree:
         raise Http404
-    data = get_node_details_cached(channel.main_tree, channel_id=channel_id)
-    return HttpResponse(json.dumps(data))
+    return node_details_response(request, channel.main_tree, channel_id=channel_id)
 
 
 @api_view(["GET"])
@@ -49,40 +45,34 @@ def get_node_details(request, node_id):
     channel = node.get_channel()
     if channel and not channel.public:
         return HttpResponseNotFound("No topic found for {}".format(node_id))
-    data = get_node_details_cached(node)
-    return HttpResponse(json.dumps(data))
+    return node_details_response(request, node)
 
 
 def get_node_details_cached(node, channel_id=None):
-    cached_data = cache.get("details_{}".format(node.node_id))
-    if cached_data:
-        descendants = (
-            node.get_descendants()
-            .prefetch_related("children", "files", "tags")
-            .select_related("license", "language")
-        )
-        channel = node.get_channel()
-
-        # If channel is a sushi chef channel, use date created for faster query
-        # Otherwise, find the last time anything was updated in the channel
-        last_update = (
-            channel.main_tree.created
-            if channel and channel.ricecooker_version
-            else descendants.filter(changed=True)
-            .aggregate(latest_update=Max("modified"))
-            .get("latest_update")
-        )
-
-        if last_update:
-            last_cache_update = datetime.strptime(
-                json.loads(cached_data)["last_update"], settings.DATE_TIME_FORMAT
-            )
-            if last_update.replace(tzinfo=None) > last_cache_update:
-                # update the stats async, then return the cached value
-                getnodedetails_task.apply_async((node.pk,))
-        return json.loads(cached_data)
-
-    return node.get_details(channel_id=channel_id)
+    """
+    :return: A tuple of the details of the node as a JSON string, and their etag
+    """
+    details = ContentNodeDetails.objects.filter(contentnode_id=node.pk, data__isnull=False).values_list(
+        "data", "etag", "stale"
+    ).first()
+    if details is None:
+        return refresh_node_details(node, channel_id=channel_id)
+
+    data, etag, stale = details
+    if stale:
+        # update the details async, then return the stored ones
+        getnodedetails_task.apply_async((node.pk,))
+    return data, etag
+
+
+def node_details_response(request, node, channel_id=None):
+    data, etag = get_node_details_cached(node, channel_id=channel_id)
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(data, content_type="application/json")
+    response["ETag"] = etag
+    return response
 
 
 @api_view(["GET"])
@@ -101,13 +91,7 @@ def get_node_diff(request, updated_id, original_id):
             return Response(data)
 
         # See if there's already a staging task in progress
-        is_generating = Task.objects.filter(
-            task_type="get-node-diff",
-            metadata__args__updated_id=updated_id,
-            metadata__args__original_id=original_id,
-        ).exclude(Q(status='FAILURE') | Q(status='SUCCESS')).exists()
-
-        if is_generating:
+        if Task.get_active("get-node-diff", {"updated_id": updated_id, "original_id": original_id}):
             return Response('Diff is being generated', status=status.HTTP_302_FOUND)
     except ContentNode.DoesNotExist:
         pass
@@ -128,13 +112,6 @@ def generate_node_diff(request, updated_id, original_id):
     except ContentNode.DoesNotExist:
         return Response('Diff is not available', status=status.HTTP_403_FORBIDDEN)
 
-    # See if there's already a staging task in progress
-    is_generating = Task.objects.filter(
-        task_type="get-node-diff",
-        metadata__args__updated_id=updated_id,
-        metadata__args__original_id=original_id,
-    ).exclude(Q(status='FAILURE') | Q(status='SUCCESS')).exists()
-
-    if not is_generating:
-        create_async_task("get-node-diff", request.user, updated_id=updated_id, original_id=original_id)
+    # Only start generating the diff if there isn't already a task in progress
+    get_or_create_async_task("get-node-diff", request.user, updated_id=updated_id, original_id=original_id)
     return Response('Diff is being generated')
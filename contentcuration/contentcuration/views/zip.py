@@ -3,18 +3,22 @@ import logging
 import mimetypes
 import os
 import re
+import struct
 import time
 import zipfile
+import zlib
+from collections import namedtuple
 from xml.etree.ElementTree import SubElement
 
 import html5lib
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.http import HttpResponse
 from django.http import HttpResponseNotFound
 from django.http import HttpResponseServerError
-from django.http.response import FileResponse
 from django.http.response import HttpResponseNotModified
+from django.http.response import StreamingHttpResponse
 from django.utils.http import http_date
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.generic.base import View
@@ -36,6 +40,164 @@ VALID_STORAGE_FILENAME = re.compile("[0-9a-f]{32}(-data)?\\.[0-9a-z]+")
 # set of file extensions that should be considered zip files and allow access to internal files
 POSSIBLE_ZIPPED_FILE_EXTENSIONS = set([".perseus", ".zip", ".epub", ".epub3"])
 
+# size of the chunks read from storage when streaming a file out of a zip
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# single byte range requests, e.g. `bytes=0-499`, `bytes=500-` or `bytes=-500`
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# how long, in seconds, a zip's index is kept in the cache after it's read
+ZIP_INDEX_CACHE_TIMEOUT = 60 * 60 * 24
+
+# the parts of a zip's central directory entry needed to read a file straight out of the zip
+ZipMember = namedtuple(
+    "ZipMember", ["header_offset", "compress_type", "compress_size", "file_size", "date_time", "flag_bits"]
+)
+
+
+class ZipMemberError(zipfile.BadZipfile):
+    pass
+
+
+def get_zip_index(zipped_filename, zipped_path, storage):
+    """
+    Returns a dict of the files within a zip, mapping their names to a ZipMember. As zip files are
+    named by their checksum, their index never changes, so it's cached once read, saving re-reading
+    the central directory for every file requested from the zip. The cache entry expires after
+    ZIP_INDEX_CACHE_TIMEOUT, so indexes of zips that are no longer viewed don't fill the cache.
+
+    :return: The index, or None if the zip does not exist in storage
+    :rtype: dict|None
+    """
+    cache_key = "zip_index_{}".format(zipped_filename)
+    index = cache.get(cache_key)
+    if index is not None:
+        return index
+
+    if not storage.exists(zipped_path):
+        return None
+
+    with storage.open(zipped_path) as zf_obj:
+        try:
+            with zipfile.ZipFile(zf_obj) as zf:
+                index = {
+                    info.filename: ZipMember(
+                        info.header_offset,
+                        info.compress_type,
+                        info.compress_size,
+                        info.file_size,
+                        info.date_time,
+                        info.flag_bits,
+                    )
+                    for info in zf.infolist()
+                }
+        except zipfile.BadZipfile:
+            just_downloaded = getattr(zf_obj, 'just_downloaded', "Unknown (Most likely local file)")
+            client.captureMessage("Unable to open zip file. File info: name={}, size={}, mode={}, just_downloaded={}".format(
+                zf_obj.name, zf_obj.size, zf_obj.mode, just_downloaded))
+            raise
+
+    cache.set(cache_key, index, ZIP_INDEX_CACHE_TIMEOUT)
+    return index
+
+
+def get_member_data_offset(zf_obj, member):
+    """
+    Reads the local header of a file within the zip, to find where its data starts
+    """
+    zf_obj.seek(member.header_offset)
+    header = zf_obj.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise ZipMemberError("Truncated file header")
+    header = struct.unpack(zipfile.structFileHeader, header)
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise ZipMemberError("Bad magic number for file header")
+    return (
+        member.header_offset
+        + zipfile.sizeFileHeader
+        + header[zipfile._FH_FILENAME_LENGTH]
+        + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+    )
+
+
+def iter_member(zf_obj, member, start=0, length=None):
+    """
+    Returns a generator of the content of a file within the zip, reading it from storage in chunks.
+    Only stored files can start part way through, as compressed files must be inflated from their
+    beginning. The file's header is checked straight away, so a broken zip raises before streaming.
+    """
+    try:
+        offset = get_member_data_offset(zf_obj, member)
+    except Exception:
+        zf_obj.close()
+        raise
+    return _iter_member_data(zf_obj, member, offset, start, length)
+
+
+def _iter_member_data(zf_obj, member, offset, start, length):
+    try:
+        if member.compress_type == zipfile.ZIP_STORED:
+            zf_obj.seek(offset + start)
+            remaining = member.file_size - start if length is None else length
+            while remaining > 0:
+                chunk = zf_obj.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ZipMemberError("Truncated file data")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            zf_obj.seek(offset)
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            remaining = member.compress_size
+            while remaining > 0:
+                chunk = zf_obj.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ZipMemberError("Truncated file data")
+                remaining -= len(chunk)
+                yield decompressor.decompress(chunk)
+            yield decompressor.flush()
+    finally:
+        zf_obj.close()
+
+
+def read_member(zf_obj, member, filename):
+    if not is_streamable(member):
+        # encrypted files and compression methods other than deflate are left to `zipfile`
+        try:
+            with zipfile.ZipFile(zf_obj) as zf:
+                return zf.read(filename)
+        finally:
+            zf_obj.close()
+    return b"".join(iter_member(zf_obj, member))
+
+
+def is_streamable(member):
+    return not member.flag_bits & 0x1 and member.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Parses a single byte range request against a file of `file_size` bytes
+
+    :return: A tuple of (start, length), None if the header should be ignored, or False if the
+             range can't be satisfied
+    """
+    match = RANGE_HEADER.match(range_header.strip())
+    if not match or not any(match.groups()):
+        # multiple or malformed ranges, so just send the whole file
+        return None
+    start, end = match.groups()
+    if not start:
+        # a suffix range for the last `end` bytes of the file
+        start = max(file_size - int(end), 0)
+        end = file_size - 1
+    else:
+        start = int(start)
+        end = min(int(end), file_size - 1) if end else file_size - 1
+    if start >= file_size or end < start:
+        return False
+    return start, end - start + 1
+
 
 def _add_access_control_headers(request, response):
     response["Access-Control-Allow-Origin"] = "*"
@@ -100,6 +262,12 @@ def parse_html(content):
 # DISK PATHS
 
 
+def zip_error_response():
+    return HttpResponseServerError(
+        "Attempt to open zip file failed. Please try again, and if you continue to receive this message, please check that the zip file is valid."
+    )
+
+
 class ZipContentView(View):
 
     @xframe_options_exempt
@@ -111,8 +279,31 @@ class ZipContentView(View):
         _add_access_control_headers(request, response)
         return response
 
+    def stored_file_response(self, request, zf_obj, member, content_type):
+        """
+        Streams a file stored uncompressed in the zip straight from its offset in the zip, so
+        byte ranges can be served, which media players within HTML5 apps need to seek
+        """
+        byte_range = parse_range_header(request.META.get("HTTP_RANGE", ""), member.file_size)
+        if byte_range is False:
+            zf_obj.close()
+            response = HttpResponse(status=416, content_type=content_type)
+            response["Content-Range"] = "bytes */{}".format(member.file_size)
+        elif byte_range:
+            start, length = byte_range
+            response = StreamingHttpResponse(
+                iter_member(zf_obj, member, start=start, length=length), status=206, content_type=content_type
+            )
+            response["Content-Range"] = "bytes {}-{}/{}".format(start, start + length - 1, member.file_size)
+            response["Content-Length"] = length
+        else:
+            response = StreamingHttpResponse(iter_member(zf_obj, member), content_type=content_type)
+            response["Content-Length"] = member.file_size
+        response["Accept-Ranges"] = "bytes"
+        return response
+
     @xframe_options_exempt  # noqa
-    def get(self, request, zipped_filename, embedded_filepath):
+    def get(self, request, zipped_filename, embedded_filepath):  # noqa: C901
         """
         Handles GET requests and serves a static file from within the zip file.
         """
@@ -125,74 +316,66 @@ class ZipContentView(View):
         filename, ext = os.path.splitext(zipped_filename)
         zipped_path = generate_object_storage_name(filename, zipped_filename)
 
-        # file size
-        file_size = 0
+        try:
+            index = get_zip_index(zipped_filename, zipped_path, storage)
+        except zipfile.BadZipfile:
+            return zip_error_response()
 
         # if the zipfile does not exist on disk, return a 404
-        if not storage.exists(zipped_path):
+        if index is None:
             return HttpResponseNotFound('"%(filename)s" does not exist in storage' % {'filename': zipped_path})
 
         # if client has a cached version, use that (we can safely assume nothing has changed, due to MD5)
         if request.META.get('HTTP_IF_MODIFIED_SINCE'):
             return HttpResponseNotModified()
 
+        # if no path, or a directory, is being referenced, look for an index.html file
+        if not embedded_filepath or embedded_filepath.endswith("/"):
+            embedded_filepath += "index.html"
+
+        # get the details about the embedded file, and ensure it exists
+        member = index.get(embedded_filepath)
+        if member is None:
+            return HttpResponseNotFound('"{}" does not exist inside "{}"'.format(embedded_filepath, zipped_filename))
+
+        # try to guess the MIME type of the embedded file being referenced
+        content_type = mimetypes.guess_type(embedded_filepath)[0] or 'application/octet-stream'
+
         zf_obj = storage.open(zipped_path)
 
         try:
-            with zipfile.ZipFile(zf_obj) as zf:
-                # if no path, or a directory, is being referenced, look for an index.html file
-                if not embedded_filepath or embedded_filepath.endswith("/"):
-                    embedded_filepath += "index.html"
-
-                # get the details about the embedded file, and ensure it exists
-                try:
-                    info = zf.getinfo(embedded_filepath)
-                except KeyError:
-                    return HttpResponseNotFound('"{}" does not exist inside "{}"'.format(embedded_filepath, zipped_filename))
-
-                # try to guess the MIME type of the embedded file being referenced
-                content_type = mimetypes.guess_type(embedded_filepath)[0] or 'application/octet-stream'
-
-                if embedded_filepath.endswith(".html") and request.GET.get("screenshot"):
-                    content_type = 'text/html'
-
-                    content = zf.open(info).read()
-
-                    response = HttpResponse(parse_html(content), content_type=content_type)
-                    file_size = info.file_size
-                elif not os.path.splitext(embedded_filepath)[1] == '.json':
-                    # generate a streaming response object, pulling data from within the zip  file
-                    response = FileResponse(zf.open(info), content_type=content_type)
-                    file_size = info.file_size
-                else:
-                    # load the stream from json file into memory, replace the path_place_holder.
-                    content = zf.open(info).read()
-                    str_to_be_replaced = ('$' + exercises.IMG_PLACEHOLDER).encode()
-                    zipcontent = ('/' + request.resolver_match.url_name + "/" + zipped_filename).encode()
-                    content_with_path = content.replace(str_to_be_replaced, zipcontent)
-                    response = HttpResponse(content_with_path, content_type=content_type)
-                    file_size = len(content_with_path)
+            if embedded_filepath.endswith(".html") and request.GET.get("screenshot"):
+                content_type = 'text/html'
+                content = read_member(zf_obj, member, embedded_filepath)
+                response = HttpResponse(parse_html(content), content_type=content_type)
+            elif embedded_filepath.endswith(".json"):
+                # load the stream from json file into memory, replace the path_place_holder.
+                content = read_member(zf_obj, member, embedded_filepath)
+                str_to_be_replaced = ('$' + exercises.IMG_PLACEHOLDER).encode()
+                zipcontent = ('/' + request.resolver_match.url_name + "/" + zipped_filename).encode()
+                content_with_path = content.replace(str_to_be_replaced, zipcontent)
+                response = HttpResponse(content_with_path, content_type=content_type)
+            elif not is_streamable(member):
+                response = HttpResponse(read_member(zf_obj, member, embedded_filepath), content_type=content_type)
+            elif member.compress_type == zipfile.ZIP_STORED:
+                response = self.stored_file_response(request, zf_obj, member, content_type)
+            else:
+                # generate a streaming response object, inflating the data from within the zip file
+                response = StreamingHttpResponse(iter_member(zf_obj, member), content_type=content_type)
+                response["Content-Length"] = member.file_size
         except zipfile.BadZipfile:
-            just_downloaded = getattr(zf_obj, 'just_downloaded', "Unknown (Most likely local file)")
-            client.captureMessage("Unable to open zip file. File info: name={}, size={}, mode={}, just_downloaded={}".format(
-                zf_obj.name, zf_obj.size, zf_obj.mode, just_downloaded))
-            return HttpResponseServerError(
-                "Attempt to open zip file failed. Please try again, and if you continue to receive this message, please check that the zip file is valid."
-            )
+            return zip_error_response()
 
         # set the last-modified header to the date marked on the embedded file
-        if info.date_time:
-            response["Last-Modified"] = http_date(time.mktime(datetime.datetime(*info.date_time).timetuple()))
+        if member.date_time:
+            response["Last-Modified"] = http_date(time.mktime(datetime.datetime(*member.date_time).timetuple()))
 
         # cache these resources forever; this is safe due to the MD5-naming used on content files
         response["Expires"] = "Sun, 17-Jan-2038 19:14:07 GMT"
 
-        # set the content-length header to the size of the embedded file
-        if file_size:
-            response["Content-Length"] = file_size
-
-        # ensure the browser knows not to try byte-range requests, as we don't support them here
-        response["Accept-Ranges"] = "none"
+        # ensure the browser knows not to try byte-range requests, unless they're supported for this file
+        if not response.has_header("Accept-Ranges"):
+            response["Accept-Ranges"] = "none"
 
         _add_access_control_headers(request, response)
 
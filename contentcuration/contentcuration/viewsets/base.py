@@ -1,6 +1,7 @@
 import traceback
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.models import Q
 from django.http import Http404
 from django_bulk_update.helper import bulk_update
@@ -424,6 +425,9 @@ class ReadOnlyValuesViewset(SimpleReprMixin, ReadOnlyModelViewSet):
     # the value for the target_key. This callable can also pop unwanted values from the obj
     # to remove unneeded keys from the object as a side effect.
     field_map = {}
+    # An optional keyset pagination class, used instead of pagination_class when the
+    # request passes its cursor query param, see ValuesViewsetCursorPagination
+    cursor_pagination_class = None
 
     def __init__(self, *args, **kwargs):
         viewset = super(ReadOnlyValuesViewset, self).__init__(*args, **kwargs)
@@ -434,6 +438,21 @@ class ReadOnlyValuesViewset(SimpleReprMixin, ReadOnlyModelViewSet):
             raise TypeError("field_map must be defined as a dict")
         self._field_map = self.field_map.copy()
 
+    def use_cursor_pagination(self):
+        return (
+            self.cursor_pagination_class is not None
+            and self.cursor_pagination_class.cursor_query_param in self.request.query_params
+        )
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.use_cursor_pagination():
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = super(ReadOnlyValuesViewset, self).paginator
+        return self._paginator
+
     @classmethod
     def id_attr(cls):
         if cls.serializer_class is not None and hasattr(
@@ -614,14 +633,17 @@ class CreateModelMixin(object):
 
         for change in changes:
             try:
-                serializer = self.get_serializer(data=self._map_create_change(change))
-                if serializer.is_valid():
-                    self.perform_create(serializer)
-                    if serializer.changes:
-                        changes_to_return.extend(serializer.changes)
-                else:
-                    change.update({"errors": serializer.errors})
-                    errors.append(change)
+                # Use a savepoint, so that a database error in one change
+                # only rolls back that change
+                with transaction.atomic():
+                    serializer = self.get_serializer(data=self._map_create_change(change))
+                    if serializer.is_valid():
+                        self.perform_create(serializer)
+                        if serializer.changes:
+                            changes_to_return.extend(serializer.changes)
+                    else:
+                        change.update({"errors": serializer.errors})
+                        errors.append(change)
             except Exception as e:
                 log_sync_exception(e)
                 change["errors"] = [str(e)]
@@ -659,9 +681,12 @@ class DestroyModelMixin(object):
         queryset = self.get_edit_queryset().order_by()
         for change in changes:
             try:
-                instance = queryset.get(**dict(self.values_from_key(change["key"])))
+                # Use a savepoint, so that a database error in one change
+                # only rolls back that change
+                with transaction.atomic():
+                    instance = queryset.get(**dict(self.values_from_key(change["key"])))
 
-                self.perform_destroy(instance)
+                    self.perform_destroy(instance)
             except ObjectDoesNotExist:
                 # If the object already doesn't exist, as far as the user is concerned
                 # job done!
@@ -689,17 +714,20 @@ class UpdateModelMixin(object):
         queryset = self.get_edit_queryset().order_by()
         for change in changes:
             try:
-                instance = queryset.get(**dict(self.values_from_key(change["key"])))
-                serializer = self.get_serializer(
-                    instance, data=self._map_update_change(change), partial=True
-                )
-                if serializer.is_valid():
-                    self.perform_update(serializer)
-                    if serializer.changes:
-                        changes_to_return.extend(serializer.changes)
-                else:
-                    change.update({"errors": serializer.errors})
-                    errors.append(change)
+                # Use a savepoint, so that a database error in one change
+                # only rolls back that change
+                with transaction.atomic():
+                    instance = queryset.get(**dict(self.values_from_key(change["key"])))
+                    serializer = self.get_serializer(
+                        instance, data=self._map_update_change(change), partial=True
+                    )
+                    if serializer.is_valid():
+                        self.perform_update(serializer)
+                        if serializer.changes:
+                            changes_to_return.extend(serializer.changes)
+                    else:
+                        change.update({"errors": serializer.errors})
+                        errors.append(change)
             except ObjectDoesNotExist:
                 # Should we also check object permissions here and return a different
                 # error if the user can view the object but not edit it?
@@ -784,7 +812,7 @@ class BulkUpdateMixin(UpdateModelMixin):
                 ]
         else:
             valid_data = []
-            for error, datum in zip(serializer.errors, data):
+            for error, datum, change in zip(serializer.errors, data, changes):
                 if error:
                     # If the user does not have permission to write to this object
                     # it will throw a uniqueness validation error when trying to
@@ -798,8 +826,9 @@ class BulkUpdateMixin(UpdateModelMixin):
                         )
                     ):
                         error = ValidationError("Not found").detail
-                    datum.update({"errors": error})
-                    errors.append(datum)
+                    # report the error against the change, so it can be matched by its revision
+                    change.update({"errors": error})
+                    errors.append(change)
                 else:
                     valid_data.append(datum)
             if valid_data:
@@ -823,7 +852,8 @@ class BulkDeleteMixin(DestroyModelMixin):
         errors = []
         changes_to_return = []
         try:
-            queryset.delete()
+            with transaction.atomic():
+                queryset.delete()
         except Exception:
             errors = [
                 {
@@ -5,14 +5,15 @@ from operator import or_
 from django.conf import settings
 from django.db import IntegrityError
 from django.db.models import Exists
+from django.db.models import F
 from django.db.models import OuterRef
 from django.db.models import Q
 from django.db.models import Subquery
+from django.db.models.functions import Coalesce
 from django.http import Http404
 from django.utils.decorators import method_decorator
 from django.utils.translation import get_language
 from django.views.decorators.cache import cache_page
-from django_cte import With
 from django_filters.rest_framework import BooleanFilter
 from django_filters.rest_framework import CharFilter
 from le_utils.constants import content_kinds
@@ -32,12 +33,13 @@ from rest_framework.serializers import IntegerField
 from contentcuration.decorators import cache_no_user_data
 from contentcuration.models import Channel
 from contentcuration.models import ContentNode
-from contentcuration.models import File
 from contentcuration.models import generate_storage_url
 from contentcuration.models import SecretToken
 from contentcuration.models import User
 from contentcuration.tasks import create_async_task
+from contentcuration.tasks import queue_channel_summaries_refresh
 from contentcuration.utils.pagination import CachedListPagination
+from contentcuration.utils.pagination import ValuesViewsetCursorPagination
 from contentcuration.utils.pagination import ValuesViewsetPageNumberPagination
 from contentcuration.viewsets.base import BulkListSerializer
 from contentcuration.viewsets.base import BulkModelSerializer
@@ -48,7 +50,6 @@ from contentcuration.viewsets.common import ChangeEventMixin
 from contentcuration.viewsets.common import ContentDefaultsSerializer
 from contentcuration.viewsets.common import JSONFieldDictSerializer
 from contentcuration.viewsets.common import SQCount
-from contentcuration.viewsets.common import SQSum
 from contentcuration.viewsets.common import UUIDInFilter
 from contentcuration.viewsets.sync.constants import CHANNEL
 from contentcuration.viewsets.sync.utils import generate_update_event
@@ -66,6 +67,12 @@ class CatalogListPagination(CachedListPagination):
     max_page_size = 1000
 
 
+class CatalogListCursorPagination(ValuesViewsetCursorPagination):
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = "name"
+
+
 primary_token_subquery = Subquery(
     SecretToken.objects.filter(channels=OuterRef("id"), is_primary=True)
     .values("token")
@@ -407,26 +414,13 @@ class ChannelViewSet(ChangeEventMixin, ValuesViewset):
 
     def annotate_queryset(self, queryset):
         queryset = queryset.annotate(primary_token=primary_token_subquery)
-        channel_main_tree_nodes = ContentNode.objects.filter(
-            tree_id=OuterRef("main_tree__tree_id")
-        )
-        # Add the last modified node modified value as the channel last modified
-        queryset = queryset.annotate(
-            modified=Subquery(
-                channel_main_tree_nodes.values("modified").order_by("-modified")[:1]
-            )
-        )
-        # Add the unique count of distinct non-topic node content_ids
-        non_topic_content_ids = (
-            channel_main_tree_nodes.exclude(kind_id=content_kinds.TOPIC)
-            .values_list("content_id", flat=True)
-            .order_by()
-        )
-
-        queryset = queryset.annotate(
-            count=SQCount(non_topic_content_ids, field="content_id"),
+        # The last modified value and the count of distinct non-topic content_ids of each
+        # channel's main tree come from its summary, which is refreshed async if the tree has changed
+        queue_channel_summaries_refresh(queryset)
+        return queryset.annotate(
+            modified=F("summary__modified"),
+            count=Coalesce(F("summary__resource_count"), 0),
         )
-        return queryset
 
     def update_from_changes(self, changes):
         """
@@ -535,6 +529,7 @@ class CatalogViewSet(ReadOnlyValuesViewset):
     queryset = Channel.objects.all()
     serializer_class = ChannelSerializer
     pagination_class = CatalogListPagination
+    cursor_pagination_class = CatalogListCursorPagination
     filterset_class = BaseChannelFilter
 
     permission_classes = [AllowAny]
@@ -560,27 +555,13 @@ class CatalogViewSet(ReadOnlyValuesViewset):
 
     def annotate_queryset(self, queryset):
         queryset = queryset.annotate(primary_token=primary_token_subquery)
-        channel_main_tree_nodes = ContentNode.objects.filter(
-            tree_id=OuterRef("main_tree__tree_id")
-        )
-        # Add the last modified node modified value as the channel last modified
-        queryset = queryset.annotate(
-            modified=Subquery(
-                channel_main_tree_nodes.values("modified").order_by("-modified")[:1]
-            )
-        )
-        # Add the unique count of distinct non-topic node content_ids
-        non_topic_content_ids = (
-            channel_main_tree_nodes.exclude(kind_id=content_kinds.TOPIC)
-            .order_by("content_id")
-            .distinct("content_id")
-            .values_list("content_id", flat=True)
-        )
-
-        queryset = queryset.annotate(
-            count=SQCount(non_topic_content_ids, field="content_id"),
+        # The last modified value and the count of distinct non-topic content_ids of each
+        # channel's main tree come from its summary, which is refreshed async if the tree has changed
+        queue_channel_summaries_refresh(queryset)
+        return queryset.annotate(
+            modified=F("summary__modified"),
+            count=Coalesce(F("summary__resource_count"), 0),
         )
-        return queryset
 
 
 class AdminChannelFilter(BaseChannelFilter):
@@ -652,19 +633,14 @@ class AdminChannelViewSet(ChannelViewSet):
     )
 
     def get_queryset(self):
-        channel_main_tree_nodes = ContentNode.objects.filter(
-            tree_id=OuterRef("main_tree__tree_id")
-        )
         queryset = Channel.objects.all().annotate(
-            modified=Subquery(
-                channel_main_tree_nodes.values("modified").order_by("-modified")[:1]
-            ),
+            modified=F("summary__modified"),
             primary_token=primary_token_subquery,
         )
         return queryset
 
     def annotate_queryset(self, queryset):
-        page_tree_ids = list(queryset.values_list("main_tree__tree_id", flat=True))
+        queue_channel_summaries_refresh(queryset)
 
         editors_query = (
             User.objects.filter(editable_channels__id=OuterRef("id"))
@@ -677,25 +653,10 @@ class AdminChannelViewSet(ChannelViewSet):
             .distinct()
         )
 
-        nodes = With(
-            ContentNode.objects.values("id", "tree_id")
-            .filter(tree_id__in=page_tree_ids)
-            .order_by(),
-            name="nodes",
-        )
-
-        file_query = (
-            nodes.join(File, contentnode_id=nodes.col.id)
-            .with_cte(nodes)
-            .filter(contentnode__tree_id=OuterRef("main_tree__tree_id"))
-            .values("checksum", "file_size")
-            .distinct()
-        )
-
         queryset = queryset.annotate(
             editors_count=SQCount(editors_query, field="id"),
             viewers_count=SQCount(viewers_query, field="id"),
-            size=SQSum(file_query, field="file_size"),
+            size=F("summary__resource_size"),
         )
         return queryset
 
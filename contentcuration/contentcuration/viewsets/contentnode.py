@@ -4,6 +4,7 @@ from functools import reduce
 from django.conf import settings
 from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
 from django.db.models import Exists
 from django.db.models import F
 from django.db.models import IntegerField as DjangoIntegerField
@@ -496,7 +497,8 @@ class PrerequisitesUpdateHandler(ViewSet):
 
         # In Django 2.2 add ignore_conflicts to make this fool proof
         try:
-            self._execute_changes(change_type, data)
+            with transaction.atomic():
+                self._execute_changes(change_type, data)
         except IntegrityError as e:
             for change in valid_changes:
                 change.update({"errors": str(e)})
@@ -627,7 +629,7 @@ class ContentNodeViewSet(BulkUpdateMixin, ChangeEventMixin, ValuesViewset):
         if not node.is_root_node():
             raise Http404
 
-        # we don't force the calculation, so if the channel is large, it returns the cached size
+        # the size of the channel tree is maintained as its files change, so this is a single lookup
         size, stale = calculate_resource_size(node=node, force=False)
         if stale:
             # When stale, that means the value is not up-to-date with modified files in the DB,
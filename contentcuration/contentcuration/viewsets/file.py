@@ -14,7 +14,6 @@ from contentcuration.models import generate_storage_url
 from contentcuration.utils.cache import ResourceSizeCache
 from contentcuration.utils.sentry import report_exception
 from contentcuration.utils.storage_common import get_presigned_upload_url
-from contentcuration.utils.user import calculate_user_storage
 from contentcuration.viewsets.base import BulkDeleteMixin
 from contentcuration.viewsets.base import BulkListSerializer
 from contentcuration.viewsets.base import BulkModelSerializer
@@ -58,10 +57,7 @@ class FileSerializer(BulkModelSerializer):
             if not update_node or update_node.id != instance.contentnode_id:
                 ResourceSizeCache.reset_modified_for_file(instance)
 
-        results = super(FileSerializer, self).update(instance, validated_data)
-        if instance.uploaded_by_id:
-            calculate_user_storage(instance.uploaded_by_id)
-        return results
+        return super(FileSerializer, self).update(instance, validated_data)
 
     class Meta:
         model = File
@@ -41,7 +41,7 @@ ALL_TABLES = set(
 
 
 # Using this as a workaround for not having a proper event source
-# this key will hold events for propagation in redis
+# this key will hold a list of events for propagation in redis
 USER_CHANGES_PREFIX = "user_changes_{user_id}"
 
 
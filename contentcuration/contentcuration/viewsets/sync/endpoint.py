@@ -7,6 +7,7 @@ import time
 from collections import OrderedDict
 from itertools import groupby
 
+from django.db import transaction
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import api_view
@@ -18,6 +19,7 @@ from rest_framework.status import HTTP_207_MULTI_STATUS
 from rest_framework.status import HTTP_400_BAD_REQUEST
 from search.viewsets.savedsearch import SavedSearchViewSet
 
+from contentcuration.tasks import queue_checksum_deltas_apply
 from contentcuration.utils.sentry import report_exception
 from contentcuration.viewsets.assessmentitem import AssessmentItemViewSet
 from contentcuration.viewsets.channel import ChannelViewSet
@@ -161,6 +163,115 @@ event_handlers = {
 }
 
 
+def get_change_identity(change):
+    key = change["key"]
+    # Compound keys come through as lists
+    if isinstance(key, list):
+        key = tuple(key)
+    return change["table"], key
+
+
+def get_merge_key(change):
+    """
+    Identifies a change, or an error reported for it, by its table, key and revision, as errors
+    can be new dicts built from the change rather than the change itself
+    """
+    key = change.get("key")
+    if isinstance(key, list):
+        key = tuple(key)
+    return change.get("table"), key, change.get("rev")
+
+
+def change_references_key(change, key):
+    """
+    Whether `change` refers to the object with `key` in any of its values
+    """
+    values = [change.get("target"), change.get("from_key")]
+    if isinstance(change.get("key"), list):
+        values.extend(change["key"])
+    for attr in ("obj", "mods"):
+        if isinstance(change.get(attr), dict):
+            values.extend(change[attr].values())
+    return key in values
+
+
+def can_merge_mods(mods, new_mods):
+    # An update to a nested path after an update to the whole field cannot be
+    # expressed in a single set of mods, so those have to stay separate.
+    return not any(
+        new_key.startswith(key + ".") for new_key in new_mods for key in mods
+    )
+
+
+def merge_mods(mods, new_mods):
+    merged = {
+        key: value
+        for key, value in mods.items()
+        if not any(key == new_key or key.startswith(new_key + ".") for new_key in new_mods)
+    }
+    merged.update(new_mods)
+    return merged
+
+
+def coalesce_changes(changes):  # noqa: C901
+    """
+    Reduces the changes of a sync request to fewer changes with the same outcome.
+    Objects that are created and then deleted within the request are dropped along
+    with all the changes to them in between, unless another change refers to them,
+    and successive updates to the same object are merged into a single update.
+
+    Returns the remaining changes, and a dict of the merged changes by their merge key to the
+    list of changes that they replace, so that any errors can be reported for each of them.
+    """
+    changes_by_identity = {}
+    for index, change in enumerate(changes):
+        if change.get("table") in viewset_mapping and "key" in change:
+            changes_by_identity.setdefault(get_change_identity(change), []).append(index)
+
+    dropped = set()
+    for identity, indices in changes_by_identity.items():
+        created = next((i for i in indices if changes[i].get("type") == CREATED), None)
+        if created is None:
+            continue
+        deleted = next((i for i in indices if i > created and changes[i].get("type") == DELETED), None)
+        if deleted is None:
+            continue
+        key = changes[created]["key"]
+        if any(
+            change_references_key(change, key)
+            for i, change in enumerate(changes)
+            if i not in indices
+        ):
+            continue
+        dropped.update(i for i in indices if created <= i <= deleted)
+
+    coalesced = []
+    merged = {}
+    last_change_index = {}
+    for index, change in enumerate(changes):
+        if index in dropped:
+            continue
+        if change.get("table") not in viewset_mapping or "key" not in change:
+            coalesced.append(change)
+            continue
+        identity = get_change_identity(change)
+        previous_index = last_change_index.get(identity)
+        previous = coalesced[previous_index] if previous_index is not None else None
+        if (
+            change.get("type") == UPDATED
+            and previous is not None
+            and previous.get("type") == UPDATED
+            and can_merge_mods(previous["mods"], change["mods"])
+        ):
+            merged_change = dict(change, mods=merge_mods(previous["mods"], change["mods"]))
+            merged[get_merge_key(merged_change)] = merged.pop(get_merge_key(previous), [previous]) + [change]
+            coalesced[previous_index] = merged_change
+        else:
+            last_change_index[identity] = len(coalesced)
+            coalesced.append(change)
+    return coalesced, merged
+
+
 def handle_changes(request, viewset_class, change_type, changes):
     try:
         change_type = int(change_type)
@@ -171,7 +282,12 @@ def handle_changes(request, viewset_class, change_type, changes):
             event_handler = getattr(viewset, event_handlers[change_type], None)
             if event_handler is None:
                 raise ChangeNotAllowed(change_type, viewset_class)
-            result = event_handler(changes)
+            # Handlers apply each change in its own savepoint, so that a database error in
+            # one change is reported against it alone. This savepoint only rolls back the
+            # changes of a handler that fails as a whole, as they're all reported as errors,
+            # and keeps the rest of the request from being rolled back with them.
+            with transaction.atomic():
+                result = event_handler(changes)
             elapsed = time.time() - start
 
             if elapsed > SLOW_UPDATE_THRESHOLD:
@@ -202,29 +318,42 @@ def sync(request):
     # this allows internal validation to take place and fields to be added
     # if needed by the server.
     changes_to_return = []
-    data = sorted(request.data, key=get_table_sort_order)
-    for table_name, group in groupby(data, get_table):
-        if table_name in viewset_mapping:
-            viewset_class = viewset_mapping[table_name]
-            group = sorted(group, key=get_change_order)
-            for change_type, changes in groupby(group, get_change_type):
-                # Coerce changes iterator to list so it can be read multiple times
-                es, cs = handle_changes(
-                    request, viewset_class, change_type, list(changes)
-                )
-                if es:
-                    errors.extend(es)
-                if cs:
-                    changes_to_return.extend(cs)
-
-    # Add any changes that have been logged from elsewhere in our hacky redis
-    # cache mechanism
+    coalesced, merged = coalesce_changes(request.data)
+    data = sorted(coalesced, key=get_table_sort_order)
+    with transaction.atomic():
+        for table_name, group in groupby(data, get_table):
+            if table_name in viewset_mapping:
+                viewset_class = viewset_mapping[table_name]
+                group = sorted(group, key=get_change_order)
+                for change_type, changes in groupby(group, get_change_type):
+                    # Coerce changes iterator to list so it can be read multiple times
+                    es, cs = handle_changes(
+                        request, viewset_class, change_type, list(changes)
+                    )
+                    if es:
+                        errors.extend(es)
+                    if cs:
+                        changes_to_return.extend(cs)
+
+    # Apply the changes to tree sizes queued by the database triggers, once they've been committed
+    queue_checksum_deltas_apply()
+
+    # Report errors against every change that was merged into a failed change
+    if merged:
+        errors = [
+            dict(error, **change)
+            for error in errors
+            for change in merged.get(get_merge_key(error), [{}])
+        ]
+
+    # Add any changes that have been logged for the user from elsewhere
+    # in their redis event list
     changes_to_return.extend(get_and_clear_user_events(request.user.id))
     if not errors:
         if changes_to_return:
             return Response({"changes": changes_to_return})
         return Response({})
-    if len(errors) < len(data) or changes_to_return:
+    if len(errors) < len(request.data) or changes_to_return:
         # If there are some errors, but not all, or all errors and some changes return a mixed response
         return Response(
             {"changes": changes_to_return, "errors": errors},
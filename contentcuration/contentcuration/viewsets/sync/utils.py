@@ -1,8 +1,8 @@
 import logging
 
 from django.conf import settings
-from django.core.cache import cache
 
+from contentcuration.utils.cache import UserEventsCache
 from contentcuration.utils.sentry import report_exception
 from contentcuration.viewsets.sync.constants import ALL_TABLES
 from contentcuration.viewsets.sync.constants import COPIED
@@ -76,16 +76,16 @@ def generate_copy_event(
 
 def add_event_for_user(user_id, event):
     cache_key = USER_CHANGES_PREFIX.format(user_id=user_id)
-    user_events = cache.get(cache_key) or []
-    user_events.append(event)
-    cache.set(cache_key, user_events, None)
+    UserEventsCache(cache_key).add_events([event])
 
 
 def get_and_clear_user_events(user_id):
+    """
+    Returns the oldest events waiting for the user, any events past the read size
+    are kept to be returned by the next call
+    """
     cache_key = USER_CHANGES_PREFIX.format(user_id=user_id)
-    user_events = cache.get(cache_key) or []
-    cache.delete(cache_key)
-    return user_events
+    return UserEventsCache(cache_key).read_events()
 
 
 def log_sync_exception(e):
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+from django.db import models
+
+
+# Titles weigh the most, then tags, author and finally description. The 'simple' configuration
+# is used as content comes in every language, so words are matched as they are.
+UPDATE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION search_contentnode_update_index(p_contentnode_id varchar) RETURNS void AS $$
+BEGIN
+    INSERT INTO search_contentnodefulltextsearch AS s (contentnode_id, keywords_tsvector, keywords_text)
+    SELECT
+        n.id,
+        setweight(to_tsvector('simple', COALESCE(n.title, '')), 'A')
+        || setweight(to_tsvector('simple', COALESCE(t.tags, '')), 'B')
+        || setweight(to_tsvector('simple', COALESCE(n.author, '')), 'C')
+        || setweight(to_tsvector('simple', COALESCE(n.description, '')), 'D'),
+        lower(concat_ws(' ', n.title, n.description, n.author, t.tags))
+    FROM contentcuration_contentnode n
+    LEFT JOIN LATERAL (
+        SELECT string_agg(ct.tag_name, ' ') AS tags
+        FROM contentcuration_contentnode_tags nt
+        INNER JOIN contentcuration_contenttag ct ON ct.id = nt.contenttag_id
+        WHERE nt.contentnode_id = n.id
+    ) t ON true
+    WHERE n.id = p_contentnode_id
+    ON CONFLICT (contentnode_id) DO UPDATE
+    SET keywords_tsvector = EXCLUDED.keywords_tsvector, keywords_text = EXCLUDED.keywords_text;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGERS_SQL = """
+CREATE OR REPLACE FUNCTION search_contentnode_index_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM search_contentnodefulltextsearch WHERE contentnode_id = OLD.id;
+    ELSE
+        PERFORM search_contentnode_update_index(NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER search_contentnode_index_insert_delete
+AFTER INSERT OR DELETE ON contentcuration_contentnode
+FOR EACH ROW EXECUTE PROCEDURE search_contentnode_index_trigger();
+
+CREATE TRIGGER search_contentnode_index_update
+AFTER UPDATE OF title, description, author ON contentcuration_contentnode
+FOR EACH ROW
+WHEN (
+    OLD.title IS DISTINCT FROM NEW.title
+    OR OLD.description IS DISTINCT FROM NEW.description
+    OR OLD.author IS DISTINCT FROM NEW.author
+)
+EXECUTE PROCEDURE search_contentnode_index_trigger();
+
+CREATE OR REPLACE FUNCTION search_contentnode_tags_index_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM search_contentnode_update_index(OLD.contentnode_id);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        PERFORM search_contentnode_update_index(NEW.contentnode_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER search_contentnode_tags_index
+AFTER INSERT OR UPDATE OR DELETE ON contentcuration_contentnode_tags
+FOR EACH ROW EXECUTE PROCEDURE search_contentnode_tags_index_trigger();
+
+CREATE OR REPLACE FUNCTION search_contenttag_index_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM search_contentnode_update_index(nt.contentnode_id)
+    FROM contentcuration_contentnode_tags nt WHERE nt.contenttag_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER search_contenttag_index
+AFTER UPDATE OF tag_name ON contentcuration_contenttag
+FOR EACH ROW
+WHEN (OLD.tag_name IS DISTINCT FROM NEW.tag_name)
+EXECUTE PROCEDURE search_contenttag_index_trigger();
+"""
+
+POPULATE_SQL = """
+INSERT INTO search_contentnodefulltextsearch (contentnode_id, keywords_tsvector, keywords_text)
+SELECT
+    n.id,
+    setweight(to_tsvector('simple', COALESCE(n.title, '')), 'A')
+    || setweight(to_tsvector('simple', COALESCE(t.tags, '')), 'B')
+    || setweight(to_tsvector('simple', COALESCE(n.author, '')), 'C')
+    || setweight(to_tsvector('simple', COALESCE(n.description, '')), 'D'),
+    lower(concat_ws(' ', n.title, n.description, n.author, t.tags))
+FROM contentcuration_contentnode n
+LEFT JOIN (
+    SELECT nt.contentnode_id, string_agg(ct.tag_name, ' ') AS tags
+    FROM contentcuration_contentnode_tags nt
+    INNER JOIN contentcuration_contenttag ct ON ct.id = nt.contenttag_id
+    GROUP BY nt.contentnode_id
+) t ON t.contentnode_id = n.id
+ON CONFLICT (contentnode_id) DO NOTHING;
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS search_contenttag_index ON contentcuration_contenttag;
+DROP TRIGGER IF EXISTS search_contentnode_tags_index ON contentcuration_contentnode_tags;
+DROP TRIGGER IF EXISTS search_contentnode_index_update ON contentcuration_contentnode;
+DROP TRIGGER IF EXISTS search_contentnode_index_insert_delete ON contentcuration_contentnode;
+DROP FUNCTION IF EXISTS search_contenttag_index_trigger();
+DROP FUNCTION IF EXISTS search_contentnode_tags_index_trigger();
+DROP FUNCTION IF EXISTS search_contentnode_index_trigger();
+DROP FUNCTION IF EXISTS search_contentnode_update_index(varchar);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentcuration', '0132_channelsummary'),
+        ('search', '0002_auto_20201215_2110'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='ContentNodeFullTextSearch',
+            fields=[
+                ('contentnode', models.OneToOneField(
+                    db_constraint=False,
+                    on_delete=django.db.models.deletion.DO_NOTHING,
+                    primary_key=True,
+                    related_name='search_index',
+                    serialize=False,
+                    to='contentcuration.contentnode',
+                )),
+                ('keywords_tsvector', django.contrib.postgres.search.SearchVectorField(null=True)),
+                ('keywords_text', models.TextField(default='')),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=POPULATE_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='contentnodefulltextsearch',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['keywords_tsvector'], name='node_keywords_tsv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contentnodefulltextsearch',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['keywords_text'], name='node_keywords_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunSQL(
+            sql=UPDATE_FUNCTION_SQL + TRIGGERS_SQL,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+    ]
@@ -1,6 +1,8 @@
 import uuid
 
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
 
@@ -13,3 +15,31 @@ class SavedSearch(models.Model):
     saved_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, related_name="searches", on_delete=models.CASCADE
     )
+
+
+class ContentNodeFullTextSearch(models.Model):
+    """
+    Search index of the keywords of a content node, its title, description, author and tags.
+
+    Rows are maintained by database triggers on the contentnode, contentnode tags and contenttag
+    tables (see migration 0003), so that nodes created, edited, copied or synced are always
+    indexed, however the change is made.
+    """
+    contentnode = models.OneToOneField(
+        "contentcuration.ContentNode",
+        primary_key=True,
+        related_name="search_index",
+        # rows are removed by the triggers along with their node, however it is deleted
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+    # Weighted full text vector, for matching whole words ranked by where they appear
+    keywords_tsvector = SearchVectorField(null=True)
+    # Lower cased text of all the keywords, for matching parts of words with the trigram index
+    keywords_text = models.TextField(default="")
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["keywords_tsvector"], name="node_keywords_tsv_idx"),
+            GinIndex(fields=["keywords_text"], name="node_keywords_trgm_idx", opclasses=["gin_trgm_ops"]),
+        ]
@@ -1,5 +1,7 @@
 import re
 
+from django.contrib.postgres.search import SearchQuery
+from django.contrib.postgres.search import SearchRank
 from django.db.models import Case
 from django.db.models import F
 from django.db.models import IntegerField
@@ -13,11 +15,13 @@ from django_filters.rest_framework import BooleanFilter
 from django_filters.rest_framework import CharFilter
 from le_utils.constants import content_kinds
 from le_utils.constants import roles
+from search.models import ContentNodeFullTextSearch
 
 from contentcuration.models import Channel
 from contentcuration.models import ContentNode
 from contentcuration.models import File
 from contentcuration.utils.pagination import CachedListPagination
+from contentcuration.utils.pagination import ValuesViewsetCursorPagination
 from contentcuration.viewsets.base import RequiredFilterSet
 from contentcuration.viewsets.common import NotNullMapArrayAgg
 from contentcuration.viewsets.common import SQArrayAgg
@@ -39,6 +43,13 @@ class ListPagination(CachedListPagination):
             return 1
 
 
+class ListCursorPagination(ValuesViewsetCursorPagination):
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = "-modified"
+
+
 uuid_re = re.compile("([a-f0-9]{32})")
 
 
@@ -70,23 +81,24 @@ class ContentNodeFilter(RequiredFilterSet):
         return queryset.filter(channel_id__in=list(channel_ids))
 
     def filter_keywords(self, queryset, name, value):
-        filter_query = Q(title__icontains=value) | Q(description__icontains=value)
-        tags_node_ids = ContentNode.tags.through.objects.filter(
-            contenttag__tag_name__icontains=value
-        ).values_list("contentnode_id", flat=True)[:250]
+        search_query = SearchQuery(value, config="simple")
+        # Whole words are matched with the full text index, and parts of words with the trigram index
+        matching_node_ids = ContentNodeFullTextSearch.objects.filter(
+            Q(keywords_tsvector=search_query) | Q(keywords_text__contains=value.lower())
+        ).values_list("contentnode_id", flat=True)
+        filter_query = Q(id__in=matching_node_ids)
         # Check if we have a Kolibri node id or ids and add them to the search if so.
         # Add to, rather than replace, the filters so that we never misinterpret a search term as a UUID.
-        # node_ids = uuid_re.findall(value) + list(tags_node_ids)
         node_ids = uuid_re.findall(value)
         for node_id in node_ids:
             # check for the major ID types
             filter_query |= Q(node_id=node_id)
             filter_query |= Q(content_id=node_id)
             filter_query |= Q(id=node_id)
-        for node_id in tags_node_ids:
-            filter_query |= Q(id=node_id)
 
-        return queryset.filter(filter_query)
+        return queryset.filter(filter_query).annotate(
+            search_rank=Coalesce(SearchRank(F("search_index__keywords_tsvector"), search_query), 0.0)
+        ).order_by("-search_rank")
 
     def filter_author(self, queryset, name, value):
         return queryset.filter(
@@ -139,6 +151,7 @@ class ContentNodeFilter(RequiredFilterSet):
 class SearchContentNodeViewSet(ContentNodeViewSet):
     filterset_class = ContentNodeFilter
     pagination_class = ListPagination
+    cursor_pagination_class = ListCursorPagination
     values = (
         "id",
         "content_id",
@@ -162,6 +175,13 @@ class SearchContentNodeViewSet(ContentNodeViewSet):
         "original_channel_name",
     )
 
+    def use_cursor_pagination(self):
+        # Keyword searches are ordered by rank, which cursors can't page through, so they are
+        # always paginated by page number
+        if self.request.query_params.get("keywords"):
+            return False
+        return super(SearchContentNodeViewSet, self).use_cursor_pagination()
+
     def annotate_queryset(self, queryset):
         """
         1. Do a distinct by 'content_id,' using the original node if possible
@@ -224,4 +244,7 @@ class SearchContentNodeViewSet(ContentNodeViewSet):
             content_tags=NotNullMapArrayAgg("tags__tag_name"),
             original_channel_name=original_channel_name,
         )
+        if "search_rank" in queryset.query.annotations:
+            # Keep the best keyword matches first, as ordered by the keywords filter
+            queryset = queryset.order_by("-search_rank")
         return queryset